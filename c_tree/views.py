@@ -1,5 +1,4 @@
 import json
-import os
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.views.generic import TemplateView
@@ -9,6 +8,7 @@ from django.conf import settings
 
 # Create your views here.
 import helpers
+from helpers import stubs
 from helpers.views import LoginMixin, CsrfCookieMixin
 
 
@@ -18,27 +18,21 @@ class TreeView(LoginMixin, CsrfCookieMixin, TemplateView):
     def post(self, request, *args, **kwargs):
         response = HttpResponse()
         if request.is_ajax():
+            payload = None
             if request.POST.get('all') == 'true':
-                path = os.path.join(settings.BASE_DIR, settings.STUB, settings.SAMPLE_NAME)
-                with open(path) as f:
-                    data = json.load(f)
+                data = stubs.load(settings.SAMPLE_NAME)
+                payload = stubs.payload(settings.SAMPLE_NAME)
             elif request.POST.get('verbatim') == 'true':
                 code_id = request.POST.get('id')
                 data = self.get_verbatim(code_id)
             else:
                 data = {'message': _('error')}
             if request.POST.get('csv', 'false') != 'true':
-                response = HttpResponse(json.dumps(data), content_type='application/json')
+                response = HttpResponse(payload or json.dumps(data), content_type='application/json')
             else:
-                response['content_type'] = 'text/csv'
-        if request.POST.get('csv') == 'true':
-            response['Content-Disposition'] = 'attachment; filename="tree.csv"'
-            helpers.json2csv(response, data['nodes'])
+                response = helpers.csv_response(data['nodes'], 'tree.csv')
         return response
 
     @staticmethod
     def get_verbatim(code_id):
-        path = os.path.join(settings.BASE_DIR, settings.STUB, settings.LEX_NAME)
-        with open(path, 'r') as f:
-            data = json.load(f)
-        return data[code_id]
+        return stubs.get_verbatim(code_id)
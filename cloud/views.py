@@ -5,14 +5,12 @@ from django.contrib.auth.decorators import login_required
 from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext as _
 from django.conf import settings
-import os
 import helpers
+from helpers import stubs
 from helpers.views import LoginMixin, CsrfCookieMixin
 
 # Create your views here.
-stub = settings.STUB
 sample_name = settings.SAMPLE_NAME
-lex_name = settings.LEX_NAME
 
 
 class CloudView(LoginMixin, CsrfCookieMixin, TemplateView):
@@ -20,31 +18,25 @@ class CloudView(LoginMixin, CsrfCookieMixin, TemplateView):
 
     def post(self, request, *args, **kwargs):
         if request.is_ajax():
+            payload = None
             if request.POST.get('all') == 'true':
                 # FIX: temporary data stub
-                path = os.path.join(settings.BASE_DIR, stub, sample_name)
-                with open(path, 'r') as f:
-                    data = json.load(f)
+                data = stubs.load(sample_name)
+                payload = stubs.payload(sample_name)
             elif request.POST.get('verbatim') == 'true':
                 code_id = request.POST.get('id')
                 data = self.get_verbatim(code_id)
             else:
                 data = {'message': _('error!')}
             if request.POST.get('csv', 'false') != 'true':
-                response = HttpResponse(json.dumps(data), content_type='application/json')
+                response = HttpResponse(payload or json.dumps(data), content_type='application/json')
             else:
-                response = HttpResponse(content_type='text/csv')
+                response = helpers.csv_response(data['nodes'], 'cloud.csv')
         else:
             response = super(CloudView, self).get(request, *args, **kwargs)
-        if request.POST.get('csv') == 'true':
-                response['Content-Disposition'] = 'attachment; filename="cloud.csv"'
-                helpers.json2csv(response, data['nodes'])
         return response
 
 
     @staticmethod
     def get_verbatim(code_id):
-        path = os.path.join(settings.BASE_DIR, stub, lex_name)
-        with open(path, 'r') as f:
-            data = json.load(f)
-        return data[code_id]
+        return stubs.get_verbatim(code_id)
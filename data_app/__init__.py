@@ -0,0 +1 @@
+default_app_config = 'data_app.apps.DataAppConfig'
@@ -1,6 +1,12 @@
+from django import forms
 from django.contrib import admin
-from data_app.models import Job, Question, Code, Variable, Verbatim, UploadFile, CodeBook
+from django.contrib import messages
+from django.contrib.admin import actions as admin_actions
+from django.utils.html import format_html, format_html_join
+from data_app.models import Job, Question, Code, Variable, Verbatim, UploadFile, CodeBook, ImportJob
+from data_app.models import delete_job_rows, job_field, recount_jobs
 from modeltranslation.admin import TranslationAdmin
+from data_app.validation import describe
 # Register your models here.
 
 
@@ -12,32 +18,117 @@ class ModelAdminTimeMixin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'updated_at')
 
 
+class JobRowsAdminMixin(object):
+    ''' Updates counts and versions of jobs once per deletion of their
+        rows, see data_app.models.delete_job_rows
+    '''
+    actions = ('delete_selected', )
+
+    def delete_model(self, request, obj):
+        delete_job_rows(type(obj).objects.filter(pk=obj.pk))
+
+    def delete_selected(self, request, queryset):
+        job_ids = set(queryset.values_list(job_field(queryset.model), flat=True))
+        response = admin_actions.delete_selected(self, request, queryset)
+        if response is None:  # confirmed and deleted
+            recount_jobs(job_ids)
+        return response
+    delete_selected.short_description = admin_actions.delete_selected.short_description
+
+
 class JobAdmin(TranslationAdminTimeMixin):
     pass
 
 
-class CodeBookAdmin(ModelAdminTimeMixin):
+class CodeBookAdmin(JobRowsAdminMixin, ModelAdminTimeMixin):
     pass
 
 
-class QuestionAdmin(TranslationAdminTimeMixin):
+class QuestionAdmin(JobRowsAdminMixin, TranslationAdminTimeMixin):
     pass
 
 
-class CodeAdmin(TranslationAdminTimeMixin):
+class CodeAdmin(JobRowsAdminMixin, TranslationAdminTimeMixin):
     pass
 
 
-class VariableAdmin(ModelAdminTimeMixin):
+class VariableAdmin(JobRowsAdminMixin, ModelAdminTimeMixin):
     pass
 
 
-class VerbatimAdmin(TranslationAdminTimeMixin):
+class VerbatimAdmin(JobRowsAdminMixin, TranslationAdminTimeMixin):
     pass
 
 
+class UploadFileForm(forms.ModelForm):
+    ''' Rejects files that are not workbooks or miss required sheets;
+        cells are validated by the queued import (see UploadFile.process)
+        and by the validate_sheets action
+    '''
+    shown_errors = 20
+
+    class Meta:
+        model = UploadFile
+        fields = ('sheet', 'incremental')
+
+    def clean_sheet(self):
+        sheet = self.cleaned_data['sheet']
+        errors = UploadFile.check_sheet_names(sheet)
+        if errors:
+            shown = [describe(error) for error in errors[:self.shown_errors]]
+            if len(errors) > self.shown_errors:
+                shown.append('and {} more errors'.format(len(errors) - self.shown_errors))
+            raise forms.ValidationError(shown)
+        return sheet
+
+
 class UploadFileAdmin(ModelAdminTimeMixin):
-    pass
+    ''' Shows wall/CPU time, rows and queries of every import stage,
+        validates uploaded and stored workbooks
+    '''
+    form = UploadFileForm
+    actions = ('validate_sheets', )
+    stat_columns = ('elapsed', 'cpu', 'rows_parsed', 'rows_written', 'queries')
+    list_display = ('__str__', 'job', 'created_at', 'import_time', 'import_queries')
+    readonly_fields = ('import_stats', 'job', 'fingerprint', 'changed_sheets', 'created_at', 'updated_at')
+
+    def import_time(self, obj):
+        stats = obj.get_stats()
+        return round(sum(s['elapsed'] for s in stats.values()), 3) if stats else None
+    import_time.short_description = 'Import, s'
+
+    def import_queries(self, obj):
+        stats = obj.get_stats()
+        return sum(s['queries'] for s in stats.values()) if stats else None
+    import_queries.short_description = 'Queries'
+
+    def import_stats(self, obj):
+        stats = obj.get_stats()
+        if not stats:
+            return '-'
+        header = format_html_join('', '<th>{}</th>', ((c, ) for c in ('stage', ) + self.stat_columns))
+        rows = format_html_join(
+            '', '<tr><td>{}</td>{}</tr>',
+            ((name, format_html_join('', '<td>{}</td>', ((stage[c], ) for c in self.stat_columns)))
+             for name, stage in stats.items()))
+        return format_html('<table><thead><tr>{}</tr></thead><tbody>{}</tbody></table>', header, rows)
+    import_stats.short_description = 'Import stages'
+
+    def validate_sheets(self, request, queryset):
+        for upload in queryset:
+            errors = UploadFile.validate_file(upload.sheet.path)
+            if not errors:
+                self.message_user(request, '{}: no errors'.format(upload))
+            for error in errors[:UploadFileForm.shown_errors]:
+                self.message_user(request, u'{}: {}'.format(upload, describe(error)), level=messages.ERROR)
+    validate_sheets.short_description = 'Validate workbooks'
+
+
+class ImportJobAdmin(ModelAdminTimeMixin):
+    list_display = ('upload', 'status', 'stage', 'job', 'worker', 'started_at', 'finished_at')
+    list_filter = ('status', )
+    readonly_fields = ('upload', 'job', 'status', 'stage', 'progress', 'error', 'worker',
+                       'started_at', 'finished_at', 'created_at', 'updated_at')
 
 
 admin.site.register(Job, JobAdmin)
@@ -46,4 +137,5 @@ admin.site.register(Code, CodeAdmin)
 admin.site.register(Verbatim, VerbatimAdmin)
 admin.site.register(Variable, VariableAdmin)
 admin.site.register(UploadFile, UploadFileAdmin)
-admin.site.register(CodeBook, CodeBookAdmin)
\ No newline at end of file
+admin.site.register(CodeBook, CodeBookAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
\ No newline at end of file
@@ -0,0 +1,194 @@
+__author__ = 'yarnaid'
+
+from collections import defaultdict
+
+from django.db.models import Count
+
+from data_app import job_index
+from data_app import models
+
+
+def code_tree(code_book):
+    """All codes of the codebook in MPTT order, fetched with one query
+    """
+    return list(models.Code.objects.filter(code_book=code_book).order_by('tree_id', 'lft'))
+
+
+def filtered_verbatims(question, filters=None):
+    """Verbatims of the question restricted by Variable fields
+
+    DIMENSIONS are filtered by their copies in Verbatim without join.
+
+    Arguments:
+    ----------
+        question: Question
+        filters: dict{String:int}
+            restrictions for Variable fields, e.g. {'sex': 1}
+    """
+    verbatims = models.Verbatim.objects.filter(question=question)
+    if filters and set(filters) <= set(models.DIMENSIONS):
+        verbatims = verbatims.filter(**filters)
+    elif filters:
+        variables = models.Variable.objects.filter(job_id=question.parent_id, **filters)
+        verbatims = verbatims.filter(variable__in=variables)
+    return verbatims
+
+
+def verbatim_counts(question, filters=None):
+    """Number of verbatims per code, one GROUP BY query
+
+    Returns:
+    --------
+        dict {code id: verbatim count}
+    """
+    verbatims = filtered_verbatims(question, filters).order_by()
+    return dict(verbatims.values_list('parent').annotate(Count('id')))
+
+
+def code_counts(question, filters=None, job=None):
+    """Number of verbatims per code, sliced from the precomputed cube of
+    the question when all filters are demographic DIMENSIONS
+
+    Arguments:
+    ----------
+        job: Job
+            job of the question; if given, counts come from the
+            in-memory index of the job (see data_app.job_index)
+    Returns:
+    --------
+        dict {code id: verbatim count}
+    """
+    return batch_code_counts([(question, filters or dict())],
+                             jobs={job.pk: job} if job is not None else None)[0]
+
+
+def code_trees(code_books):
+    """Codes of several codebooks in MPTT order, fetched with one query
+
+    Returns:
+    --------
+        dict {codebook id: list of Code}
+    """
+    trees = defaultdict(list)
+    codes = models.Code.objects.filter(code_book__in=set(code_books)).order_by('tree_id', 'lft')
+    for code in codes:
+        trees[code.code_book_id].append(code)
+    return trees
+
+
+def batch_code_counts(specs, jobs=None):
+    """Number of verbatims per code for several (question, filters) specs
+
+    Specs filtered by demographic DIMENSIONS only are sliced from
+    QuestionCube of their questions fetched with one query; the rest
+    fall back to verbatim_counts one by one. Questions of the given jobs
+    are counted in memory by job indexes instead, unless JOB_INDEX_SIZE
+    setting is 0.
+
+    Arguments:
+    ----------
+        specs: list of (Question, dict{String:int})
+        jobs: dict {job id: Job}
+            loaded jobs of the questions, their version is the
+            version of the index
+    Returns:
+    --------
+        list of dicts {code id: verbatim count} in the order of specs
+    """
+    results = [None] * len(specs)
+    if jobs and job_index.enabled():
+        for i, (question, filters) in enumerate(specs):
+            if question.parent_id in jobs:
+                index = job_index.get_index(jobs[question.parent_id])
+                results[i] = index.counts(question.id, filters)
+    bucketed = [i for i, (question, filters) in enumerate(specs)
+                if results[i] is None and set(filters) <= set(models.DIMENSIONS)]
+    if bucketed:
+        counts = models.QuestionCube.objects.counts([specs[i] for i in bucketed])
+        for i, result in zip(bucketed, counts):
+            results[i] = result
+    for i, (question, filters) in enumerate(specs):
+        if results[i] is None:
+            results[i] = verbatim_counts(question, filters)
+    return results
+
+
+def build_hierarchy(question, codes, counts):
+    """Assembles JSON-like tree of overcodes with rolled up verbatim counts
+
+    Code without verbatims in its subtree is omitted.
+
+    Arguments:
+    ----------
+        question: Question
+        codes: list of Code
+            codes of the question codebook in MPTT order (see code_tree)
+        counts: dict {code id: int}
+            own verbatims of each code (see code_counts)
+    Returns:
+    --------
+        list of dicts, one per overcode
+    """
+    roots = list()
+    children = defaultdict(list)
+    for code in codes:
+        if code.parent_id is None:
+            if code.overcode:
+                roots.append(code)
+        else:
+            children[code.parent_id].append(code)
+
+    def build(code, depth):
+        code_dict = {
+            'id': code.id,
+            'title': code.title,
+            'code': code.code,
+            'text': code.text,
+            'code_depth': depth,
+            'question_id': question.id,
+            'verbatim_count': counts.get(code.id, 0),
+        }
+        children_list = list()
+        for child_code in children[code.id]:
+            child = build(child_code, depth + 1)
+            if child is not None:
+                children_list.append(child)
+                code_dict['verbatim_count'] += child['verbatim_count']
+        if code_dict['verbatim_count'] == 0:
+            return None
+        code_dict['children'] = children_list
+        return code_dict
+
+    return [child for child in (build(code, 0) for code in roots) if child is not None]
+
+
+def response_body(job, question, overcodes):
+    """visualization_data response of the question
+
+    Arguments:
+    ----------
+        job: Job
+        question: Question
+            with code_book fetched
+        overcodes: list of dicts
+            see build_hierarchy
+    """
+    body = {
+        'job_number': job.number,
+        'job_name': job.name,
+        'question': {
+            'codebook_name': question.code_book.name,
+            'title': question.title,
+            'text': question.text,
+            'name': question.name,
+            'kind': question.kind,
+            'verbatim_count': 0,
+        }
+    }
+    body['question']['children'] = overcodes
+    for child in overcodes:
+        body['question']['verbatim_count'] += child['verbatim_count']
+        child['overcode'] = True
+    for child in overcodes:
+        child['total'] = child['verbatim_count'] / body['question']['verbatim_count']
+    return body
@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class DataAppConfig(AppConfig):
+    name = 'data_app'
+
+    def ready(self):
+        from data_app import signals  # noqa
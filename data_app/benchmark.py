@@ -0,0 +1,425 @@
+__author__ = 'yarnaid'
+
+import multiprocessing
+import os
+import resource
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from data_app import fast_serializers
+from data_app import models
+from data_app import query_plan
+from data_app import serializers
+from data_app.models import UploadFile
+from data_app.progress import Progress
+
+# name: (model, DRF serializer, fast serializer) of list endpoints
+SERIALIZERS = (
+    ('verbatims', models.Verbatim, serializers.VerbatimSerialier, fast_serializers.VerbatimValues),
+    ('codes', models.Code, serializers.CodeSerializer, fast_serializers.CodeValues),
+    ('variables', models.Variable, serializers.VariableSerializer, fast_serializers.VariableValues),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+def make_codebook(nets, subnets, codes, languages):
+    """Codebook sheet: NET rows, Sub net rows and leaf Codes rows
+
+    Leaf code numbers are NET * 100 + index, so every codebook of the
+    workbook has the same codes.
+
+    Returns:
+    --------
+        (DataFrame of the sheet, list of leaf code numbers)
+    """
+    rows = list()
+    leaves = list()
+    for net in range(1, nets + 1):
+        rows.append((net, None, None, 'net {}'.format(net)))
+        for sub in range(1, subnets + 1):
+            sub_net = net * 10 + sub
+            rows.append((net, sub_net, None, 'sub net {}'.format(sub_net)))
+        for i in range(codes):
+            code = net * 100 + i
+            sub_net = net * 10 + i % subnets + 1 if subnets else None
+            rows.append((net, sub_net, code, 'code {}'.format(code)))
+            leaves.append(code)
+    df = pd.DataFrame(rows, columns=['NET', 'Sub net', 'Codes', 'title'])
+    df['text'] = df['title'] + ' text'
+    for lang in languages:
+        df['text_' + lang] = df['text'] + ' ' + lang
+        df['title_' + lang] = df['title'] + ' ' + lang
+    return df, leaves
+
+
+def make_workbook(path, respondents=1000, questions=3, nets=5, subnets=2, codes=6,
+                  codes_per_answer=3, languages=('fr', ), seed=0):
+    """Writes synthetic workbook in the layout expected by UploadFile
+
+    Sheets: question, variables, cb_q<N> per question and verbatims with
+    '<question> - text', '<question> - code <i>' and '<question> - text_<lang>'
+    columns. Format follows the extension (.xls or .xlsx).
+
+    Arguments:
+    ----------
+        path: str
+            file name must start with job number, e.g. 900001_benchmark.xls
+        respondents: int
+            rows of variables and verbatims sheets
+        questions: int
+        nets, subnets, codes: int
+            overcodes per codebook, subnets and leaf codes per overcode
+        codes_per_answer: int
+            code columns per question, some of them are left empty
+    Returns:
+    --------
+        dict of generated sizes
+    """
+    rng = np.random.RandomState(seed)
+    names = ['Q{}'.format(i) for i in range(1, questions + 1)]
+    question_df = pd.DataFrame({
+        'id': names,
+        'type': 'Open',
+        'code_book': ['cb_' + name.lower() for name in names],
+        'text': [name + ' text' for name in names],
+        'title': [name + ' title' for name in names],
+    }, columns=['id', 'type', 'code_book', 'text', 'title'])
+    for lang in languages:
+        question_df['text_' + lang] = question_df['text'] + ' ' + lang
+        question_df['title_' + lang] = question_df['title'] + ' ' + lang
+
+    uids = np.arange(1, respondents + 1)
+    variable_df = pd.DataFrame({
+        'uid': uids,
+        'sex': rng.randint(1, 3, respondents),
+        'age_bands': rng.randint(1, 6, respondents),
+        'reg_quota': rng.randint(1, 5, respondents),
+        'csp_quota': rng.randint(1, 7, respondents),
+        'main_cell_text': 'cell',
+    }, columns=['uid', 'sex', 'age_bands', 'reg_quota', 'csp_quota', 'main_cell_text'])
+
+    codebook_df, leaves = make_codebook(nets, subnets, codes, languages)
+    verbatim_df = pd.DataFrame({'uid': uids})
+    assigned = 0
+    for name in names:
+        verbatim_df[name + ' - text'] = ['{} answer {}'.format(name, uid) for uid in uids]
+        for i in range(1, codes_per_answer + 1):
+            column = pd.Series(rng.choice(leaves, respondents), dtype=float)
+            if i > 1:  # first code is always given
+                column[rng.rand(respondents) < 0.5] = np.nan
+            assigned += column.notnull().sum()
+            verbatim_df['{} - code {}'.format(name, i)] = column
+        for lang in languages:
+            verbatim_df['{} - text_{}'.format(name, lang)] = verbatim_df[name + ' - text'] + ' ' + lang
+
+    writer = pd.ExcelWriter(path)
+    question_df.to_excel(writer, 'question', index=False)
+    variable_df.to_excel(writer, 'variables', index=False)
+    for name in names:
+        codebook_df.to_excel(writer, 'cb_' + name.lower(), index=False)
+    verbatim_df.to_excel(writer, 'verbatims', index=False)
+    writer.save()
+    return {
+        'respondents': respondents,
+        'questions': questions,
+        'codes': len(codebook_df) * questions,
+        'verbatims': int(assigned),
+    }
+
+
+def peak_memory():
+    """Peak resident memory of the process since its start, Mb
+
+    It's a high-water mark: it doesn't move during an import smaller
+    than the largest one already run by the process.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def current_memory():
+    """Resident memory of the process now, Mb
+
+    Read from /proc/self/statm; where it's missing the process peak is
+    returned, see peak_memory
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return peak_memory()
+    return pages * resource.getpagesize() / 1024. / 1024.
+
+
+class MemorySampler(threading.Thread):
+    """Samples resident memory of the process while the import runs
+
+    Attributes:
+    -----------
+        start_memory : float
+            memory when sampling started, Mb
+        peak : float
+            the largest sample, Mb
+        stages : dict
+            {stage: the largest sample of the stage over the sample
+            taken before it, Mb}; stages shorter than the interval
+            may be missed
+    """
+
+    def __init__(self, progress, interval=0.01):
+        super(MemorySampler, self).__init__()
+        self.daemon = True
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_memory = self.peak = self.last = current_memory()
+        self.stages = dict()
+        self._baselines = dict()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        memory = current_memory()
+        stage = self.progress.current
+        if stage is not None:
+            baseline = self._baselines.setdefault(stage, self.last)
+            self.stages[stage] = max(self.stages.get(stage, 0), memory - baseline)
+        self.peak = max(self.peak, memory)
+        self.last = memory
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+
+def run_import(name, keep=False):
+    """Imports the workbook stored in MEDIA_ROOT and measures it
+
+    Arguments:
+    ----------
+        name: str
+            name of the workbook in UploadFile storage
+        keep: bool
+            commit imported job, otherwise it's rolled back
+    Returns:
+    --------
+        dict with total wall time, query count, memory and per-stage
+        times, rows, queries (see data_app.progress.Progress) and memory
+        growth; memory of the import is sampled (see MemorySampler),
+        process_peak_memory_mb is the peak of the whole process
+    """
+    upload = UploadFile()
+    upload.sheet.name = name
+    progress = Progress()
+    sampler = MemorySampler(progress)
+    sampler.start()
+    started = time.time()
+    try:
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                job = upload.process(progress=progress)
+            if not keep:
+                raise Rollback()
+    except Rollback:
+        pass
+    finally:
+        sampler.stop()
+    stages = progress.as_dict()
+    for stage_name, stage in stages.items():
+        growth = sampler.stages.get(stage_name)
+        stage['memory_growth_mb'] = round(growth, 1) if growth is not None else None
+    return {
+        'file': name,
+        'job_number': job.number,
+        'size_kb': os.path.getsize(upload.sheet.path) / 1024,
+        'wall': time.time() - started,
+        'queries': len(queries),
+        'peak_memory_mb': sampler.peak,
+        'peak_memory_growth_mb': sampler.peak - sampler.start_memory,
+        'process_peak_memory_mb': peak_memory(),
+        'stages': stages,
+    }
+
+
+def import_committed(name):
+    """Imports the stored workbook in its own transaction and connection
+
+    Returns:
+    --------
+        (job id, wall time of the import)
+    """
+    upload = UploadFile()
+    upload.sheet.name = name
+    started = time.time()
+    try:
+        return upload.process().pk, time.time() - started
+    finally:
+        connection.close()
+
+
+def duplicates(queryset, *fields):
+    """Number of groups of rows sharing the values of fields
+    """
+    return (queryset.order_by().values(*fields).annotate(rows=Count('id'))
+            .filter(rows__gt=1).count())
+
+
+def check_integrity(jobs, verbatims=None):
+    """Problems of the imported jobs: tree ids shared by roots, broken
+    nested sets, rows referring to rows of other jobs, missing rows
+
+    Arguments:
+    ----------
+        jobs: list of job ids
+        verbatims: dict {job id: expected number of verbatims}
+    Returns:
+    --------
+        list of problem descriptions, empty if the jobs are consistent
+    """
+    problems = list()
+    if duplicates(models.Job.objects.filter(parent__isnull=True), 'tree_id'):
+        problems.append('jobs share tree ids')
+    codes = models.Code.objects.filter(job__in=jobs)
+    if duplicates(models.Code.objects.filter(parent__isnull=True), 'tree_id'):
+        problems.append('code trees share tree ids')
+    if duplicates(codes, 'tree_id', 'lft') or duplicates(codes, 'tree_id', 'rght'):
+        problems.append('codes share nested set numbers')
+    sizes = dict(codes.order_by().values_list('tree_id').annotate(Count('id')))
+    for tree_id, lft, rght in codes.filter(parent__isnull=True).values_list('tree_id', 'lft', 'rght'):
+        if lft != 1 or rght != 2 * sizes[tree_id]:
+            problems.append('code tree {} is not numbered 1..{}'.format(tree_id, 2 * sizes[tree_id]))
+    mixed = (
+        ('codes of other job codebooks', codes.exclude(code_book__job=F('job'))),
+        ('codes in trees of other jobs', codes.exclude(parent__isnull=True).exclude(parent__job=F('job'))),
+        ('questions in trees of other jobs', models.Question.objects.filter(parent__in=jobs)
+         .exclude(tree_id=F('parent__tree_id'))),
+        ('verbatims of other job variables', models.Verbatim.objects.filter(job__in=jobs)
+         .filter(variable__isnull=False).exclude(variable__job=F('job'))),
+        ('verbatims coded by other jobs', models.Verbatim.objects.filter(job__in=jobs)
+         .filter(parent__isnull=False).exclude(parent__job=F('job'))),
+    )
+    for problem, queryset in mixed:
+        count = queryset.count()
+        if count:
+            problems.append('{} {}'.format(count, problem))
+    stored = dict(models.Verbatim.objects.filter(job__in=jobs).order_by()
+                  .values_list('job').annotate(Count('id')))
+    for job, expected in (verbatims or {}).items():
+        if stored.get(job, 0) != expected:
+            problems.append('job {} has {} verbatims instead of {}'.format(job, stored.get(job, 0), expected))
+    return problems
+
+
+def run_concurrent_imports(names, workers, threads=False):
+    """Imports the stored workbooks by a pool of workers at once
+
+    Arguments:
+    ----------
+        names: list
+            names of the workbooks in UploadFile storage
+        workers: int
+            concurrent imports
+        threads: bool
+            import in threads instead of processes, e.g. with SQLite
+            in-memory database of tests
+    Returns:
+    --------
+        dict with total wall time, imports per second, wall time of
+        every import and ids of the imported jobs
+    """
+    connection.close()  # forked workers must not share the connection
+    pool = (ThreadPool if threads else multiprocessing.Pool)(workers)
+    started = time.time()
+    try:
+        results = pool.map(import_committed, names)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - started
+    return {
+        'workers': workers,
+        'imports': len(names),
+        'wall': wall,
+        'imports_per_second': len(names) / wall,
+        'import_walls': [seconds for job, seconds in results],
+        'jobs': [job for job, seconds in results],
+    }
+
+
+def serializer_context(path='/'):
+    return {'request': Request(RequestFactory().get(path)), 'format': None, 'view': None}
+
+
+def render_drf(model, serializer_class, limit=None, context=None):
+    """JSON of the rows as list endpoint renders it with DRF serializer
+    """
+    context = context or serializer_context()
+    queryset = query_plan.optimize(model.objects.order_by('id'), serializer_class(context=context))
+    data = serializer_class(queryset[:limit], many=True, context=context).data
+    return JSONRenderer().render(data)
+
+
+def render_fast(model, fast_class, limit=None, context=None):
+    """JSON of the rows as list endpoint renders it with values() serializer
+    """
+    serializer = fast_class(context or serializer_context())
+    rows = serializer.values(model.objects.order_by('id'))[:limit]
+    return fast_serializers.render_values(serializer.serialize(rows))
+
+
+def best_time(func, repeat):
+    times = list()
+    for i in range(repeat):
+        started = time.time()
+        func()
+        times.append(time.time() - started)
+    return min(times)
+
+
+def serializer_benchmark(limit=None, repeat=3):
+    """Rows per second of DRF serializers with JSONRenderer against
+    values() serializers with FastJSONRenderer on the stored rows,
+    queries included
+
+    Arguments:
+    ----------
+        limit: int
+            rows of every model, all by default
+        repeat: int
+            the best of repeated runs is taken
+    Returns:
+    --------
+        list of dicts, one per list endpoint
+    """
+    context = serializer_context()
+    report = list()
+    for name, model, serializer_class, fast_class in SERIALIZERS:
+        rows = model.objects.count() if limit is None else min(limit, model.objects.count())
+        drf = best_time(lambda: render_drf(model, serializer_class, limit, context), repeat)
+        fast = best_time(lambda: render_fast(model, fast_class, limit, context), repeat)
+        report.append({
+            'endpoint': name,
+            'rows': rows,
+            'drf_rows_per_second': rows / drf if drf else None,
+            'fast_rows_per_second': rows / fast if fast else None,
+            'speedup': drf / fast if fast else None,
+        })
+    return report
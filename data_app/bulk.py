@@ -0,0 +1,267 @@
+__author__ = 'yarnaid'
+
+import itertools
+from collections import defaultdict
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Max
+
+
+def get_batch_size():
+    """Number of rows written by a single INSERT during import
+
+    Configured with IMPORT_BATCH_SIZE setting
+    """
+    return getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+
+
+def next_id(model):
+    """First free primary key of the model table
+    """
+    try:
+        return model.objects.latest('id').id + 1
+    except model.DoesNotExist:
+        return 1
+
+
+def uses_sequences(using=DEFAULT_DB_ALIAS):
+    """Whether new ids are taken from database sequences
+
+    nextval() of PostgreSQL is neither rolled back nor blocked by other
+    transactions, so concurrent imports never get the same ids. On other
+    backends ids are counted from the stored maximum, which is safe only
+    while imports are serialized (see data_app.locks.import_lock).
+    """
+    return connections[using].vendor == 'postgresql'
+
+
+def tree_sequence(model):
+    """Name of PostgreSQL sequence of MPTT tree ids of the model,
+    created by migration 0030_tree_id_sequences
+    """
+    return '{}_{}_seq'.format(model._meta.db_table, model._mptt_meta.tree_id_attr)
+
+
+def nextval(sequence_sql, params, count, using=DEFAULT_DB_ALIAS):
+    cursor = connections[using].cursor()
+    try:
+        cursor.execute('SELECT nextval({}) FROM generate_series(1, %s)'.format(sequence_sql),
+                       list(params) + [count])
+        return sorted(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.close()
+
+
+def reserve_ids(model, count, using=DEFAULT_DB_ALIAS):
+    """Primary keys for count new rows of the model
+
+    Taken from the primary key sequence of the table where there is one,
+    so no sequence reset is needed after the rows are inserted with
+    explicit ids. Ids may be not contiguous.
+
+    Returns:
+    --------
+        sorted list of ids
+    """
+    if uses_sequences(using):
+        return nextval('pg_get_serial_sequence(%s, %s)',
+                       [model._meta.db_table, model._meta.pk.column], count, using=using)
+    first = next_id(model)
+    return range(first, first + count)
+
+
+def reserve_tree_ids(model, count, using=DEFAULT_DB_ALIAS):
+    """MPTT tree ids for count new roots of the model, see reserve_ids
+    """
+    if uses_sequences(using):
+        return nextval('%s', [tree_sequence(model)], count, using=using)
+    first = next_tree_id(model)
+    return range(first, first + count)
+
+
+class IdAllocator(object):
+    """Primary keys and tree ids of rows written by one import
+
+    Primary keys are reserved by blocks of IMPORT_BATCH_SIZE, so an import
+    makes one query per block instead of one per row. Without sequences
+    a block continues the previous one: its rows may be not written yet
+    when the next block is counted from the stored maximum.
+
+    Arguments:
+    ----------
+        block: int
+            ids reserved at once, IMPORT_BATCH_SIZE by default
+        using: String
+            database alias
+    """
+
+    def __init__(self, block=None, using=DEFAULT_DB_ALIAS):
+        self.block = block or get_batch_size()
+        self.using = using
+        self.free = defaultdict(deque)  # {(model, kind): reserved ids}
+        self.last = dict()  # {(model, kind): the last given id}
+
+    def take(self, key, count, reserve):
+        free = self.free[key]
+        if len(free) < count:
+            ids = reserve(count - len(free))
+            if key in self.last and not uses_sequences(self.using):
+                start = max(ids[0], self.last[key] + 1, free[-1] + 1 if free else 0)
+                ids = range(start, start + len(ids))
+            free.extend(ids)
+        taken = [free.popleft() for i in range(count)]
+        if taken:
+            self.last[key] = taken[-1]
+        return taken
+
+    def next_id(self, model):
+        """Primary key of one new row of the model
+        """
+        block = lambda count: reserve_ids(model, max(count, self.block), using=self.using)
+        return self.take((model, 'pk'), 1, block)[0]
+
+    def number_tree(self, nodes):
+        """Fills MPTT fields of new nodes, see number_tree, with reserved tree ids
+        """
+        if not nodes:
+            return
+        model = type(nodes[0])
+        parent_attr = model._mptt_meta.parent_attr
+        roots = len([node for node in nodes if getattr(node, parent_attr) is None])
+        tree_ids = self.take((model, 'tree_id'), roots,
+                             lambda count: reserve_tree_ids(model, count, using=self.using))
+        number_tree(nodes, tree_ids)
+
+
+def bulk_save(model, objects, batch_size=None, using=DEFAULT_DB_ALIAS):
+    """Writes objects with batched INSERTs bypassing Model.save()
+
+    MPTT fields of tree models must be filled in before,
+    see number_tree and number_leaves
+
+    Arguments:
+    ----------
+        model: Model
+            class of saved objects
+        objects: list
+            unsaved model instances with explicit primary keys
+        batch_size: int
+            rows per INSERT, IMPORT_BATCH_SIZE by default
+    Returns:
+    --------
+        list of saved objects
+    """
+    objects = list(objects)
+    if not objects:
+        return objects
+    if batch_size is None:
+        batch_size = get_batch_size()
+    # Django 1.8 doesn't cap explicit batch_size by backend limits (SQLite)
+    backend_size = connections[using].ops.bulk_batch_size(model._meta.concrete_fields, objects)
+    batch_size = max(min(batch_size, backend_size), 1)
+    model.objects.using(using).bulk_create(objects, batch_size=batch_size)
+    return objects
+
+
+def next_tree_id(model):
+    """First free MPTT tree id of the model table
+    """
+    tree_id_attr = model._mptt_meta.tree_id_attr
+    max_tree_id = model._tree_manager.aggregate(m=Max(tree_id_attr))['m']
+    return (max_tree_id or 0) + 1
+
+
+def number_tree(nodes, tree_ids):
+    """Fills MPTT fields of in-memory nodes of a self-referencing tree
+
+    Nested set numbers are computed in one pass over the nodes, so the
+    whole hierarchy can be written with bulk_save instead of inserting
+    node by node. Siblings keep the order of the nodes list, as MPTT
+    does for 'last-child' insertion.
+
+    Arguments:
+    ----------
+        nodes: list
+            unsaved MPTT instances, parent is either None (root)
+            or another instance from the list
+        tree_ids: int or iterable
+            tree ids given to the roots in order; int is the id of the
+            first root, next roots get following ids
+    """
+    if not nodes:
+        return
+    if isinstance(tree_ids, (int, long)):
+        tree_ids = itertools.count(tree_ids)
+    tree_ids = iter(tree_ids)
+    opts = nodes[0]._mptt_meta
+    roots = list()
+    children = defaultdict(list)
+    for node in nodes:
+        parent = getattr(node, opts.parent_attr)
+        if parent is None:
+            roots.append(node)
+        else:
+            children[id(parent)].append(node)
+
+    for root in roots:
+        tree_id = next(tree_ids)
+        counter = 1
+        # iterative dfs: (node, level, is_closing)
+        stack = [(root, 0, False)]
+        while stack:
+            node, level, closing = stack.pop()
+            if closing:
+                setattr(node, opts.right_attr, counter)
+                counter += 1
+                continue
+            setattr(node, opts.tree_id_attr, tree_id)
+            setattr(node, opts.level_attr, level)
+            setattr(node, opts.left_attr, counter)
+            counter += 1
+            stack.append((node, level, True))
+            for child in reversed(children[id(node)]):
+                stack.append((child, level + 1, False))
+
+
+def number_leaves(nodes):
+    """Fills MPTT fields of in-memory leaf nodes whose parents are saved
+
+    Used for Question and Verbatim which refer to the node of another
+    tree model (Job and Code) as the parent. Every node becomes a leaf
+    in the tree of its parent, numbered after the rows already stored
+    in that tree.
+
+    Arguments:
+    ----------
+        nodes: list
+            unsaved MPTT instances, parent is a saved instance
+    """
+    if not nodes:
+        return
+    model = type(nodes[0])
+    opts = model._mptt_meta
+    parent_opts = None
+    by_tree = defaultdict(list)
+    for node in nodes:
+        parent = getattr(node, opts.parent_attr)
+        parent_opts = parent._mptt_meta
+        by_tree[getattr(parent, parent_opts.tree_id_attr)].append(node)
+
+    filters = {'{}__in'.format(opts.tree_id_attr): by_tree.keys()}
+    stored = dict(model._tree_manager.filter(**filters)
+                  .values_list(opts.tree_id_attr)
+                  .annotate(Max(opts.right_attr)))
+
+    for tree_id, tree_nodes in by_tree.iteritems():
+        counter = (stored.get(tree_id) or 0) + 1
+        for node in tree_nodes:
+            parent = getattr(node, opts.parent_attr)
+            setattr(node, opts.tree_id_attr, tree_id)
+            setattr(node, opts.level_attr,
+                    getattr(parent, parent_opts.level_attr) + 1)
+            setattr(node, opts.left_attr, counter)
+            setattr(node, opts.right_attr, counter + 1)
+            counter += 2
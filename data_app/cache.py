@@ -0,0 +1,60 @@
+__author__ = 'yarnaid'
+
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import translation
+
+STATS_KEYS = ('hits', 'misses')
+
+
+def get_cache():
+    """Cache of visualization responses, VISUALIZATION_CACHE alias of CACHES
+
+    Local memory suits single node, FileBasedCache or shared
+    memcached/redis backend keeps workers consistent.
+    """
+    return caches[getattr(settings, 'VISUALIZATION_CACHE', 'default')]
+
+
+def visualization_key(job, question_id, filters):
+    """Canonical cache key of the visualization response
+
+    Job version is incremented by every change of the job data (see
+    data_app.models.touch_jobs), so stale entries are never read again
+    and expire by timeout. Titles and texts are translated, so active
+    language is a part of the key too.
+
+    Arguments:
+    ----------
+        job: Job
+        question_id: int
+        filters: dict{String:int}
+            restrictions for Variable fields, order doesn't matter
+    """
+    filters = '&'.join('{}={}'.format(k, int(v)) for k, v in sorted(filters.items()))
+    key = 'vis:{}:{}:{}:{}:{}'.format(job.pk, job.version, translation.get_language(),
+                                      int(question_id), filters)
+    # memcached doesn't accept long keys and spaces
+    return 'vis:' + hashlib.md5(key).hexdigest()
+
+
+def count(name):
+    cache = get_cache()
+    key = 'vis_stats:' + name
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:  # evicted between add and incr
+        cache.set(key, 1, None)
+
+
+def stats():
+    """Hit and miss counters of the visualization cache
+    """
+    values = get_cache().get_many(['vis_stats:' + name for name in STATS_KEYS])
+    result = {name: values.get('vis_stats:' + name, 0) for name in STATS_KEYS}
+    total = result['hits'] + result['misses']
+    result['hit_rate'] = float(result['hits']) / total if total else None
+    return result
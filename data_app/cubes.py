@@ -0,0 +1,131 @@
+__author__ = 'yarnaid'
+
+import json
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Cube(object):
+    """Verbatim counts of one question per code and every combination
+    of demographic dimension values
+
+    Position 0 of each dimension axis is the "all" rollup, positions
+    1.. are the values of the dimension in the order of `axes`, so
+    counts of any filter combination are a single slice.
+
+    Attributes:
+    -----------
+        codes: list of int
+            code ids, the first axis of the array
+        axes: list of lists
+            values of each dimension found in the question
+        array: np.ndarray of int32
+            shape (len(codes), len(axes[0]) + 1, ...)
+    """
+
+    def __init__(self, codes, axes, array):
+        self.codes = codes
+        self.axes = axes
+        self.array = array
+
+    @classmethod
+    def from_buckets(cls, rows, dimensions):
+        """Builds the cube of (code id, value per dimension..., count) rows
+
+        Arguments:
+        ----------
+            rows: list of tuples
+                e.g. CodeCount buckets of the question
+            dimensions: int
+                number of dimension values in a row
+        """
+        codes = sorted(set(row[0] for row in rows))
+        axes = [sorted(set(row[i + 1] for row in rows)) for i in range(dimensions)]
+        array = np.zeros([len(codes)] + [len(axis) + 1 for axis in axes], dtype=np.int32)
+        if rows:
+            positions = [np.searchsorted(codes, [row[0] for row in rows])]
+            for i, axis in enumerate(axes):
+                lookup = {value: pos + 1 for pos, value in enumerate(axis)}
+                positions.append(np.array([lookup[row[i + 1]] for row in rows]))
+            np.add.at(array, tuple(positions), np.array([row[-1] for row in rows], dtype=np.int32))
+            # rolls every axis up into its position 0, axis by axis,
+            # so "all" of several dimensions is summed as well
+            for axis in range(1, array.ndim):
+                rollup = [slice(None)] * array.ndim
+                rollup[axis] = 0
+                values = [slice(None)] * array.ndim
+                values[axis] = slice(1, None)
+                array[tuple(rollup)] = array[tuple(values)].sum(axis=axis)
+        return cls(codes, axes, array)
+
+    def encode(self):
+        """(JSON of codes and axes, compressed array bytes)
+        """
+        header = json.dumps({'codes': self.codes, 'axes': self.axes, 'shape': self.array.shape})
+        return header, zlib.compress(self.array.tobytes())
+
+    @classmethod
+    def decode(cls, header, data):
+        header = json.loads(header)
+        array = np.frombuffer(zlib.decompress(bytes(data)), dtype=np.int32)
+        return cls(header['codes'], header['axes'], array.reshape(header['shape']))
+
+    def counts(self, values):
+        """Number of verbatims per code
+
+        Arguments:
+        ----------
+            values: list
+                value of each dimension or None for "all"; a value
+                missing in the question matches nothing
+        Returns:
+        --------
+            dict {code id: verbatim count} of codes with verbatims
+        """
+        index = [slice(None)]
+        for axis, value in zip(self.axes, values):
+            if value is None:
+                index.append(0)
+            elif value in axis:
+                index.append(axis.index(value) + 1)
+            else:
+                return dict()
+        vector = self.array[tuple(index)]
+        return {code: int(count) for code, count in zip(self.codes, vector) if count}
+
+
+class LRUCache(object):
+    """Bounded per-process mapping dropping the least recently used keys
+
+    Attributes:
+    -----------
+        size: int
+            maximum number of kept values
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
@@ -0,0 +1,96 @@
+__author__ = 'yarnaid'
+
+import re
+from collections import OrderedDict
+
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count
+
+from data_app import aggregation
+from data_app import models
+
+
+def canonical_queries(job=None):
+    """Hot queries of visualization_data, verbatim popups and import
+
+    Parameters are taken from the job (the latest one by default), so
+    plans are close to the real ones; on empty database ids are 0, which
+    doesn't change what indexes are usable.
+
+    Returns:
+    --------
+        OrderedDict {name: QuerySet}
+    """
+    if job is None:
+        job = models.Job.objects.order_by('-id').first()
+    question = models.Question.objects.filter(parent=job, code_book__isnull=False).first()
+    if question is None:
+        question = models.Question(id=0, parent_id=0, code_book_id=0, name='')
+    code = models.Code.objects.filter(code_book=question.code_book_id).first()
+    code_id = code.id if code is not None else 0
+    code_number = code.code if code is not None else 0
+    job_id = job.id if job is not None else 0
+    filters = {'sex': 1}
+    queries = OrderedDict()
+    queries['code_tree'] = (models.Code.objects
+                            .filter(code_book=question.code_book_id)
+                            .order_by('tree_id', 'lft'))
+    queries['question_cubes'] = (models.QuestionCube.objects
+                                 .filter(question__in=[question.id])
+                                 .select_related('job'))
+    queries['verbatim_counts'] = (aggregation.filtered_verbatims(question, filters)
+                                  .order_by()
+                                  .values_list('parent')
+                                  .annotate(Count('id')))
+    queries['code_verbatims'] = (models.Verbatim.objects
+                                 .filter(parent=code_id, question=question)
+                                 .order_by('id'))
+    queries['code_verbatims_filtered'] = aggregation.filtered_verbatims(question, filters).filter(
+        parent=code_id).order_by('id')
+    queries['overcodes'] = models.Code.objects.filter(code_book=question.code_book_id, overcode=True)
+    queries['code_by_number'] = models.Code.objects.filter(
+        job=job_id, code_book=question.code_book_id, code=code_number)
+    queries['question_by_name'] = models.Question.objects.filter(parent=job_id, name=question.name)
+    queries['import_questions'] = models.Question.objects.filter(parent=job_id)
+    queries['import_codes'] = models.Code.objects.filter(job=job_id)
+    queries['import_variables'] = models.Variable.objects.filter(job=job_id)
+    return queries
+
+
+SQLITE_SCAN = re.compile(r'^SCAN (TABLE )?\w+$')
+
+
+def explain(queryset, using=DEFAULT_DB_ALIAS):
+    """Plan of the queryset by EXPLAIN of the database
+
+    Arguments:
+    ----------
+        queryset: QuerySet
+        using: String
+            database alias
+    Returns:
+    --------
+        (list of plan lines, bool whether no table is read by full scan)
+    """
+    connection = connections[using]
+    sql, params = queryset.query.sql_with_params()
+    vendor = connection.vendor
+    prefix = 'EXPLAIN QUERY PLAN ' if vendor == 'sqlite' else 'EXPLAIN '
+    cursor = connection.cursor()
+    try:
+        cursor.execute(prefix + sql, params)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    if vendor == 'sqlite':
+        lines = [row[-1] for row in rows]
+        indexed = not any(SQLITE_SCAN.match(line) for line in lines)
+    elif vendor == 'mysql':
+        lines = [' '.join('{}={}'.format(c, v) for c, v in zip(columns, row)) for row in rows]
+        indexed = 'ALL' not in [row[columns.index('type')] for row in rows]
+    else:
+        lines = [row[0] for row in rows]
+        indexed = not any('Seq Scan' in line for line in lines)
+    return lines, indexed
@@ -0,0 +1,253 @@
+__author__ = 'yarnaid'
+
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework import renderers
+from rest_framework.reverse import reverse
+from rest_framework.response import Response
+from rest_framework.utils import encoders
+
+from data_app import models
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def render_values(data):
+    """JSON of ValuesSerializer output
+
+    Rows of values() hold only numbers, strings and None, so ujson is
+    used when it's installed: it has no default handler for dates,
+    Decimals and lazy translations of other responses.
+    """
+    if ujson is not None:
+        return ujson.dumps(data, ensure_ascii=False).encode('utf-8')
+    return render_json(data)
+
+
+def render_json(data):
+    return json.dumps(data, separators=(',', ':'), default=encoders.JSONEncoder().default)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """Compact JSON without indentation
+
+    Uses the C encoder of json module, which escapes non-ASCII
+    characters: on python 2 it's much faster than the pure python path
+    DRF takes with UNICODE_JSON. Responses with values_rows attribute
+    set by FastListMixin are rendered by render_values.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        response = (renderer_context or dict()).get('response')
+        if getattr(response, 'values_rows', False):
+            return render_values(data)
+        return render_json(data)
+
+
+class ValuesSerializer(object):
+    """Read-only serializer building rows from values() dicts
+
+    Gives the JSON of the model serializer of the same endpoint without
+    model instances, nested serializers and URL reversing per row.
+    ?fields= is supported like data_app.serializers.SparseFieldsMixin.
+
+    Attributes:
+    -----------
+        fields : tuple
+            lookups passed to values()
+    """
+    fields = ()
+
+    def __init__(self, context=None):
+        self.context = context or dict()
+        request = self.context.get('request')
+        requested = request.query_params.get('fields') if request is not None else None
+        self.requested = set(name.strip() for name in requested.split(',')) if requested else None
+
+    def values(self, queryset):
+        """values() queryset of the rows, relations of the model
+        serializer aren't needed
+        """
+        return queryset.select_related(None).prefetch_related(None).values(*self.fields)
+
+    def to_representation(self, row):
+        raise NotImplementedError()
+
+    def wants(self, name):
+        return self.requested is None or name in self.requested
+
+    def serialize(self, rows):
+        data = [self.to_representation(row) for row in rows]
+        if self.requested is not None:
+            data = [{k: v for k, v in item.iteritems() if k in self.requested} for item in data]
+        return data
+
+
+class VariableValues(ValuesSerializer):
+    """Same JSON as data_app.serializers.VariableSerializer
+    """
+    fields = ('uid', 'sex', 'age_bands', 'reg_quota', 'csp_quota', 'main_cell_text', 'id')
+
+    def to_representation(self, row):
+        return row
+
+
+class VerbatimValues(ValuesSerializer):
+    """Same JSON as data_app.serializers.VerbatimSerialier
+    """
+    fields = ('id', 'verbatim', 'parent_id', 'parent__text', 'question_id', 'question__name',
+              'variable_id', 'variable__uid', 'variable__sex', 'variable__age_bands',
+              'variable__reg_quota', 'variable__csp_quota', 'variable__main_cell_text')
+
+    def to_representation(self, row):
+        variable = None
+        if row['variable_id'] is not None:
+            variable = {
+                'uid': row['variable__uid'],
+                'sex': row['variable__sex'],
+                'age_bands': row['variable__age_bands'],
+                'reg_quota': row['variable__reg_quota'],
+                'csp_quota': row['variable__csp_quota'],
+                'main_cell_text': row['variable__main_cell_text'],
+                'id': row['variable_id'],
+            }
+        parent = None
+        if row['parent_id'] is not None:
+            parent = {'text': row['parent__text'], 'id': row['parent_id']}
+        question = None
+        if row['question_id'] is not None:
+            question = {'id': row['question_id'], 'name': row['question__name']}
+        return {
+            'variable': variable,
+            'verbatim': row['verbatim'],
+            'parent': parent,
+            'id': row['id'],
+            'question': question,
+        }
+
+
+class CodeValues(ValuesSerializer):
+    """Same JSON as data_app.serializers.CodeSerializer
+
+    Verbatims of all codes of the page are fetched with one query.
+    """
+    fields = ('id', 'text', 'title', 'code', 'overcode', 'code_book_id', 'code_book__name',
+              'job_id', 'job__name', 'job__number', 'parent_id', 'parent__text')
+
+    def __init__(self, context=None):
+        super(CodeValues, self).__init__(context)
+        self.job_urls = dict()
+
+    def job_url(self, job_id):
+        if job_id not in self.job_urls:
+            self.job_urls[job_id] = reverse('job-detail', kwargs={'pk': job_id},
+                                            request=self.context.get('request'))
+        return self.job_urls[job_id]
+
+    def serialize(self, rows):
+        rows = list(rows)
+        self.verbatims = dict()
+        if self.wants('children_verbatims'):
+            verbatim_values = VerbatimValues()
+            verbatims = models.Verbatim.objects.filter(parent__in=[row['id'] for row in rows])
+            for row in verbatim_values.values(verbatims):
+                self.verbatims.setdefault(row['parent_id'], list()).append(
+                    verbatim_values.to_representation(row))
+        return super(CodeValues, self).serialize(rows)
+
+    def to_representation(self, row):
+        code_book = None
+        if row['code_book_id'] is not None:
+            code_book = {'name': row['code_book__name'], 'id': row['code_book_id']}
+        parent = None
+        if row['parent_id'] is not None:
+            parent = {'text': row['parent__text'], 'id': row['parent_id']}
+        return {
+            'text': row['text'],
+            'title': row['title'],
+            'code': row['code'],
+            'code_book': code_book,
+            'job': {
+                'name': row['job__name'],
+                'number': row['job__number'],
+                'id': row['job_id'],
+                'url': self.job_url(row['job_id']),
+            },
+            'overcode': row['overcode'],
+            'id': row['id'],
+            'parent': parent,
+            'children_verbatims': self.verbatims.get(row['id'], []),
+        }
+
+
+def keyset_chunks(rows, size):
+    """Rows of values() queryset in chunks of ordered ids
+
+    Every chunk is a separate 'WHERE id > last id LIMIT size' query, so
+    neither the database driver nor the process keeps more than a chunk,
+    whatever the backend.
+    """
+    rows = rows.order_by('id')
+    last = None
+    while True:
+        chunk = list((rows if last is None else rows.filter(id__gt=last))[:size])
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        last = chunk[-1]['id']
+
+
+def stream_json(serializer, rows, size):
+    """Generator of JSON array fragments of all rows, chunk by chunk
+    """
+    yield '['
+    separator = ''
+    for chunk in keyset_chunks(rows, size):
+        # rendered chunk without its brackets
+        yield separator + render_values(serializer.serialize(chunk))[1:-1]
+        separator = ','
+    yield ']'
+
+
+class FastListMixin(object):
+    """Viewset mixin listing rows with fast_serializer_class
+
+    Retrieve, create and update keep the model serializer.
+    With allow_stream, ?stream=1 returns all rows as JSON array streamed
+    chunk by chunk instead of a page: memory of the worker doesn't grow
+    with the number of rows.
+
+    Attributes:
+    -----------
+        fast_serializer_class : ValuesSerializer subclass or None
+        allow_stream : bool
+        stream_chunk_size : int
+            rows per query of the stream
+    """
+    fast_serializer_class = None
+    allow_stream = False
+    stream_query_param = 'stream'
+    stream_chunk_size = 1000
+
+    def list(self, request, *args, **kwargs):
+        if self.fast_serializer_class is None:
+            return super(FastListMixin, self).list(request, *args, **kwargs)
+        serializer = self.fast_serializer_class(context=self.get_serializer_context())
+        queryset = serializer.values(self.filter_queryset(self.get_queryset()))
+        if self.allow_stream and request.query_params.get(self.stream_query_param) in ('1', 'true'):
+            return StreamingHttpResponse(stream_json(serializer, queryset, self.stream_chunk_size),
+                                         content_type='application/json')
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            response = self.get_paginated_response(serializer.serialize(page))
+        else:
+            response = Response(serializer.serialize(queryset))
+        response.values_rows = True
+        return response
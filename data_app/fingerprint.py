@@ -0,0 +1,38 @@
+__author__ = 'yarnaid'
+
+import hashlib
+import json
+
+import pandas as pd
+
+CHUNK = 1 << 20  # bytes of the file hashed at once
+
+
+def file_fingerprint(path, version):
+    """SHA-256 of the file content and the parser version
+
+    The file is read by chunks, so the whole workbook is never in memory.
+    """
+    digest = hashlib.sha256('{}\n'.format(version))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def frame_hash(df):
+    """SHA-256 of the parsed sheet: column names and cell values
+    """
+    digest = hashlib.sha256(json.dumps([unicode(column) for column in df.columns]))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def changed_sheets(hashes, previous):
+    """Names of sheets whose hashes differ, added and removed sheets included
+
+    Arguments:
+    ----------
+        hashes, previous: dict {sheet name: frame_hash}
+    """
+    return sorted(name for name in set(hashes) | set(previous) if hashes.get(name) != previous.get(name))
@@ -0,0 +1,205 @@
+__author__ = 'yarnaid'
+
+import hashlib
+import json
+from collections import defaultdict
+
+from data_app import bulk
+
+IN_BATCH = 500  # ids per IN (...) lookup, SQLite allows 999 parameters
+
+
+class StructureChanged(Exception):
+    """Code trees of the workbook differ from the stored ones, nested
+    sets can't be updated row by row
+    """
+
+
+def content_fields(model):
+    """Concrete fields compared between parsed and stored rows: all but
+    primary key, MPTT numbers and modification times
+    """
+    skip = set()
+    mptt_meta = getattr(model, '_mptt_meta', None)
+    if mptt_meta is not None:
+        skip.update([mptt_meta.left_attr, mptt_meta.right_attr,
+                     mptt_meta.tree_id_attr, mptt_meta.level_attr])
+    return [f for f in model._meta.concrete_fields
+            if not f.primary_key and f.attname not in skip
+            and not getattr(f, 'auto_now', False) and not getattr(f, 'auto_now_add', False)]
+
+
+def row_hash(fields, values):
+    """Content hash of the row, values are normalized by their fields,
+    so e.g. 1.0 parsed by pandas and 1 stored in integer column match
+    """
+    values = [None if value is None else field.to_python(value) for field, value in zip(fields, values)]
+    return hashlib.sha1(json.dumps(values, default=unicode)).hexdigest()
+
+
+def code_paths(rows):
+    """Numbers of ancestors and the code itself by code id
+
+    Arguments:
+    ----------
+        rows: list of (id, code number, parent id)
+    """
+    numbers = {pk: (code, parent_id) for pk, code, parent_id in rows}
+    paths = dict()
+
+    def path(pk):
+        if pk not in paths:
+            code, parent_id = numbers[pk]
+            paths[pk] = (path(parent_id) if parent_id is not None else ()) + (code,)
+        return paths[pk]
+
+    for pk in numbers:
+        path(pk)
+    return paths
+
+
+def stored_keys(model, job):
+    """Natural keys of the stored rows of the job, the same parsers of
+    UploadFile give to RowSync.new_id
+
+    Returns:
+    --------
+        dict {natural key: id}
+    """
+    name = model._meta.model_name
+    if name == 'codebook':
+        return dict((key, pk) for pk, key in model.objects.filter(job=job).values_list('id', 'name'))
+    if name == 'question':
+        rows = model.objects.filter(parent=job).values_list('id', 'name', 'kind', 'code_book__name')
+        return dict((key, pk) for pk, key in ((row[0], row[1:]) for row in rows))
+    if name == 'variable':
+        return dict((key, pk) for pk, key in model.objects.filter(job=job).values_list('id', 'uid'))
+    if name == 'code':
+        rows = model.objects.filter(job=job).values_list('id', 'code', 'parent_id',
+                                                         'code_book__name', 'overcode')
+        paths = code_paths([row[:3] for row in rows])
+        return dict(((book, paths[pk], overcode), pk) for pk, code, parent_id, book, overcode in rows)
+    if name == 'verbatim':
+        rows = (model.objects.filter(job=job).order_by('id')
+                .values_list('id', 'variable_id', 'question_id', 'parent_id'))
+        ordinals = defaultdict(int)
+        keys = dict()
+        for pk, variable_id, question_id, code_id in rows:
+            key = (variable_id, question_id, code_id)
+            keys[key + (ordinals[key],)] = pk
+            ordinals[key] += 1
+        return keys
+    raise ValueError('no natural key of {}'.format(name))
+
+
+class RowSync(object):
+    """Ids and writes of parsed rows of UploadFile
+
+    Without stored job every parsed row gets new id and is inserted with
+    bulk_save. With stored job, parsed rows take the ids of stored rows
+    with the same natural key; rows whose content hash differs are
+    updated, new ones inserted, and stored rows not met in the workbook
+    are deleted by delete_missing.
+
+    Attributes:
+    -----------
+        job: Job
+        incremental: bool
+            whether the job has stored rows to compare with
+        ids: bulk.IdAllocator
+            ids of new rows
+        unchanged: callable
+            takes model, tells whether its parsed rows can't differ from
+            the stored ones (e.g. their sheets are unchanged), then rows
+            are not compared
+        inserted, updated, deleted: int
+            numbers of written rows
+    """
+
+    def __init__(self, job, incremental=False, unchanged=None):
+        self.job = job
+        self.incremental = incremental
+        self.unchanged = unchanged or (lambda model: False)
+        self.ids = bulk.IdAllocator()
+        self.stored = dict()  # {model: {key: id}}
+        self.keys = defaultdict(dict)  # {model: {id: key}} of parsed rows
+        self.inserted = self.updated = self.deleted = 0
+
+    @property
+    def changed(self):
+        return bool(self.inserted or self.updated or self.deleted)
+
+    def stored_ids(self, model):
+        if model not in self.stored:
+            self.stored[model] = stored_keys(model, self.job) if self.incremental else dict()
+        return self.stored[model]
+
+    def new_id(self, model, key):
+        """Primary key of the parsed row with the natural key
+        """
+        pk = self.stored_ids(model).get(key)
+        if pk is None:
+            pk = self.ids.next_id(model)
+        self.keys[model][pk] = key
+        return pk
+
+    def save(self, model, objects, number=None):
+        """Writes parsed rows
+
+        Arguments:
+        ----------
+            model: Model
+            objects: list
+                parsed instances with ids given by new_id
+            number: callable
+                fills MPTT fields of new instances, e.g. bulk.number_leaves
+        Returns:
+        --------
+            number of written rows
+        """
+        stored = set(self.stored_ids(model).values())
+        new = [obj for obj in objects if obj.pk not in stored]
+        if model._meta.model_name == 'code' and self.incremental and \
+                (new or len(objects) != len(stored)):
+            raise StructureChanged()
+        if number is not None:
+            number(new)
+        bulk.bulk_save(model, new)
+        self.inserted += len(new)
+        changed = list()
+        if not self.unchanged(model):
+            changed = self.changed_rows(model, [obj for obj in objects if obj.pk in stored])
+        fields = content_fields(model)
+        for obj in changed:
+            model.objects.filter(pk=obj.pk).update(**{f.attname: getattr(obj, f.attname) for f in fields})
+        self.updated += len(changed)
+        return len(new) + len(changed)
+
+    def changed_rows(self, model, objects):
+        if not objects:
+            return []
+        fields = content_fields(model)
+        attnames = [f.attname for f in fields]
+        hashes = dict()
+        ids = [obj.pk for obj in objects]
+        for start in range(0, len(ids), IN_BATCH):
+            rows = model.objects.filter(pk__in=ids[start:start + IN_BATCH]).values_list('pk', *attnames)
+            for row in rows:
+                hashes[row[0]] = row_hash(fields, row[1:])
+        return [obj for obj in objects
+                if hashes[obj.pk] != row_hash(fields, [getattr(obj, a) for a in attnames])]
+
+    def delete_missing(self, models):
+        """Deletes stored rows whose natural keys weren't parsed
+
+        Arguments:
+        ----------
+            models: list
+                in order of deletion, e.g. dependent rows first
+        """
+        for model in models:
+            parsed = self.keys[model]
+            missing = [pk for pk in self.stored_ids(model).values() if pk not in parsed]
+            for start in range(0, len(missing), IN_BATCH):
+                model.objects.filter(pk__in=missing[start:start + IN_BATCH]).delete()
+            self.deleted += len(missing)
@@ -0,0 +1,110 @@
+__author__ = 'yarnaid'
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+from data_app import models
+from data_app.cubes import LRUCache
+
+NULL = -1  # missing values in int32 columns
+
+
+class JobIndex(object):
+    """Coded verbatims of one job as parallel int32 arrays
+
+    Rows are ordered by question, so verbatims of a question are a
+    contiguous slice; codes are numbered densely for np.bincount.
+
+    Attributes:
+    -----------
+        version: int
+            version of the job the index is loaded at
+        codes: np.ndarray
+            code ids by dense position
+        code: np.ndarray
+            dense code position of each verbatim
+        variable: np.ndarray
+            variable id of each verbatim, NULL if missing
+        dimensions: dict {String: np.ndarray}
+            DIMENSIONS values of each verbatim, NULL if missing
+        questions: dict {question id: (start, stop)}
+            rows of the question
+    """
+
+    def __init__(self, job):
+        self.version = job.version
+        columns = ('question', 'parent', 'variable') + models.DIMENSIONS
+        rows = (models.Verbatim.objects
+                .filter(job=job, question__isnull=False, parent__isnull=False)
+                .order_by()
+                .values_list(*columns))
+        df = pd.DataFrame.from_records(list(rows), columns=columns)
+        df = df.fillna(NULL).astype(np.int32).sort_values('question', kind='mergesort')
+        self.codes, code = np.unique(df['parent'].values, return_inverse=True)
+        self.code = code.astype(np.int32)
+        self.variable = df['variable'].values
+        self.dimensions = {d: df[d].values for d in models.DIMENSIONS}
+        question = df['question'].values
+        ids, starts = np.unique(question, return_index=True)
+        stops = list(starts[1:]) + [len(question)]
+        self.questions = {int(q): (int(start), int(stop)) for q, start, stop in zip(ids, starts, stops)}
+        self.job_id = job.pk
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in [self.codes, self.code, self.variable] + self.dimensions.values())
+
+    def counts(self, question_id, filters=None):
+        """Number of verbatims per code of the question
+
+        DIMENSIONS are compared in memory, other Variable fields are
+        resolved to variable ids with one query.
+
+        Arguments:
+        ----------
+            question_id: int
+            filters: dict{String:int}
+                restrictions for Variable fields, e.g. {'sex': 1}
+        Returns:
+        --------
+            dict {code id: verbatim count}
+        """
+        filters = dict(filters or {})
+        start, stop = self.questions.get(question_id, (0, 0))
+        rows = slice(start, stop)
+        mask = np.ones(stop - start, dtype=bool)
+        for name in models.DIMENSIONS:
+            if name in filters:
+                mask &= self.dimensions[name][rows] == filters.pop(name)
+        if filters:
+            variables = models.Variable.objects.filter(job_id=self.job_id, **filters)
+            ids = np.fromiter(variables.values_list('id', flat=True), dtype=np.int32)
+            mask &= np.in1d(self.variable[rows], ids)
+        counts = np.bincount(self.code[rows][mask], minlength=len(self.codes))
+        found = np.flatnonzero(counts)
+        return dict(zip(self.codes[found].tolist(), counts[found].tolist()))
+
+
+# JobIndex by job id, JOB_INDEX_SIZE jobs per process
+indexes = LRUCache(getattr(settings, 'JOB_INDEX_SIZE', 8))
+
+
+def enabled():
+    return indexes.size > 0
+
+
+def get_index(job):
+    """Index of the job, loaded again when the job data has changed
+
+    Arguments:
+    ----------
+        job: Job
+            its version is the version of the index (see
+            data_app.models.touch_jobs)
+    """
+    index = indexes.get(job.pk)
+    if index is None or index.version != job.version:
+        index = JobIndex(job)
+        indexes.set(job.pk, index)
+    return index
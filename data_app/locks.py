@@ -0,0 +1,82 @@
+__author__ = 'yarnaid'
+
+import fcntl
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db import DatabaseError
+from django.db import DEFAULT_DB_ALIAS
+from django.db import transaction
+
+from data_app import bulk
+
+LOCK_NAME = 'data_app_import'
+MYSQL_LOCK_TIMEOUT = 3600  # seconds an import waits for the running one
+
+
+def lock_key(name):
+    """Signed 32-bit key of pg_advisory_xact_lock for the lock name
+    """
+    return zlib.crc32(name.encode('utf-8'))
+
+
+def lock_file(using=DEFAULT_DB_ALIAS):
+    """File locked by imports into SQLite database, one per database
+    """
+    database = connections[using].settings_dict['NAME']
+    return os.path.join(tempfile.gettempdir(), '{}_{:x}.lock'.format(
+        LOCK_NAME, zlib.crc32(database.encode('utf-8')) & 0xffffffff))
+
+
+@contextmanager
+def import_lock(name, using=DEFAULT_DB_ALIAS):
+    """Transaction of an import holding the lock of its job
+
+    With ids from sequences (PostgreSQL, see bulk.uses_sequences) the lock
+    is an advisory lock of the job only: imports of different jobs run
+    concurrently, imports of the same job wait for each other. Otherwise
+    new ids are counted from stored ones, and all imports into the
+    database are serialized by a single lock (GET_LOCK of MySQL, a file
+    lock for SQLite) taken before the transaction starts and released
+    after it ends.
+
+    Arguments:
+    ----------
+        name: String
+            job the import writes, e.g. '<number>_<name>'
+        using: String
+            database alias
+    """
+    connection = connections[using]
+    if bulk.uses_sequences(using):
+        with transaction.atomic(using=using):
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [lock_key(name)])
+            finally:
+                cursor.close()
+            yield
+    elif connection.vendor == 'mysql':
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT GET_LOCK(%s, %s)', [LOCK_NAME, MYSQL_LOCK_TIMEOUT])
+            if not cursor.fetchone()[0]:
+                raise DatabaseError('import lock is not released in {} s'.format(MYSQL_LOCK_TIMEOUT))
+            try:
+                with transaction.atomic(using=using):
+                    yield
+            finally:
+                cursor.execute('SELECT RELEASE_LOCK(%s)', [LOCK_NAME])
+        finally:
+            cursor.close()
+    else:
+        with open(lock_file(using), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                with transaction.atomic(using=using):
+                    yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from data_app.models import CodeCount
+from data_app.models import copy_dimensions
+from data_app.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Copies demographic fields of variables to their verbatims ' \
+           'and rebuilds verbatim counts of the jobs (all jobs by default).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, nargs='+', default=None,
+                            help='ids of the jobs to backfill')
+
+    def handle(self, *args, **options):
+        jobs = Job.objects.order_by('id')
+        if options['job']:
+            jobs = jobs.filter(id__in=options['job'])
+        for job in jobs:
+            updated = copy_dimensions(job)
+            CodeCount.objects.rebuild(job)
+            self.stdout.write('{}: {} verbatims updated'.format(job, updated))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from data_app import explain
+from data_app.models import Job
+
+
+class Command(BaseCommand):
+    help = 'Runs EXPLAIN for hot queries of visualization_data, verbatim popups ' \
+           'and import and reports whether each of them reads tables by index. ' \
+           'Note that PostgreSQL prefers sequential scans of small tables anyway, ' \
+           'run it against a database with real jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', type=int, default=None,
+                            help='id of the job to take parameters from, the latest by default')
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--verbose-plan', action='store_true', default=False,
+                            help='print plans of all queries, not only of unindexed ones')
+        parser.add_argument('--fail', action='store_true', default=False,
+                            help='exit with error if any query is unindexed')
+
+    def handle(self, *args, **options):
+        job = None
+        if options['job'] is not None:
+            try:
+                job = Job.objects.get(pk=options['job'])
+            except Job.DoesNotExist:
+                raise CommandError('Job {} does not exist'.format(options['job']))
+        unindexed = list()
+        for name, queryset in explain.canonical_queries(job).items():
+            lines, indexed = explain.explain(queryset, using=options['database'])
+            self.stdout.write('{:<28}{}'.format(name, 'index' if indexed else 'FULL SCAN'))
+            if not indexed:
+                unindexed.append(name)
+            if options['verbose_plan'] or not indexed:
+                for line in lines:
+                    self.stdout.write('    {}'.format(line))
+        if unindexed and options['fail']:
+            raise CommandError('Unindexed queries: {}'.format(', '.join(unindexed)))
@@ -0,0 +1,67 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand
+
+from data_app import benchmark
+from data_app.models import UploadFile
+
+
+class Command(BaseCommand):
+    help = 'Generates synthetic workbooks of the given sizes, imports them ' \
+           'and reports wall time, query count and memory growth of every stage. ' \
+           'Imported jobs are rolled back unless --keep is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--respondents', type=int, nargs='+', default=[1000, 5000],
+                            help='sizes of the generated workbooks')
+        parser.add_argument('--questions', type=int, default=3)
+        parser.add_argument('--nets', type=int, default=5)
+        parser.add_argument('--subnets', type=int, default=2)
+        parser.add_argument('--codes', type=int, default=6,
+                            help='leaf codes per NET')
+        parser.add_argument('--codes-per-answer', type=int, default=3)
+        parser.add_argument('--format', choices=['xls', 'xlsx'], default='xls')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help='commit imported jobs and keep generated files')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print reports as JSON')
+
+    def handle(self, *args, **options):
+        storage = UploadFile._meta.get_field('sheet').storage
+        reports = list()
+        for respondents in options['respondents']:
+            name = os.path.join('benchmark', '9{:05d}_benchmark_{}.{}'.format(
+                respondents % 100000, respondents, options['format']))
+            path = storage.path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            sizes = benchmark.make_workbook(
+                path, respondents=respondents, questions=options['questions'],
+                nets=options['nets'], subnets=options['subnets'], codes=options['codes'],
+                codes_per_answer=options['codes_per_answer'])
+            try:
+                report = benchmark.run_import(name, keep=options['keep'])
+            finally:
+                if not options['keep']:
+                    os.remove(path)
+            report.update(sizes)
+            reports.append(report)
+            if not options['json']:
+                self.print_report(report)
+        if options['json']:
+            self.stdout.write(json.dumps(reports, indent=2))
+
+    def print_report(self, report):
+        self.stdout.write('{file}: {respondents} respondents, {questions} questions, '
+                          '{codes} codes, {verbatims} verbatims, {size_kb} Kb'.format(**report))
+        self.stdout.write('  {:<18}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+            'stage', 'wall, s', 'cpu, s', 'parsed', 'written', 'queries', '+mem, Mb'))
+        for name, stage in report['stages'].items():
+            memory = stage['memory_growth_mb']
+            self.stdout.write('  {:<18}{:>10.3f}{:>10.3f}{:>10}{:>10}{:>10}{:>10}'.format(
+                name, stage['elapsed'], stage['cpu'], stage['rows_parsed'],
+                stage['rows_written'], stage['queries'], '-' if memory is None else memory))
+        self.stdout.write('  total {wall:.3f} s, {queries} queries, peak memory {peak_memory_mb:.1f} Mb '
+                          '(+{peak_memory_growth_mb:.1f} Mb), process peak {process_peak_memory_mb:.1f} Mb'
+                          .format(**report))
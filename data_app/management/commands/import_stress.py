@@ -0,0 +1,68 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from data_app import benchmark
+from data_app.models import Job
+from data_app.models import UploadFile
+
+
+class Command(BaseCommand):
+    help = 'Generates synthetic workbooks, imports them concurrently by a pool ' \
+           'of processes, checks ids, trees and row counts of the imported jobs ' \
+           'and reports the throughput. Imported jobs are deleted unless --keep is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--imports', type=int, default=8,
+                            help='number of imported workbooks')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='concurrent imports')
+        parser.add_argument('--respondents', type=int, default=1000)
+        parser.add_argument('--questions', type=int, default=3)
+        parser.add_argument('--threads', action='store_true', default=False,
+                            help='import in threads instead of processes')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help='keep imported jobs and generated files')
+        parser.add_argument('--json', action='store_true', default=False,
+                            help='print the report as JSON')
+
+    def handle(self, *args, **options):
+        storage = UploadFile._meta.get_field('sheet').storage
+        names = list()
+        verbatims = list()
+        for i in range(options['imports']):
+            name = os.path.join('stress', '8{:05d}_stress.xls'.format(i))
+            path = storage.path(name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            sizes = benchmark.make_workbook(path, respondents=options['respondents'],
+                                            questions=options['questions'], seed=i)
+            names.append(name)
+            verbatims.append(sizes['verbatims'])
+        try:
+            report = benchmark.run_concurrent_imports(names, options['workers'],
+                                                      threads=options['threads'])
+            report['verbatims_per_second'] = sum(verbatims) / report['wall']
+            report['problems'] = benchmark.check_integrity(
+                report['jobs'], dict(zip(report['jobs'], verbatims)))
+        finally:
+            if not options['keep']:
+                for name in names:
+                    storage.delete(name)
+        if not options['keep']:
+            Job.objects.filter(pk__in=report['jobs']).delete()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.stdout.write('{imports} imports by {workers} workers: {wall:.3f} s, '
+                              '{imports_per_second:.2f} imports/s, '
+                              '{verbatims_per_second:.0f} verbatims/s'.format(**report))
+            self.stdout.write('  import wall time: min {:.3f} s, max {:.3f} s'.format(
+                min(report['import_walls']), max(report['import_walls'])))
+            for problem in report['problems']:
+                self.stdout.write('  ' + problem)
+        if report['problems']:
+            raise CommandError('{} integrity problems'.format(len(report['problems'])))
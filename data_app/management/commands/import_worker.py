@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from data_app import tasks
+
+
+class Command(BaseCommand):
+    help = 'Runs queued spreadsheet imports (ImportJob). ' \
+           'Start several workers to import several studies at once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sleep', type=float, default=2,
+                            help='seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        worker = tasks.worker_name()
+        self.stdout.write('Import worker {} started'.format(worker))
+        while True:
+            import_job = tasks.claim_next(worker)
+            if import_job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            self.stdout.write('Importing {}'.format(import_job.upload))
+            import_job = tasks.run_import_job(import_job)
+            self.stdout.write('{} {}'.format(import_job.upload, import_job.status))
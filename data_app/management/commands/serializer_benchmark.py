@@ -0,0 +1,43 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from data_app import benchmark
+from data_app.models import UploadFile
+
+
+class Command(BaseCommand):
+    help = 'Imports a synthetic workbook and compares rows per second of DRF ' \
+           'serializers and values() serializers of the list endpoints. ' \
+           'Imported job is rolled back.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--respondents', type=int, default=2000)
+        parser.add_argument('--questions', type=int, default=3)
+        parser.add_argument('--limit', type=int, default=None,
+                            help='rows of every endpoint, all by default')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        storage = UploadFile._meta.get_field('sheet').storage
+        name = os.path.join('benchmark', '9{:05d}_serializers.xls'.format(options['respondents'] % 100000))
+        path = storage.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        benchmark.make_workbook(path, respondents=options['respondents'],
+                                questions=options['questions'])
+        try:
+            with transaction.atomic():
+                benchmark.run_import(name, keep=True)
+                report = benchmark.serializer_benchmark(options['limit'], options['repeat'])
+                raise benchmark.Rollback()
+        except benchmark.Rollback:
+            pass
+        finally:
+            os.remove(path)
+        self.stdout.write('{:<12}{:>10}{:>14}{:>14}{:>10}'.format(
+            'endpoint', 'rows', 'drf rows/s', 'fast rows/s', 'speedup'))
+        for row in report:
+            self.stdout.write('{endpoint:<12}{rows:>10}{drf_rows_per_second:>14.0f}'
+                              '{fast_rows_per_second:>14.0f}{speedup:>10.1f}'.format(**row))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0022_auto_20150511_0650'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('status', models.CharField(default=b'pending', max_length=16, choices=[(b'pending', b'Pending'), (b'running', b'Running'), (b'done', b'Done'), (b'failed', b'Failed')])),
+                ('stage', models.CharField(max_length=64, blank=True)),
+                ('progress', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('worker', models.CharField(max_length=255, blank=True)),
+                ('started_at', models.DateTimeField(null=True, blank=True)),
+                ('finished_at', models.DateTimeField(null=True, blank=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, to='data_app.Job', null=True)),
+                ('upload', models.ForeignKey(related_name='import_jobs', to='data_app.UploadFile')),
+            ],
+            options={
+                'ordering': ('updated_at',),
+                'abstract': False,
+            },
+        ),
+    ]
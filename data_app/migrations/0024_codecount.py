@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+DIMENSIONS = ('sex', 'age_bands', 'reg_quota', 'csp_quota')
+
+
+def count_verbatims(apps, schema_editor):
+    Verbatim = apps.get_model('data_app', 'Verbatim')
+    CodeCount = apps.get_model('data_app', 'CodeCount')
+    dimensions = ['variable__' + d for d in DIMENSIONS]
+    rows = (Verbatim.objects
+            .filter(question__isnull=False, parent__isnull=False)
+            .order_by()
+            .values_list('job', 'question', 'parent', *dimensions)
+            .annotate(Count('id')))
+    CodeCount.objects.bulk_create(
+        (CodeCount(job_id=row[0], question_id=row[1], code_id=row[2], count=row[-1],
+                   **dict(zip(DIMENSIONS, row[3:-1])))
+         for row in rows),
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0023_importjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CodeCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sex', models.IntegerField(null=True, blank=True)),
+                ('age_bands', models.IntegerField(null=True, blank=True)),
+                ('reg_quota', models.IntegerField(null=True, blank=True)),
+                ('csp_quota', models.IntegerField(null=True, blank=True)),
+                ('count', models.IntegerField(default=0)),
+                ('code', models.ForeignKey(to='data_app.Code')),
+                ('job', models.ForeignKey(to='data_app.Job')),
+                ('question', models.ForeignKey(to='data_app.Question')),
+            ],
+        ),
+        migrations.RunPython(count_verbatims, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0024_codecount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfile',
+            name='stats',
+            field=models.TextField(editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0025_uploadfile_stats'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='question',
+            index_together=set([('parent', 'name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='code',
+            index_together=set([('code_book', 'overcode'), ('job', 'code_book', 'code'), ('code_book', 'tree_id', 'lft')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='verbatim',
+            index_together=set([('parent', 'question', 'variable'), ('question', 'variable')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='codecount',
+            index_together=set([('question', 'code')]),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+DIMENSIONS = ('sex', 'age_bands', 'reg_quota', 'csp_quota')
+
+
+def copy_dimensions(apps, schema_editor):
+    Variable = apps.get_model('data_app', 'Variable')
+    Verbatim = apps.get_model('data_app', 'Verbatim')
+    for values in Variable.objects.order_by().values_list(*DIMENSIONS).distinct():
+        dimensions = dict(zip(DIMENSIONS, values))
+        (Verbatim.objects
+         .filter(variable__in=Variable.objects.filter(**dimensions))
+         .update(**dimensions))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0026_index_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='verbatim',
+            name='sex',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='verbatim',
+            name='age_bands',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='verbatim',
+            name='reg_quota',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='verbatim',
+            name='csp_quota',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='verbatim',
+            index_together=set([('parent', 'question', 'variable'), ('question', 'variable'),
+                                ('question', 'sex'), ('question', 'age_bands'),
+                                ('question', 'reg_quota'), ('question', 'csp_quota')]),
+        ),
+        migrations.RunPython(copy_dimensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0027_verbatim_dimensions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionCube',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('version', models.DateTimeField()),
+                ('header', models.TextField()),
+                ('data', models.BinaryField()),
+                ('job', models.ForeignKey(to='data_app.Job')),
+                ('question', models.OneToOneField(related_name='cube', to='data_app.Question')),
+            ],
+        ),
+    ]
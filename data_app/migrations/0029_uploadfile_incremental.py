@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0028_questioncube'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfile',
+            name='incremental',
+            field=models.BooleanField(default=False, help_text='update the job with the same number and name instead of creating new one'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# tables whose root tree ids are taken by data_app.bulk.reserve_tree_ids
+TREE_TABLES = ('data_app_job', 'data_app_code')
+
+
+def create_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table in TREE_TABLES:
+        schema_editor.execute('CREATE SEQUENCE {}_tree_id_seq'.format(table))
+        schema_editor.execute("SELECT setval('{0}_tree_id_seq', COALESCE(MAX(tree_id), 0) + 1, false) "
+                              "FROM {0}".format(table))
+
+
+def drop_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for table in TREE_TABLES:
+        schema_editor.execute('DROP SEQUENCE {}_tree_id_seq'.format(table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0029_uploadfile_incremental'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_sequences, drop_sequences),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0030_tree_id_sequences'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadfile',
+            name='job',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.SET_NULL, blank=True, editable=False, to='data_app.Job', null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='job_version',
+            field=models.DateTimeField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='fingerprint',
+            field=models.CharField(db_index=True, max_length=64, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='parser_version',
+            field=models.IntegerField(null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='sheet_hashes',
+            field=models.TextField(editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='changed_sheets',
+            field=models.TextField(editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def delete_cubes(apps, schema_editor):
+    # cubes versioned by timestamps are rebuilt on the next request
+    apps.get_model('data_app', 'QuestionCube').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_app', '0031_uploadfile_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(delete_cubes, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='questioncube',
+            name='version',
+        ),
+        migrations.AddField(
+            model_name='questioncube',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RemoveField(
+            model_name='uploadfile',
+            name='job_version',
+        ),
+        migrations.AddField(
+            model_name='uploadfile',
+            name='job_version',
+            field=models.PositiveIntegerField(blank=True, null=True, editable=False),
+        ),
+    ]
@@ -3,19 +3,56 @@ import thread
 
 import helpers.models as helpers
 import os
+import numpy as np
 import pandas as pd
 import re
-import time
+import json
+import xlrd
 
+from collections import defaultdict
+from collections import OrderedDict
 from django.db import models
+from django.db.models import Count
+from django.db.models import F
+from django.db import IntegrityError
 from django.db import transaction
+from mptt.managers import TreeManager
 from mptt.models import MPTTModel
 from mptt.models import TreeForeignKey
 # from silk.profiling.profiler import silk_profile
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
+from django.utils import timezone
+from data_app import bulk
+from data_app import fingerprint
+from data_app import validation
+from data_app.cubes import Cube
+from data_app.cubes import LRUCache
+from data_app.incremental import RowSync
+from data_app.incremental import StructureChanged
+from data_app.locks import import_lock
+from data_app.progress import Progress
+from data_app.sheets import SheetReader
+from data_app.validation import WorkbookInvalid
 
 cb_regex = '^cb_.*$'
+# sheets read by UploadFile besides cb_* codebooks
+DATA_SHEETS = ('question', 'variables', 'verbatims')
+# sheets the rows of each model are parsed from, cb_regex stands for
+# all codebook sheets; codebooks have no content besides natural keys
+MODEL_SHEETS = {
+    'codebook': (),
+    'question': ('question', ),
+    'variable': ('variables', ),
+    'code': (cb_regex, ),
+    'verbatim': ('verbatims', 'variables'),
+}
+# bump on changes of UploadFile parsers, so fingerprints of workbooks
+# imported by older parsers don't match
+PARSER_VERSION = 1
+
+# Variable fields verbatim counts are materialized by (see CodeCount)
+DIMENSIONS = ('sex', 'age_bands', 'reg_quota', 'csp_quota')
 
 
 class OverwriteStorage(FileSystemStorage):
@@ -44,16 +81,105 @@ class OverwriteStorage(FileSystemStorage):
         return name
 
 
+class RootTreeManager(TreeManager):
+    """TreeManager giving new roots tree ids of bulk.reserve_tree_ids,
+    so roots saved one by one and trees of concurrent imports don't share
+    tree ids
+    """
+
+    def _get_next_tree_id(self):
+        return bulk.reserve_tree_ids(self.model, 1, using=self.db)[0]
+
+
 class Job(MPTTModel, helpers.TimeMixin):
     name = models.CharField(max_length=255)
     number = models.IntegerField()
     parent = TreeForeignKey('self', null=True, blank=True,
                             related_name='children_jobs')
+    # version of the job data, see touch_jobs
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = RootTreeManager()
 
     def __str__(self):
         return '{}_{}'.format(self.number, self.name)
 
 
+def df_records(df):
+    """Rows of DataFrame as list of dicts, empty cells are None
+    """
+    return df.astype(object).where(pd.notnull(df), None).to_dict('records')
+
+
+def translations(row, prefixes=('text_', 'title_')):
+    """Translated columns of the row, e.g. {'text_fr': ...}
+    """
+    return {key: value for key, value in row.iteritems()
+            if any(key.count(prefix) > 0 for prefix in prefixes)}
+
+
+def touch_jobs(job_ids):
+    """Increments version of the jobs data
+
+    Called on every change of the jobs, questions, codes, verbatims and
+    variables, invalidates cached responses (see data_app.cache), job
+    indexes and cubes. The counter is incremented by the database, so
+    it doesn't depend on clocks of web and worker hosts.
+    """
+    Job.objects.filter(pk__in=[pk for pk in job_ids if pk is not None]).update(
+        version=F('version') + 1, updated_at=timezone.now())
+
+
+def job_field(model):
+    """Field of the model referring to its job
+    """
+    return 'parent' if model is Question else 'job'
+
+
+def recount_jobs(job_ids):
+    """Rebuilds CodeCount of the jobs and moves their versions, once
+    after any number of their rows are deleted
+    """
+    for job in Job.objects.filter(pk__in=job_ids):
+        CodeCount.objects.rebuild(job)
+    touch_jobs(job_ids)
+
+
+def delete_job_rows(queryset):
+    """Deletes questions, codebooks, codes, verbatims or variables and
+    brings counts and versions of their jobs up to date once
+
+    Delete signals aren't used: they would make Django load every row
+    deleted by cascade, e.g. all verbatims of a deleted job. A single
+    verbatim or variable takes its verbatims out of their CodeCount
+    buckets, any other deletion rebuilds counts of the jobs.
+
+    Arguments:
+    ----------
+        queryset: QuerySet
+            rows of one of the models above
+    """
+    model = queryset.model
+    job_ids = set(queryset.values_list(job_field(model), flat=True))
+    pks = list(queryset.values_list('pk', flat=True)[:2])
+    if len(pks) != 1:
+        queryset.delete()
+        recount_jobs(job_ids)
+        return
+    groups = None
+    if model in (Verbatim, Variable):
+        lookup = 'pk' if model is Verbatim else 'variable'
+        groups = list(Verbatim.objects.filter(**{lookup: pks[0]}).order_by()
+                      .values_list('job', 'question', 'parent', *DIMENSIONS).annotate(Count('id')))
+    model.objects.get(pk=pks[0]).delete()  # MPTT closes the gap of the node
+    if groups is None:
+        recount_jobs(job_ids)
+        return
+    for row in groups:
+        CodeCount.objects.adjust(row[0], row[1], row[2], dict(zip(DIMENSIONS, row[3:-1])), -row[-1])
+    touch_jobs(job_ids)
+
+
 class Question(MPTTModel, helpers.TimeMixin):
     name = models.CharField(max_length=255, blank=True)
     text = models.TextField(blank=True)
@@ -63,6 +189,11 @@ class Question(MPTTModel, helpers.TimeMixin):
                             related_name='children_questions')
     code_book = models.ForeignKey('CodeBook', null=True, blank=True)  # key for root code
 
+    class Meta:
+        index_together = (
+            ('parent', 'name'),  # questions of the job by sheet column
+        )
+
     def __str__(self):
         return '{}({})'.format(self.title, self.kind)
 
@@ -89,6 +220,15 @@ class Code(MPTTModel, helpers.TimeMixin):
     overcode = models.BooleanField()
     verbatim_count = 0
 
+    objects = RootTreeManager()
+
+    class Meta:
+        index_together = (
+            ('code_book', 'overcode'),
+            ('job', 'code_book', 'code'),
+            ('code_book', 'tree_id', 'lft'),  # see aggregation.code_tree
+        )
+
     def __str__(self):
         return '{}'.format(self.title)
 
@@ -100,6 +240,23 @@ class Verbatim(MPTTModel, helpers.TimeMixin):
     parent = TreeForeignKey('Code', null=True, blank=True,
                             related_name='children_verbatims')
     job = models.ForeignKey('Job')
+    # copies of DIMENSIONS of the variable to filter without join,
+    # kept in sync by data_app.signals
+    sex = models.IntegerField(blank=True, null=True, editable=False)
+    age_bands = models.IntegerField(blank=True, null=True, editable=False)
+    reg_quota = models.IntegerField(blank=True, null=True, editable=False)
+    csp_quota = models.IntegerField(blank=True, null=True, editable=False)
+
+    class Meta:
+        index_together = (
+            ('parent', 'question', 'variable'),  # verbatims of the code, filtered
+            ('question', 'variable'),  # see aggregation.verbatim_counts
+            # DIMENSIONS filters of aggregation.filtered_verbatims
+            ('question', 'sex'),
+            ('question', 'age_bands'),
+            ('question', 'reg_quota'),
+            ('question', 'csp_quota'),
+        )
 
     def __str__(self):
         return '{}'.format(self.verbatim)
@@ -114,6 +271,9 @@ class Variable(helpers.TimeMixin):
     main_cell_text = models.CharField(max_length=255, blank=True, null=True)
     job = models.ForeignKey('Job')
 
+    def dimensions(self):
+        return {d: getattr(self, d) for d in DIMENSIONS}
+
     def __str__(self):
         return '[{}][{}][{}][{}][{}][{}]'.format(self.uid,
                                                  self.sex,
@@ -123,25 +283,243 @@ class Variable(helpers.TimeMixin):
                                                  self.main_cell_text)
 
 
+def copy_dimensions(job):
+    """Copies DIMENSIONS of variables of the job to their verbatims
+
+    One UPDATE per distinct combination of values, so the number of
+    queries doesn't depend on the number of verbatims.
+
+    Returns:
+    --------
+        number of updated verbatims
+    """
+    updated = 0
+    variables = Variable.objects.filter(job=job)
+    for values in variables.order_by().values_list(*DIMENSIONS).distinct():
+        dimensions = dict(zip(DIMENSIONS, values))
+        updated += (Verbatim.objects
+                    .filter(job=job, variable__in=variables.filter(**dimensions))
+                    .update(**dimensions))
+    return updated
+
+
+class CodeCountManager(models.Manager):
+
+    def rebuild(self, job):
+        """Recomputes counts of all verbatims of the job
+        """
+        self.filter(job=job).delete()
+        rows = (Verbatim.objects
+                .filter(job=job, question__isnull=False, parent__isnull=False)
+                .order_by()
+                .values_list('question', 'parent', *DIMENSIONS)
+                .annotate(Count('id')))
+        counts = [self.model(job=job, question_id=row[0], code_id=row[1], count=row[-1],
+                             **dict(zip(DIMENSIONS, row[2:-1])))
+                  for row in rows]
+        return bulk.bulk_save(self.model, counts)
+
+    def adjust(self, job_id, question_id, code_id, dimensions, delta):
+        """Adds delta to the count of single bucket
+
+        Arguments:
+        ----------
+            dimensions: dict
+                {Variable field: value} for each of DIMENSIONS
+            delta: int
+                number of added (positive) or removed (negative) verbatims
+        """
+        if question_id is None or code_id is None or delta == 0:
+            return
+        bucket = self.filter(question_id=question_id, code_id=code_id, **dimensions)
+        if bucket.update(count=F('count') + delta) == 0 and delta > 0:
+            self.create(job_id=job_id, question_id=question_id, code_id=code_id,
+                        count=delta, **dimensions)
+        bucket.filter(count__lte=0).delete()
+
+
+class CodeCount(models.Model):
+    """Materialized number of verbatims of the question per code and
+    demographic bucket (combination of Variable DIMENSIONS values)
+
+    Filled at the end of import and kept in sync with edits of Verbatim
+    and Variable by data_app.signals. Filtered counts of the code are
+    sums over matching buckets.
+    """
+    job = models.ForeignKey('Job')
+    question = models.ForeignKey('Question')
+    code = models.ForeignKey('Code')
+    sex = models.IntegerField(blank=True, null=True)
+    age_bands = models.IntegerField(blank=True, null=True)
+    reg_quota = models.IntegerField(blank=True, null=True)
+    csp_quota = models.IntegerField(blank=True, null=True)
+    count = models.IntegerField(default=0)
+
+    objects = CodeCountManager()
+
+    class Meta:
+        index_together = (
+            ('question', 'code'),
+        )
+
+    def __str__(self):
+        return '{}:{}[{}]={}'.format(self.question_id, self.code_id,
+                                     ','.join(str(getattr(self, d)) for d in DIMENSIONS),
+                                     self.count)
+
+
+class QuestionCubeManager(models.Manager):
+    # decoded cubes by (question id, version), see CUBE_CACHE_SIZE setting
+    decoded = LRUCache(getattr(settings, 'CUBE_CACHE_SIZE', 256))
+
+    def build(self, questions):
+        """Builds and stores cubes of the questions from CodeCount buckets
+
+        Cubes of all questions are built from one query; a cube stored
+        concurrently by another process is left as is.
+
+        Returns:
+        --------
+            dict {question id: QuestionCube}
+        """
+        questions = list(questions)
+        versions = dict(Job.objects.filter(pk__in=set(q.parent_id for q in questions))
+                        .values_list('id', 'version'))
+        buckets = defaultdict(list)
+        rows = (CodeCount.objects.filter(question__in=[q.id for q in questions])
+                .order_by().values_list('question', 'code', *(DIMENSIONS + ('count',))))
+        for row in rows:
+            buckets[row[0]].append(row[1:])
+        cubes = dict()
+        for question in questions:
+            cube = Cube.from_buckets(buckets[question.id], len(DIMENSIONS))
+            header, data = cube.encode()
+            cubes[question.id] = self.model(job_id=question.parent_id, question_id=question.id,
+                                            version=versions[question.parent_id],
+                                            header=header, data=data)
+            cubes[question.id]._cube = cube
+        try:
+            with transaction.atomic():
+                self.filter(question__in=cubes.keys()).delete()
+                self.bulk_create(cubes.values())
+        except IntegrityError:
+            pass
+        return cubes
+
+    def rebuild(self, job):
+        """Rebuilds cubes of all questions of the job
+        """
+        return self.build(Question.objects.filter(parent=job)).values()
+
+    def counts(self, specs):
+        """Number of verbatims per code for (question, filters) specs
+        filtered by DIMENSIONS only
+
+        Versions are checked with a query of stored cubes without their
+        data, which is only fetched for cubes not decoded by this process
+        yet. Cubes built before the last change of their job are rebuilt.
+
+        Arguments:
+        ----------
+            specs: list of (Question, dict{String:int})
+        Returns:
+        --------
+            list of dicts {code id: verbatim count} in the order of specs
+        """
+        questions = {question.id: question for question, filters in specs}
+        versions = (self.filter(question__in=questions.keys())
+                    .values_list('question_id', 'id', 'version', 'job__version'))
+        cubes = dict()
+        load = dict()
+        for question_id, pk, version, job_version in versions:
+            if version != job_version:
+                continue
+            cube = self.decoded.get((question_id, version))
+            if cube is None:
+                load[pk] = version
+            else:
+                cubes[question_id] = cube
+        for stored in self.filter(pk__in=load.keys()):
+            cubes[stored.question_id] = stored.cube()
+            self.decoded.set((stored.question_id, stored.version), stored.cube())
+        stale = [q for q_id, q in questions.iteritems() if q_id not in cubes]
+        if stale:
+            for question_id, stored in self.build(stale).iteritems():
+                cubes[question_id] = stored.cube()
+                self.decoded.set((question_id, stored.version), stored.cube())
+        return [cubes[question.id].counts([filters.get(d) for d in DIMENSIONS])
+                for question, filters in specs]
+
+
+class QuestionCube(models.Model):
+    """Verbatim counts of the question per code and every combination
+    of DIMENSIONS values, "all" rollups included (see data_app.cubes.Cube)
+
+    Built from CodeCount at the end of import; after any change of the
+    job data the cube is stale and rebuilt on the next read.
+    """
+    job = models.ForeignKey('Job')
+    question = models.OneToOneField('Question', related_name='cube')
+    version = models.PositiveIntegerField()  # version of the job the cube is built at
+    header = models.TextField()
+    data = models.BinaryField()
+
+    objects = QuestionCubeManager()
+
+    def cube(self):
+        if not hasattr(self, '_cube'):
+            self._cube = Cube.decode(self.header, self.data)
+        return self._cube
+
+    def __str__(self):
+        return '{}'.format(self.question_id)
+
+
 class UploadFile(helpers.TimeMixin):
     """Upload and process template file.
 
     Parses and uploads data from .xls spreadsheets to the existing databases
-    Each file represents single job
+    Each file represents single job. Rows of every sheet are built in memory
+    and written with batched INSERTs (see data_app.bulk), MPTT fields are
+    computed once per sheet instead of per inserted node.
 
     Attributes:
     -----------
         job : Job
-            temporary attribute. Represents job entity while input's processing
+            job the sheet is imported into
+        job_version : int
+            version of the job after the import; the job wasn't edited
+            since while they are equal
+        fingerprint : str
+            SHA-256 of the file and PARSER_VERSION; an upload identical to
+            the last import of the job doesn't import anything
+        sheet_hashes : str
+            JSON {sheet name: SHA-256 of parsed cells}
+        changed_sheets : str
+            JSON list of sheets that differ from the previous import of
+            the job, all sheets of the first import
+        sync : RowSync
+            temporary attribute. Gives ids to parsed rows and writes them
         code_books_entities : dict
             dict {code_book_name : code_book_entity}, contains codebooks, available
             in current file
+        stats : str
+            JSON {stage: {rows_parsed, rows_written, elapsed, cpu, queries, finished}}
+            of the last import, see data_app.progress.Progress
     """
 
-    # TODO: improve performace, bulk DB write
-
     sheet = models.FileField(storage=OverwriteStorage(),
                              upload_to=lambda i, x: x)
+    incremental = models.BooleanField(default=False,
+                                      help_text='update the job with the same number and name '
+                                                'instead of creating new one')
+    stats = models.TextField(blank=True, editable=False)
+    job = models.ForeignKey('Job', blank=True, null=True, editable=False, on_delete=models.SET_NULL)
+    job_version = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    fingerprint = models.CharField(max_length=64, blank=True, editable=False, db_index=True)
+    parser_version = models.IntegerField(blank=True, null=True, editable=False)
+    sheet_hashes = models.TextField(blank=True, editable=False)
+    changed_sheets = models.TextField(blank=True, editable=False)
 
     def __str__(self):
         return '{}'.format(os.path.basename(self.sheet.name))
@@ -153,79 +531,44 @@ class UploadFile(helpers.TimeMixin):
         ----------
             excel_file: ExcelFile
                 input .xls file, that contains data about questions
+        Returns:
+        --------
+            list of saved questions
         """
-        start = time.clock()
         question_df = excel_file.parse('question')
-        question_df = question_df.where(pd.notnull(question_df), None)
-        q_to_save = list()
-        try:
-            q_id = Question.objects.latest('id').id + 1
-        except:
-            q_id = 0
-
-        questions_in_df = dict()
-
-        questions_names = list()
-        questions_kinds = list()
-        questions_codebooks = list()
-
-        for question in question_df.iterrows():
-            qq = question[1]
-            if qq.code_book not in questions_codebooks:
-                questions_codebooks.append(qq.code_book)
-            questions_names.append(qq.id)
-            questions_kinds.append(qq.type)
-            q = {
-                'id': q_id,
-                'name': qq.id,
-                'kind': qq.type,
-                'parent': self.job,
-                'text_en': qq.text,
-                'title_en': qq.title
-            }
-            for key in qq.keys():
-                if key.count('text_') or key.count('title_'):
-                    q[key] = qq[key]
-
-            q_id += 1
-
-            questions_in_df[(qq.id, qq.type, self.job, qq.code_book)] = q
-
-        # TODO: MAKE INDEX
-        existing_codebooks = {cb.name: cb for cb in CodeBook.objects
-                                .filter(name__in=questions_codebooks)}
-
-        # TODO: OPTIMIZE QUERY
-        existing_questions = {(q.name, q.kind, q.parent, q.code_book): q
-                              for q in Question.objects.filter(
-            name__in=questions_names,
-            parent=self.job,
-            kind__in=questions_kinds,
-            code_book__in=existing_codebooks.values()
-        )}
-
-        for key, q in questions_in_df.iteritems():
-            if key[3] in existing_codebooks.keys():
-                cb = existing_codebooks[key[3]]
+        self.report(parsed=len(question_df))
+        code_books = dict(self.code_books_entities)
+        new_code_books = list()  # referred without cb_* sheet
+        questions_in_df = OrderedDict()
+
+        for qq in df_records(question_df):
+            if qq['code_book'] is None:
+                cb = None
+            elif qq['code_book'] in code_books:
+                cb = code_books[qq['code_book']]
             else:
-                cb = CodeBook.objects.create(job=self.job, name=key.code_book)
-                existing_codebooks[cb.name] = cb
-
-            key = (key[0], key[1], key[2], cb)
+                cb = CodeBook(id=self.sync.new_id(CodeBook, qq['code_book']),
+                              job=self.job, name=qq['code_book'])
+                code_books[cb.name] = cb
+                new_code_books.append(cb)
+
+            q = Question(
+                id=self.sync.new_id(Question, (qq['id'], qq['type'], cb.name if cb else None)),
+                name=qq['id'],
+                kind=qq['type'],
+                parent=self.job,
+                code_book=cb,
+                text_en=qq['text'],
+                title_en=qq['title'],
+                **translations(qq)
+            )
 
-            if key in existing_questions.keys():
-                question = existing_questions[key]
-            else:
-                question = Question()
+            questions_in_df[(qq['id'], qq['type'], cb)] = q
 
-            for attribute, value in q.iteritems():
-                setattr(question, attribute, value)
-            question.code_book = cb
-            q_to_save.append(question)
-        # TODO: USE BULK CRAEATE AND Q_ID
-        for q in q_to_save:
-            q.save()
-        return q_to_save
+        self.sync.save(CodeBook, new_code_books)
+        questions = questions_in_df.values()
+        self.report(written=self.sync.save(Question, questions, number=bulk.number_leaves))
+        return questions
 
     def parse_variables(self, excel_file):
         """Method that parses variables from spreadsheet
@@ -234,289 +577,286 @@ class UploadFile(helpers.TimeMixin):
         ----------
             excel_file: ExcelFile
                 input .xls file, that contains data about variables
+        Returns:
+        --------
+            list of saved variables
         """
 
-        start = time.clock()
         variable_df = excel_file.parse('variables')
-        variable_df = variable_df.where(pd.notnull(variable_df), None)
-        variable_records = set()
-
-        try:
-            v_id = Variable.objects.latest('id').id + 1
-        except:
-            v_id = 0
-
-        for vverbatim in variable_df.iterrows():
-            verbat = vverbatim[1]
-            v = Variable(
-                id=v_id,
-                uid=verbat[0],
-                sex=verbat[1],
-                age_bands=verbat[2],
-                reg_quota=verbat[3],
-                csp_quota=verbat[4],
-                main_cell_text=verbat[5],
+        self.report(parsed=len(variable_df))
+
+        # columns by position: uid, sex, age_bands, reg_quota, csp_quota, main_cell_text
+        variable_df = variable_df.iloc[:, :6]
+        rows = variable_df.astype(object).where(pd.notnull(variable_df), None).values.tolist()
+        variable_records = [
+            Variable(
+                id=self.sync.new_id(Variable, uid),
+                uid=uid,
+                sex=sex,
+                age_bands=age_bands,
+                reg_quota=reg_quota,
+                csp_quota=csp_quota,
+                main_cell_text=main_cell_text,
                 job=self.job
             )
-            variable_records.add(v)
-
-            v_id += 1
+            for uid, sex, age_bands, reg_quota, csp_quota, main_cell_text in rows]
 
-        # TODO: BULK CREATE
-        for v in variable_records:
-            v.save()
+        self.report(written=self.sync.save(Variable, variable_records))
         return variable_records
 
+    def make_code(self, code_id, row, code_book, num_code, parent, overcode):
+        """Builds unsaved Code from the row of codebook sheet
+
+        Arguments:
+        ----------
+            code_id: int
+                primary key of new code
+            row: dict
+                row of cb_* sheet with text, title and translations
+            code_book: CodeBook
+            num_code: int
+                number of the code inside of the codebook
+            parent: Code
+                parent node or None for root
+            overcode: bool
+        """
+        return Code(
+            id=code_id,
+            text=row['text'],
+            title=row['title'],
+            code=num_code,
+            parent=parent,
+            code_book=code_book,
+            job=self.job,
+            overcode=overcode,
+            text_en=row['text'],
+            title_en=row['title'],
+            **translations(row)
+        )
+
     def parse_codes(self, excel_file, code_books):
         """Method that parses codes from spreadsheet
 
+        NET rows without Sub net are overcodes (roots), NET rows with
+        Sub net are subnets of the NET overcode, rows with Codes are
+        leaves of the Sub net if given, of the NET overcode otherwise.
+        The whole hierarchy of all codebooks is numbered and written at once.
+
         Arguments:
         ----------
             excel_file: ExcelFile
                 input .xls file, that contains data about codes
+            code_books: dict
+                {code_book_name: DataFrame} of cb_* sheets
+        Returns:
+        --------
+            list of saved codes
         """
+        codes = list()
 
-        start = time.clock()
-        for key, cb in self.code_books_entities.iteritems():
-            referenced_overcodes = list()
-            overcodes_dict = dict()
-            subnets_dict = dict()
-
-            codes_codebooks = list()
+        def new_id(path, overcode):
+            return self.sync.new_id(Code, (code_book.name, path, overcode))
 
-            try:
-                code_book = cb
-            except Exception as e:
-                print key, self.job
-                raise e
+        for key, code_book in self.code_books_entities.iteritems():
             _cb = code_books[key]
-            _cb = _cb.where(pd.notnull(_cb), None)
-            ocb = _cb[pd.isnull(_cb.Codes)]  # overcodes
+            self.report(parsed=len(_cb))
+            ocb = _cb[pd.isnull(_cb.Codes)]  # overcodes and subnets
             cb = _cb[pd.notnull(_cb.Codes)]
 
-            # parsing overcodes and subnets here
-            for oocode in ocb.iterrows():
-                code = oocode[1]
-                if code['Sub net'] is not None:
-                    num_code = int(code['Sub net'])
-                    parent_code = code.NET
-                    overcode_flag = False
-                    referenced_overcodes.append(parent_code)
-                else:
-                    num_code = code.NET
-                    parent_code = None
-                    overcode_flag = True
-
-                codes_codebooks.append(code_book)
-                ccode = {
-                    'text': code.text,
-                    'title': code.title,
-                    'code': num_code,
-                    'parent': parent_code,
-                    'code_book': code_book,
-                    'job': self.job,
-                    'overcode': overcode_flag,
-                    'text_en': code.text,
-                    'title_en': code.title
-                }
-                for ckey in code.keys():
-                    if ckey.count('text_') > 0 or ckey.count('title_') > 0:
-                        ccode[ckey] = code[ckey]
-                # oc.save()
-                if overcode_flag:
-                    overcodes_dict[ccode['code']] = ccode
-                else:
-                    subnets_dict[ccode['code']] = ccode
-                    # TODO: OPTIMIZE QUERY
-
-            existing_overcodes = {code.code:
-                                code for code in Code.objects.filter(code__in=overcodes_dict.keys()+referenced_overcodes,
-                                                                     code_book=code_book,
-                                                                     job=self.job)}
-            existing_subnets = {code.code:
-                                code for code in Code.objects.filter(code__in=subnets_dict.keys(), code_book=code_book,
-                                                                     job=self.job)}
-
-            for k, value in overcodes_dict.iteritems():
-
-                try:
-                    code = existing_overcodes[k]
-                except:
-                    code = Code()
-                for arg, val in value.iteritems():
-                    setattr(code, arg, val)
-                code.save()
-                existing_overcodes[k] = code
-
-            for k, value in subnets_dict.iteritems():
-
-                try:
-                    code = existing_overcodes[k]
-                except:
-                    code = Code()
-                for arg, val in value.iteritems():
-                    if arg == 'parent' and val is not None:
-                        code.parent = existing_overcodes[val]
-                    else:
-                        setattr(code, arg, val)
-                code.save()
-                existing_subnets[k] = code
-
-            related_codes = dict()
-            related_num_codes = list()
-            parent_codes = list()
-
-            for ccode in cb.iterrows():
-                print(ccode)
-                if len(ccode) > 3:
-                    code = ccode[2] if ccode[2] is not None else ccode[1]
-                else:
-                    code = ccode[1]
-                #print("lol", code['Sub net'])
+            overcodes_dict = dict()
+            subnets_dict = dict()
+
+            # overcodes go first, so subnets can refer to them in any row order
+            # natural key of the code is the codebook and numbers of the code and its ancestors
+            paths = dict()
+            for code in df_records(ocb[pd.isnull(ocb['Sub net'])]):
+                num_code = int(code['NET'])
+                paths[num_code] = (num_code,)
+                oc = self.make_code(new_id(paths[num_code], True), code, code_book, num_code, None, True)
+                overcodes_dict[num_code] = oc
+                codes.append(oc)
+
+            sub_paths = dict()
+            for code in df_records(ocb[pd.notnull(ocb['Sub net'])]):
+                num_code = int(code['Sub net'])
+                parent = overcodes_dict[int(code['NET'])]
+                sub_paths[num_code] = paths[int(code['NET'])] + (num_code,)
+                sn = self.make_code(new_id(sub_paths[num_code], False), code, code_book, num_code, parent, False)
+                subnets_dict[num_code] = sn
+                codes.append(sn)
+
+            for code in df_records(cb):
+                num_code = int(code['Codes'])
                 if code['Sub net'] is not None:
-                    parent_code = int(code['Sub net'])
-                else:
-                    parent_code = code.NET
-                #print(parent_code)
-                if parent_code not in existing_overcodes.keys()+existing_subnets.keys():
-                    parent_codes.append(parent_code)
-
-                related_num_codes.append(code.Codes)
-                c = {
-                    'text': code.text,
-                    'title': code.title,
-                    'code': code.Codes,
-                    'job': self.job,
-                    'overcode': False,
-                    'parent': parent_code,
-                    'code_book': code_book,
-                    'text_en': code.text,
-                    'title_en': code.title
-                }
-
-                for ckey in code.keys():
-                    if ckey.count('text_') > 0 or ckey.count('title_') > 0:
-                        c[ckey] = code[ckey]
-
-                related_codes[c['code']] = c
-
-            existing_parents = {code.code: code for code in Code.objects.filter(code__in=parent_codes,
-                                                                                job=self.job,
-                                                                                code_book=code_book,
-                                                                                )}
-            for key, value in existing_overcodes.iteritems():
-                existing_parents[key] = value
-            for key, value in existing_subnets.iteritems():
-                existing_parents[key] = value
-
-            existing_related_codes = {code.code: code
-                                for code in Code.objects.filter(code__in=related_num_codes,
-                                                                job=self.job,
-                                                                code_book=code_book,
-                                                                parent__in=existing_parents,)}
-
-            #import ipdb; ipdb.set_trace()
-
-            for key, value in related_codes.iteritems():
-                print(key, value['parent'], value)
-                if value['parent'] is not None:
-                    value['parent'] = existing_parents[value['parent']]
-
-                if key in existing_related_codes.keys():
-                    code = existing_related_codes[key]
+                    parent = subnets_dict[int(code['Sub net'])]
+                    path = sub_paths[int(code['Sub net'])] + (num_code,)
+                elif code['NET'] is not None:
+                    parent = overcodes_dict[int(code['NET'])]
+                    path = paths[int(code['NET'])] + (num_code,)
                 else:
-                    code = Code()
-
-                for arg, val in value.iteritems():
-                    setattr(code, arg, val)
-
-                code.save()
+                    parent = None
+                    path = (num_code,)
+                c = self.make_code(new_id(path, False), code, code_book, num_code, parent, False)
+                codes.append(c)
 
+        written = self.sync.save(Code, codes, number=self.sync.ids.number_tree)
+        self.report(written=written)
+        return codes
 
+    @staticmethod
+    def is_data_sheet(name):
+        return name in DATA_SHEETS or re.match(cb_regex, name, re.IGNORECASE) is not None
 
     def parse_code_books(self, excel_file):
         code_books_names = filter(lambda x: re.match(cb_regex, x, re.IGNORECASE) is not None, excel_file.sheet_names)
         code_books = {name: excel_file.parse(name) for name in code_books_names}
-        return {name: CodeBook.objects.get_or_create(job=self.job, name=name)[0] for name in
-                code_books_names}, code_books
+        self.report(parsed=sum(len(cb) for cb in code_books.values()))
+        entities = OrderedDict()
+        for name in code_books_names:
+            entities[name] = CodeBook(id=self.sync.new_id(CodeBook, name), job=self.job, name=name)
+        self.report(written=self.sync.save(CodeBook, entities.values()))
+        return entities, code_books
 
     def parse_verbatims(self, excel_file):
         """Method that parses verbatims and adds it to database
 
-        Current parsing method ignores if input file contains verbatims
-        that refers to unexisting question and has unexisting codes
+        Current parsing method ignores verbatims without respondent or text,
+        references to unexisting variables or codes are reported by
+        validate before the import.
+        Columns of each question are reshaped from wide (one column per
+        assigned code) to long form, one row per verbatim, with empty
+        cells dropped by pandas. Verbatims are written question by question.
 
         Arguments:
         ----------
             excel_file: ExcelFile
                 input .xls file, that contains data about codes
+        Returns:
+        --------
+            number of written verbatims
         """
         verbatim_df = excel_file.parse('verbatims')
-        verbatim_df = verbatim_df.where(pd.notnull(verbatim_df), None)
+        self.report(parsed=len(verbatim_df))
 
         keys = verbatim_df.keys()
         var_id = keys[0]
-        q = set()
-        questions = {q.name: q for q in Question.objects.filter(parent=self.job)}
-        codes = {(code.code, code.code_book): code for code in Code.objects.filter(job=self.job)}
-        ver_to_save = list()
-
+        # rows of the job the workbook has, stale ones are deleted after all sheets
+        parsed = self.sync.keys
+        questions = {q.name: q for q in Question.objects.filter(parent=self.job) if q.pk in parsed[Question]}
+
+        # {code_book_id: {code number: code}}, leaf codes win over nets with the same number
+        codes = defaultdict(dict)
+        for code in Code.objects.filter(job=self.job):
+            if code.pk not in parsed[Code]:
+                continue
+            book = codes[code.code_book_id]
+            if code.code not in book or code.is_leaf_node():
+                book[code.code] = code
+
+        # columns of each question in the top row: text, codes, translations
+        q_columns = OrderedDict()
         for k in keys[1:]:
-            q.add(k.split('-')[0].rstrip())
-
-        vars = {var.uid: var for var in Variable.objects.filter(job=self.job)}
-        # for each question in the top row
-        for q_n in q:
-            start = time.clock()
-
-            # Respondents serial
-            var_keys = [var_id, ]
-            for vk in keys:
-                if vk.count(q_n) > 0:
-                    var_keys.append(vk)
-            vdf = verbatim_df[var_keys]
+            q_columns.setdefault(k.split('-')[0].rstrip(), list()).append(k)
+
+        vars = {var.uid: var for var in Variable.objects.filter(job=self.job) if var.pk in parsed[Variable]}
+        dimensions = {uid: var.dimensions() for uid, var in vars.iteritems()}
+        saved = 0
+        ordinals = defaultdict(int)  # of verbatims with the same natural key
+        for q_n, columns in q_columns.iteritems():
+
             question = questions[q_n]
+            book = codes[question.code_book_id]
+            text_key = columns[0]
+            lang_keys = [k for k in columns[1:] if k.count('text_') > 0]
+            code_keys = [k for k in columns[1:] if k not in lang_keys]
+
+            vdf = verbatim_df[pd.notnull(verbatim_df[var_id]) & pd.notnull(verbatim_df[text_key])]
+            # long form in row order: (row label, code column) -> code number
+            assigned = vdf[code_keys].stack()
+            if assigned.empty:
+                continue
+            rows = assigned.index.get_level_values(0)
+            answers = vdf.loc[rows]
+
+            uids = answers[var_id].astype(np.int64).values
+            texts = answers[text_key].values
+            code_ids = assigned.astype(np.int64).values
+            lang_df = answers[lang_keys].astype(object).where(pd.notnull(answers[lang_keys]), None)
+            langs = [('verbatim_' + lkey.split('_')[-1], lang_df[lkey].tolist()) for lkey in lang_keys]
+
+            natural_keys = list()
+            for uid, code_id in zip(uids, code_ids):
+                key = (vars[uid].pk, question.pk, book[code_id].pk)
+                natural_keys.append(key + (ordinals[key],))
+                ordinals[key] += 1
+
+            ver_to_save = [
+                Verbatim(
+                    id=self.sync.new_id(Verbatim, natural_keys[i]),
+                    job=self.job,
+                    variable=vars[uid],
+                    verbatim=text,
+                    verbatim_en=text,
+                    parent=book[code_id],
+                    question=question,
+                    **dict(dimensions[uid], **{field: values[i] for field, values in langs})
+                )
+                for i, (uid, text, code_id) in enumerate(zip(uids, texts, code_ids))]
+
+            written = self.sync.save(Verbatim, ver_to_save, number=bulk.number_leaves)
+            self.report(written=written)
+            saved += written
+        return saved
+
+    def report(self, parsed=0, written=0):
+        """Adds rows to the progress of the running import stage, if any
+        """
+        progress = getattr(self, 'progress', None)
+        if progress is not None:
+            progress.add(parsed=parsed, written=written)
 
-            '''
-            Is there any logic to create codes with no enough information about it?
-            Is there a reason to save an verbatim of unknovn variable?
-            '''
-            for vverbatim in vdf.iterrows():
-                verbat = vverbatim[1]
-                if verbat[0] is not None:
-                    var = vars[verbat[0]]
-                else:
-                    continue
-                text = verbat[1]
-                if text is None:
-                    continue  # TODO: dropna for df
-                for code_id in verbat[2:]:
-                    if code_id is None:
-                        continue
-                    code = codes[(code_id, question.code_book)]
-
-                    if code is None:
-                        continue
-
-                    v = Verbatim(
-                        job=self.job,
-                        variable=var,
-                        verbatim=text,
-                        parent=code,
-                        question=question
-                    )
-                    v.verbatim_en = text
-                    for ckey in verbat.keys():
-                        if ckey.count('text_') > 0:
-                            lang = ckey.split('_')[-1]
-                            setattr(v, 'verbatim_' + lang, verbat[ckey])
-                    v.save()
-
-
-    @transaction.atomic
-    # @silk_profile(name='Save File')
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
+        """Stores the sheet and imports it
+
+        With IMPORT_ASYNC setting the import is queued as ImportJob and
+        runs in the import_worker process, otherwise it runs right away.
+        """
+        super(UploadFile, self).save(force_insert=force_insert, force_update=force_update,
+                                     using=using, update_fields=update_fields)
+        if getattr(settings, 'IMPORT_ASYNC', False):
+            ImportJob.objects.create(upload=self)
+        else:
+            self.process()
+
+    # @silk_profile(name='Save File')
+    def process(self, progress=None):
+        """Parses the stored sheet into a Job
+
+        With incremental flag the job of the same number and name, if
+        any, is updated: parsed rows are matched with stored ones by
+        natural keys, only new, changed and missing rows are written
+        (see data_app.incremental). Changed code trees replace all rows
+        of the job. Otherwise a new job is created. The import is one
+        transaction holding data_app.locks.import_lock of the job.
+
+        A file with the fingerprint of the last import of the job does
+        nothing while the job isn't edited. Incremental import of a
+        changed file doesn't compare rows of the models whose sheets
+        (see MODEL_SHEETS) have the hashes of the previous import.
+
+        Sheets are validated before the transaction starts, a workbook
+        with broken references raises WorkbookInvalid with all errors.
+
+        Arguments:
+        ----------
+            progress: Progress
+                receives rows parsed and written by each stage
+        Returns:
+        --------
+            created or updated Job
+        """
+        self.progress = progress if progress is not None else Progress()
 
         file_name = self.sheet.path
         fname = self.sheet.path
@@ -527,22 +867,221 @@ class UploadFile(helpers.TimeMixin):
         job_number = file_name.split('_')[0]
         job_name = ' '.join(file_name.split('_')[1:])
 
-        job = Job.objects.get_or_create(name=os.path.basename(job_name), number=job_number)
-        if job[1]:  # exists
-            job[0].delete()
-        job = job[0]
+        with self.progress.stage('fingerprint'):
+            self.fingerprint = fingerprint.file_fingerprint(fname, PARSER_VERSION)
+            self.parser_version = PARSER_VERSION
+            previous = self.previous_import(job__number=job_number, job__name=job_name)
+        if previous is not None and previous.fingerprint == self.fingerprint \
+                and previous.job_version == previous.job.version:
+            # the same file as the last import of the unchanged job
+            self.job = previous.job
+            self.job_version = previous.job_version
+            self.sheet_hashes = previous.sheet_hashes
+            self.changed_sheets = json.dumps([])
+            self.save_stats()
+            return self.job
+
+        # sheets are decoded by IMPORT_PROCESSES processes while parsed ones are written
+        with SheetReader(fname, self.is_data_sheet) as f:
+            self.reader = f
+            # errors are found before the transaction and locks are taken
+            with self.progress.stage('validate'):
+                errors = self.validate(f)
+            if errors:
+                raise WorkbookInvalid(errors)
+
+            # the job is written by one import at a time, all imports are
+            # serialized where ids aren't taken from sequences
+            with import_lock(file_name):
+                job = None
+                if self.incremental:
+                    job = Job.objects.filter(name=job_name, number=job_number).order_by('-id').first()
+                    previous = self.previous_import(job=job) if job is not None else None
+                hashes = previous.get_sheet_hashes() if previous is not None else {}
+                # stored rows of an edited job may differ from the previous sheets
+                unchanged_job = previous is not None and previous.job_version == previous.job.version
+                self.previous_hashes = hashes if unchanged_job else None
+
+                if job is None:
+                    job = Job.objects.create(name=job_name, number=job_number)
+                    self.import_rows(f, RowSync(job))
+                else:
+                    try:
+                        with transaction.atomic():
+                            self.import_rows(f, RowSync(job, incremental=True,
+                                                        unchanged=self.unchanged_rows))
+                    except StructureChanged:
+                        self.clear_job(job)
+                        self.import_rows(f, RowSync(job))
+
+                if self.sync.changed:
+                    with self.progress.stage('count_verbatims'):
+                        self.report(written=len(CodeCount.objects.rebuild(job)))
+                    touch_jobs([job.pk])
+                    with self.progress.stage('build_cubes'):
+                        self.report(written=len(QuestionCube.objects.rebuild(job)))
+                self.job_version = Job.objects.filter(pk=job.pk).values_list('version', flat=True)[0]
+                self.sheet_hashes = json.dumps(f.hashes, sort_keys=True)
+                self.changed_sheets = json.dumps(fingerprint.changed_sheets(f.hashes, hashes))
+                self.save_stats()
+        return job
+
+    @staticmethod
+    def validate(excel_file):
+        """Errors the import of the workbook would fail on, see
+        data_app.validation.validate
+        """
+        code_book_names = [name for name in excel_file.sheet_names
+                           if re.match(cb_regex, name, re.IGNORECASE) is not None]
+        return validation.validate(excel_file, code_book_names)
+
+    @staticmethod
+    def validate_file(f):
+        """Errors of the workbook given by path or file object, e.g.
+        uploaded one before it's stored
+        """
+        try:
+            excel_file = pd.ExcelFile(f)
+        except xlrd.XLRDError as e:
+            return [validation.sheet_error(None, 'file is not a workbook: {}'.format(e))]
+        try:
+            return UploadFile.validate(excel_file)
+        finally:
+            excel_file.book.release_resources()
+            if hasattr(f, 'seek'):
+                f.seek(0)
+
+    @staticmethod
+    def check_sheet_names(f):
+        """Errors in the sheet names of the uploaded workbook, cheap
+        enough to be checked before it's stored
+
+        Cells of .xls sheets are not read (see data_app.sheets.open_book);
+        the rest of validate_file runs when the upload is imported.
+        """
+        try:
+            book = xlrd.open_workbook(file_contents=f.read(), on_demand=True)
+        except xlrd.XLRDError as e:
+            return [validation.sheet_error(None, 'file is not a workbook: {}'.format(e))]
+        finally:
+            f.seek(0)
+        try:
+            return validation.missing_sheets(book.sheet_names())
+        finally:
+            book.release_resources()
 
-        super(UploadFile, self).save(force_insert=force_insert, force_update=force_update,
-                                     using=using, update_fields=update_fields)
+    def previous_import(self, **filters):
+        """The last other upload imported into the job by the same parsers
+
+        Arguments:
+        ----------
+            filters: dict
+                of the job, e.g. job=job or job__number and job__name
+        Returns:
+        --------
+            UploadFile or None
+        """
+        return (UploadFile.objects
+                .filter(parser_version=PARSER_VERSION, job__isnull=False, **filters)
+                .exclude(pk=self.pk)
+                .select_related('job')
+                .order_by('-id')
+                .first())
+
+    def unchanged_rows(self, model):
+        """Whether sheets the model rows are parsed from have the hashes
+        of the previous import of the job, which wasn't edited since;
+        then rows of the model are not compared with stored ones
+        """
+        previous = self.previous_hashes
+        if previous is None:
+            return False
+        names = set()
+        for pattern in MODEL_SHEETS.get(model._meta.model_name, [None]):
+            if pattern is None:
+                return False
+            names.update(name for name in set(previous) | set(self.reader.hashes)
+                         if re.match(pattern, name, re.IGNORECASE))
+        return all(self.reader.hashes.get(name) == previous.get(name) for name in names)
+
+    def import_rows(self, excel_file, sync):
+        """Writes rows of all sheets to the job of sync
+        """
+        self.job = sync.job
+        self.sync = sync
+        with self.progress.stage('parse_code_books'):
+            self.code_books_entities, code_books = self.parse_code_books(excel_file)
+        with self.progress.stage('parse_questions'):
+            self.parse_questions(excel_file)
+        with self.progress.stage('parse_variables'):
+            self.parse_variables(excel_file)
+        with self.progress.stage('parse_codes'):
+            self.parse_codes(excel_file, code_books)
+        with self.progress.stage('parse_verbatims'):
+            self.parse_verbatims(excel_file)
+        if sync.incremental:
+            with self.progress.stage('delete_missing'):
+                sync.delete_missing([Verbatim, Question, Code, Variable, CodeBook])
+                self.report(written=sync.deleted)
+
+    def clear_job(self, job):
+        """Deletes all rows of the job, keeping the job itself
+        """
+        for model in (QuestionCube, CodeCount, Verbatim, Code, Variable, CodeBook):
+            model.objects.filter(job=job).delete()
+        Question.objects.filter(parent=job).delete()
+
+    def save_stats(self):
+        """Stores stage counters, job and fingerprints of the import on the record
+        """
+        self.stats = json.dumps(self.progress.as_dict())
+        if self.pk is not None:
+            UploadFile.objects.filter(pk=self.pk).update(
+                stats=self.stats, job=self.job, job_version=self.job_version,
+                fingerprint=self.fingerprint, parser_version=self.parser_version,
+                sheet_hashes=self.sheet_hashes, changed_sheets=self.changed_sheets)
+
+    def get_sheet_hashes(self):
+        return json.loads(self.sheet_hashes) if self.sheet_hashes else {}
 
-        f = pd.ExcelFile(fname)
+    def get_changed_sheets(self):
+        return json.loads(self.changed_sheets) if self.changed_sheets else []
 
-        job = Job.objects.create(name=job_name, number=job_number)
+    def get_stats(self):
+        """Stage counters of the last import, empty before it finished
+        """
+        return json.loads(self.stats, object_pairs_hook=OrderedDict) if self.stats else {}
 
-        self.job = job
-        self.code_books_entities, code_books = self.parse_code_books(f)
-        self.parse_questions(f)
-        self.parse_variables(f)
-        self.parse_codes(f, code_books)
-        self.parse_verbatims(f)
 
+class ImportJob(helpers.TimeMixin):
+    """Queued import of UploadFile, executed by import_worker command
+
+    Attributes:
+    -----------
+        progress : str
+            JSON {stage: {rows_parsed, rows_written, elapsed, finished}},
+            updated by the worker while the import runs
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    upload = models.ForeignKey('UploadFile', related_name='import_jobs')
+    job = models.ForeignKey('Job', blank=True, null=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=16, choices=STATUSES, default=PENDING)
+    stage = models.CharField(max_length=64, blank=True)
+    progress = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=255, blank=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '{}[{}]'.format(self.upload, self.status)
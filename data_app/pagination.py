@@ -0,0 +1,26 @@
+__author__ = 'yarnaid'
+
+from rest_framework.pagination import CursorPagination
+from rest_framework.pagination import _positive_int
+
+
+class IdCursorPagination(CursorPagination):
+    ''' Cursor paging by primary key for large collections
+
+    Page is fetched by 'WHERE id > last seen id', so the cost doesn't grow
+    with the page number and pages stay consistent while rows are added.
+    Response: {"next": url or null, "previous": url or null, "results": [...]}
+
+    PAGE_SIZE of REST_FRAMEWORK settings rows by default,
+    ?page_size= up to max_page_size
+    '''
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(request.query_params[self.page_size_query_param],
+                                 strict=True, cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
@@ -0,0 +1,152 @@
+__author__ = 'yarnaid'
+
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection as default_connection
+from django.db.backends.utils import CursorWrapper
+
+
+def cpu_time():
+    """User and system CPU time of the process, seconds
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class CountingCursor(CursorWrapper):
+
+    def __init__(self, cursor, db, counter):
+        super(CountingCursor, self).__init__(cursor, db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        self.counter.count += 1
+        return super(CountingCursor, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.count += 1
+        return super(CountingCursor, self).executemany(sql, param_list)
+
+
+class QueryCounter(object):
+    """Counts queries of cursors opened on the connection while active
+
+    Unlike CaptureQueriesContext the queries aren't stored, so it suits
+    imports of any size. Queries are still logged when logging is on
+    (DEBUG or CaptureQueriesContext around the counter).
+
+    Attributes:
+    -----------
+        count : int
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection or default_connection
+        self.count = 0
+
+    def __enter__(self):
+        connection = self.connection
+        logged = connection.queries_logged
+        make_debug_cursor = connection.make_debug_cursor
+
+        def make_cursor(cursor):
+            if logged:
+                cursor = make_debug_cursor(cursor)
+            return CountingCursor(cursor, connection, self)
+
+        self._forced = connection.force_debug_cursor
+        connection.make_debug_cursor = make_cursor
+        connection.force_debug_cursor = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        del self.connection.make_debug_cursor
+        self.connection.force_debug_cursor = self._forced
+
+
+class Progress(object):
+    """Counters of the running import, stage by stage
+
+    Thread safe: the import runs in one thread while another one
+    reads the counters to report them.
+
+    Attributes:
+    -----------
+        current : str
+            name of the running stage or None
+        connection : DatabaseWrapper
+            connection whose queries are counted, default one if None
+    """
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.current = None
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that measures the stage wrapped into it:
+        wall and CPU time, rows and queries of the connection
+        """
+        counter = QueryCounter(self.connection)
+        with self._lock:
+            self.current = name
+            self._stages[name] = {
+                'rows_parsed': 0,
+                'rows_written': 0,
+                'started': time.time(),
+                'cpu_started': cpu_time(),
+                'elapsed': None,
+                'cpu': None,
+                'counter': counter,
+            }
+        try:
+            with counter:
+                yield self
+        finally:
+            with self._lock:
+                stage = self._stages[name]
+                stage['elapsed'] = time.time() - stage['started']
+                stage['cpu'] = cpu_time() - stage['cpu_started']
+                self.current = None
+
+    def add(self, parsed=0, written=0):
+        """Adds rows to the counters of the current stage
+        """
+        with self._lock:
+            if self.current is None:
+                return
+            stage = self._stages[self.current]
+            stage['rows_parsed'] += parsed
+            stage['rows_written'] += written
+
+    def as_dict(self):
+        """JSON-like snapshot of all stages, times of the running
+        stage are counted up to now
+        """
+        now = time.time()
+        cpu_now = cpu_time()
+        with self._lock:
+            result = OrderedDict()
+            for name, stage in self._stages.iteritems():
+                elapsed = stage['elapsed']
+                if elapsed is None:
+                    elapsed = now - stage['started']
+                cpu = stage['cpu']
+                if cpu is None:
+                    cpu = cpu_now - stage['cpu_started']
+                result[name] = {
+                    'rows_parsed': stage['rows_parsed'],
+                    'rows_written': stage['rows_written'],
+                    'elapsed': round(elapsed, 3),
+                    'cpu': round(cpu, 3),
+                    'queries': stage['counter'].count,
+                    'finished': stage['elapsed'] is not None,
+                }
+            return result
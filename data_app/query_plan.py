@@ -0,0 +1,114 @@
+__author__ = 'yarnaid'
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+
+def plan(model, serializer, trim=True):
+    """Relations and columns read by the serializer from model instances
+
+    Forward relations rendered by nested serializers are joined with
+    select_related, reverse ones (many=True) are fetched with Prefetch
+    whose queryset is planned the same way, so the number of queries
+    depends on the serializer only, not on the number of rows.
+
+    Arguments:
+    ----------
+        model: Model
+            class of serialized instances
+        serializer: Serializer
+            instance, e.g. get_serializer() of the view, so fields
+            dropped by ?fields= are not fetched
+        trim: bool
+            fetch only columns rendered by the serializer
+    Returns:
+    --------
+        (set of only() names or None, list of select_related paths,
+         list of Prefetch)
+    """
+    opts = model._meta
+    only = {opts.pk.attname}
+    mptt_meta = getattr(model, '_mptt_meta', None)
+    if mptt_meta is not None:  # read by MPTTModel.__init__
+        only.add(opts.get_field(mptt_meta.parent_attr).attname)
+    select = list()
+    prefetch = list()
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+        name = field.source.split('.')[0]
+        try:
+            model_field = opts.get_field(name)
+        except FieldDoesNotExist:  # property or method, read anything
+            only = None
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            related = model_field.related_model
+            child_only, child_select, child_prefetch = plan(related, field.child, trim)
+            if not model_field.concrete:
+                # prefetched rows refer to the parent instance itself,
+                # what they render of it is fetched with the parent
+                back = model_field.field.name
+                prefix = back + '__'
+                select.extend(path[len(prefix):] for path in child_select if path.startswith(prefix))
+                child_select = [path for path in child_select
+                                if path != back and not path.startswith(prefix)]
+                if child_only is not None:
+                    if only is not None:
+                        only.update(f[len(prefix):] for f in child_only if f.startswith(prefix))
+                    child_only = set(f for f in child_only if f != back and not f.startswith(prefix))
+                    child_only.add(model_field.field.attname)  # to match rows to parents
+            queryset = apply(related._default_manager.all(), child_only, child_select, child_prefetch)
+            prefetch.append(Prefetch(name, queryset=queryset))
+        elif isinstance(field, serializers.BaseSerializer):
+            related = model_field.related_model
+            child_only, child_select, child_prefetch = plan(related, field, trim)
+            select.append(name)
+            select.extend('{}__{}'.format(name, path) for path in child_select)
+            prefetch.extend(Prefetch('{}__{}'.format(name, p.prefetch_through), queryset=p.queryset)
+                            for p in child_prefetch)
+            if only is not None:
+                only.add(name)
+                if child_only is None:
+                    only = None
+                else:
+                    only.update('{}__{}'.format(name, f) for f in child_only)
+        elif isinstance(field, serializers.ManyRelatedField) or not model_field.concrete:
+            prefetch.append(name)
+        elif only is not None:
+            only.add(model_field.attname if model_field.is_relation else name)
+    if not trim:
+        only = None
+    return only, select, prefetch
+
+
+def apply(queryset, only, select, prefetch):
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    if only is not None:
+        queryset = queryset.only(*only)
+    return queryset
+
+
+def optimize(queryset, serializer, trim=True):
+    """Queryset fetching everything the serializer renders in a fixed
+    number of queries, see plan
+    """
+    return apply(queryset, *plan(queryset.model, serializer, trim))
+
+
+class QueryPlanMixin(object):
+    """Viewset mixin planning the queryset by its serializer
+
+    Columns are trimmed for reading requests only: instances with
+    deferred fields are of a proxy class, so model signals (e.g. of
+    data_app.signals) wouldn't be sent on their save.
+    """
+
+    def get_queryset(self):
+        queryset = super(QueryPlanMixin, self).get_queryset()
+        trim = self.request is not None and self.request.method in ('GET', 'HEAD', 'OPTIONS')
+        return optimize(queryset, self.get_serializer(), trim=trim)
@@ -1,22 +1,43 @@
 __author__ = 'yarnaid'
 
-from data_app.models import Job, Question, Code, Variable, Verbatim, CodeBook
+import json
+
+from data_app.models import Job, Question, Code, Variable, Verbatim, CodeBook, ImportJob, UploadFile
 from rest_framework import serializers
 
 
+class SparseFieldsMixin(object):
+    """Restricts fields of the top level serializer to ?fields=a,b,c
+
+    Nested serializers render all their fields, unknown names are ignored.
+    """
+    fields_query_param = 'fields'
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        request = self._context.get('request')
+        if request is None:
+            return
+        requested = request.query_params.get(self.fields_query_param)
+        if requested:
+            allowed = set(name.strip() for name in requested.split(','))
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
 class RecursiveField(serializers.Serializer):
     def to_native(self, value):
         return self.parent.to_native(value)
 
 
-class JobSerializer(serializers.HyperlinkedModelSerializer):
+class JobSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Job
         fields = ('name', 'number', 'id', 'url')
 
 
-class VariableSerializer(serializers.HyperlinkedModelSerializer):
+class VariableSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Variable
@@ -39,7 +60,7 @@ class QuestionIdSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('id', 'name')
 
 
-class VerbatimSerialier(serializers.HyperlinkedModelSerializer):
+class VerbatimSerialier(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     parent = CodeIdSerializer()
     variable = VariableSerializer()
     question = QuestionIdSerializer()
@@ -75,7 +96,7 @@ class ShortCodeSerializer(serializers.HyperlinkedModelSerializer):
         filter_fields = ('overcode', )
 
 
-class CodeSerializer(serializers.HyperlinkedModelSerializer):
+class CodeSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     children_verbatims = VerbatimSerialier(many=True)
     job = JobSerializer()
     code_book = CodeBookIdSerializer()
@@ -93,7 +114,7 @@ class CodeSerializer(serializers.HyperlinkedModelSerializer):
         filter_fields = ('overcode', )
 
 
-class CodeBookSerializer(serializers.HyperlinkedModelSerializer):
+class CodeBookSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     job = JobSerializer()
     # children_codes = CodeSerializer()
 
@@ -112,20 +133,7 @@ class CodesSerializer(serializers.HyperlinkedModelSerializer):
         fields = ('id', 'children_codes', 'name')
 
 
-class QuestionSerializer(serializers.HyperlinkedModelSerializer):
-    parent = JobSerializer()
-    code_book = CodeBookSerializer()
-
-    class Meta:
-        model = Question
-        depth = 1
-        fields = (
-            'name', 'text', 'title', 'kind', 'parent', 'code_book', 'id',
-            'url')
-        filter_fields = ('parent', )
-
-class QuestionSerializer(serializers.HyperlinkedModelSerializer):
-    parent = JobSerializer()
+class QuestionSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     code_book = CodeBookSerializer()
 
     class Meta:
@@ -137,7 +145,7 @@ class QuestionSerializer(serializers.HyperlinkedModelSerializer):
         filter_fields = ('parent', )
 
 
-class VariableCodesSerializer(serializers.HyperlinkedModelSerializer):
+class VariableCodesSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     code_book = CodesSerializer()
 
     class Meta:
@@ -147,7 +155,7 @@ class VariableCodesSerializer(serializers.HyperlinkedModelSerializer):
         filter_fields = ('parent', )
 
 
-class ShortQuestionSerializer(serializers.HyperlinkedModelSerializer):
+class ShortQuestionSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     code_book = CodeBookIdSerializer()
 
     class Meta:
@@ -162,3 +170,27 @@ class VisDataSerializer(serializers.HyperlinkedModelSerializer):
         model = Question
         depth = 1
         fields = ('name', 'text', 'title', 'id', 'children_questions', )
+
+
+class ImportJobSerializer(serializers.HyperlinkedModelSerializer):
+    upload = serializers.StringRelatedField()
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'upload', 'job', 'status', 'stage', 'progress', 'error',
+                  'worker', 'created_at', 'started_at', 'finished_at')
+
+    def get_progress(self, obj):
+        return json.loads(obj.progress) if obj.progress else {}
+
+
+class UploadFileSerializer(serializers.ModelSerializer):
+    stats = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadFile
+        fields = ('id', 'sheet', 'created_at', 'stats')
+
+    def get_stats(self, obj):
+        return obj.get_stats()
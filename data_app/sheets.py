@@ -0,0 +1,103 @@
+__author__ = 'yarnaid'
+
+import multiprocessing
+
+import pandas as pd
+import xlrd
+from django.conf import settings
+
+from data_app.fingerprint import frame_hash
+
+_book = None  # workbook opened by a pool worker, see open_book
+
+
+def get_processes():
+    """Number of processes decoding sheets during import
+
+    Configured with IMPORT_PROCESSES setting, 0 (default) means one per
+    CPU, 1 parses in the importing process
+    """
+    processes = getattr(settings, 'IMPORT_PROCESSES', 0)
+    return processes or multiprocessing.cpu_count()
+
+
+def open_book(path):
+    """Opens the workbook once per pool worker
+
+    Sheets of .xls are loaded by xlrd only when parsed
+    """
+    global _book
+    _book = pd.ExcelFile(xlrd.open_workbook(path, on_demand=True))
+
+
+def parse_sheet(name):
+    return name, _book.parse(name)
+
+
+class SheetReader(object):
+    """Workbook whose sheets are decoded by a process pool
+
+    Has sheet_names and parse() of pandas.ExcelFile, so parsers of
+    UploadFile take either. All wanted sheets are submitted at once,
+    one task per sheet, and parse() waits only for the asked sheet:
+    rows of the sheets decoded first are written while the rest are
+    still being decoded. Parsed sheets are kept until the reader is
+    closed, so validation and parsers decode every sheet once, and
+    hashed into `hashes` {sheet name: fingerprint.frame_hash}.
+
+    Arguments:
+    ----------
+        path: String
+            workbook file
+        wanted: callable
+            takes sheet name, tells whether the sheet will be parsed
+        processes: int
+            pool size, see get_processes; with 1 sheets are parsed
+            on demand by the calling process
+    """
+
+    def __init__(self, path, wanted, processes=None):
+        self.excel_file = pd.ExcelFile(xlrd.open_workbook(path, on_demand=True))
+        self.sheet_names = self.excel_file.sheet_names
+        self.processes = processes if processes is not None else get_processes()
+        self.parsed = dict()
+        self.frames = dict()
+        self.hashes = dict()
+        self.pool = None
+        names = [name for name in self.sheet_names if wanted(name)]
+        if self.processes > 1 and len(names) > 1:
+            self.pool = multiprocessing.Pool(min(self.processes, len(names)),
+                                             initializer=open_book, initargs=(path,))
+            # the largest sheets are usually the last ones (verbatims)
+            self.results = self.pool.imap_unordered(parse_sheet, reversed(names))
+
+    def parse(self, name):
+        if name not in self.frames:
+            self.frames[name] = self.decode(name)
+            self.hashes[name] = frame_hash(self.frames[name])
+        return self.frames[name]
+
+    def decode(self, name):
+        if self.pool is None:
+            return self.excel_file.parse(name)
+        while name not in self.parsed:
+            try:
+                parsed_name, df = next(self.results)
+            except StopIteration:  # not a wanted sheet
+                return self.excel_file.parse(name)
+            self.parsed[parsed_name] = df
+        return self.parsed.pop(name)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.frames.clear()
+        self.excel_file.book.release_resources()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
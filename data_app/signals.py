@@ -0,0 +1,128 @@
+__author__ = 'yarnaid'
+
+from django.db.models import Count
+from django.db.models.signals import post_init
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+from django.dispatch import receiver
+
+from data_app.models import Code
+from data_app.models import CodeBook
+from data_app.models import CodeCount
+from data_app.models import DIMENSIONS
+from data_app.models import Job
+from data_app.models import job_field
+from data_app.models import Question
+from data_app.models import touch_jobs
+from data_app.models import Variable
+from data_app.models import Verbatim
+
+
+def variable_dimensions(variable_id):
+    if variable_id is None:
+        return {d: None for d in DIMENSIONS}
+    return Variable.objects.filter(pk=variable_id).values(*DIMENSIONS).get()
+
+
+def verbatim_state(verbatim):
+    return verbatim.question_id, verbatim.parent_id, verbatim.variable_id
+
+
+@receiver(post_init, sender=Verbatim)
+def remember_verbatim(sender, instance, **kwargs):
+    """Keeps the loaded state of verbatim to move its count on edit
+
+    Stored row can't be read in pre_save: MPTT moves the node
+    before saving it
+    """
+    instance._stored = verbatim_state(instance) if instance.pk is not None else None
+
+
+@receiver(pre_save, sender=Verbatim)
+def copy_verbatim_dimensions(sender, instance, raw=False, **kwargs):
+    """Copies DIMENSIONS of the variable when it's set or changed
+    """
+    if raw:
+        return
+    stored = getattr(instance, '_stored', False)
+    if not stored or stored[2] != instance.variable_id:
+        for d, value in variable_dimensions(instance.variable_id).items():
+            setattr(instance, d, value)
+
+
+@receiver(post_save, sender=Verbatim)
+def count_verbatim(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    current = verbatim_state(instance)
+    stored = None if created else getattr(instance, '_stored', False)
+    if stored is False:  # loaded with deferred fields, state unknown
+        CodeCount.objects.rebuild(instance.job)
+        return
+    if stored == current:
+        return
+    if stored is not None:
+        CodeCount.objects.adjust(instance.job_id, stored[0], stored[1],
+                                 variable_dimensions(stored[2]), -1)
+    CodeCount.objects.adjust(instance.job_id, current[0], current[1],
+                             variable_dimensions(current[2]), 1)
+    instance._stored = current
+
+
+def variable_state(variable):
+    return {d: getattr(variable, d) for d in DIMENSIONS}
+
+
+@receiver(post_init, sender=Variable)
+def remember_variable(sender, instance, **kwargs):
+    instance._stored = variable_state(instance) if instance.pk is not None else None
+
+
+@receiver(post_save, sender=Variable)
+def copy_variable_dimensions(sender, instance, created=False, raw=False, **kwargs):
+    """Updates copies of DIMENSIONS in verbatims of the variable
+
+    Connected before move_variable_counts, which may rebuild counts
+    from the copies
+    """
+    if raw or created:
+        return
+    current = variable_state(instance)
+    if getattr(instance, '_stored', None) != current:
+        Verbatim.objects.filter(variable=instance).update(**current)
+
+
+@receiver(post_save, sender=Variable)
+def move_variable_counts(sender, instance, created=False, raw=False, **kwargs):
+    """Moves counts of all verbatims of the variable to its new bucket
+    """
+    if raw or created:
+        return
+    stored = getattr(instance, '_stored', None)
+    if stored is None:  # loaded with deferred fields, state unknown
+        CodeCount.objects.rebuild(instance.job)
+        return
+    current = variable_state(instance)
+    if stored == current:
+        return
+    groups = (Verbatim.objects.filter(variable=instance).order_by()
+              .values_list('question_id', 'parent_id').annotate(Count('id')))
+    for question_id, code_id, count in groups:
+        CodeCount.objects.adjust(instance.job_id, question_id, code_id, stored, -count)
+        CodeCount.objects.adjust(instance.job_id, question_id, code_id, current, count)
+    instance._stored = current
+
+
+@receiver(post_save, sender=Job)
+@receiver(post_save, sender=Question)
+@receiver(post_save, sender=CodeBook)
+@receiver(post_save, sender=Code)
+@receiver(post_save, sender=Verbatim)
+@receiver(post_save, sender=Variable)
+def touch_job(sender, instance, raw=False, **kwargs):
+    """New version of job data on any edit of its entities, deletions
+    are handled by data_app.models.delete_job_rows
+    """
+    if raw:
+        return
+    touch_jobs([instance.pk if sender is Job else getattr(instance, job_field(sender) + '_id')])
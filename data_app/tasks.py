@@ -0,0 +1,95 @@
+__author__ = 'yarnaid'
+
+import json
+import os
+import socket
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import connection
+from django.db import DatabaseError
+from django.utils import timezone
+
+from data_app.models import ImportJob
+from data_app.progress import Progress
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_next(worker):
+    """Takes the oldest pending ImportJob
+
+    Claiming is a conditional UPDATE, so several workers polling
+    the same table never run one import twice.
+
+    Returns:
+    --------
+        claimed ImportJob or None if the queue is empty
+    """
+    pending = ImportJob.objects.filter(status=ImportJob.PENDING).order_by('id')
+    for pk in pending.values_list('id', flat=True)[:10]:
+        claimed = ImportJob.objects.filter(pk=pk, status=ImportJob.PENDING).update(
+            status=ImportJob.RUNNING, worker=worker, started_at=timezone.now())
+        if claimed:
+            return ImportJob.objects.get(pk=pk)
+    return None
+
+
+class ProgressReporter(threading.Thread):
+    """Writes progress of the running import to its ImportJob row
+
+    Runs in its own thread, hence with its own DB connection, so the
+    progress is visible while the import transaction is not committed yet.
+    """
+
+    def __init__(self, import_job, progress, interval):
+        super(ProgressReporter, self).__init__()
+        self.daemon = True
+        self.import_job_id = import_job.pk
+        self.progress = progress
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        try:
+            ImportJob.objects.filter(pk=self.import_job_id).update(
+                stage=self.progress.current or '',
+                progress=json.dumps(self.progress.as_dict()))
+        except DatabaseError:
+            pass  # e.g. SQLite is locked by the import, try next time
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_import_job(import_job):
+    """Executes parse stages of claimed ImportJob and stores the outcome
+    """
+    progress = Progress()
+    reporter = ProgressReporter(import_job, progress,
+                                getattr(settings, 'IMPORT_PROGRESS_INTERVAL', 1))
+    reporter.start()
+    try:
+        import_job.job = import_job.upload.process(progress=progress)
+        import_job.status = ImportJob.DONE
+    except Exception:
+        import_job.status = ImportJob.FAILED
+        import_job.error = traceback.format_exc()
+    finally:
+        reporter.stop()
+    import_job.stage = ''
+    import_job.progress = json.dumps(progress.as_dict())
+    import_job.finished_at = timezone.now()
+    import_job.save()
+    return import_job
@@ -1,3 +1,916 @@
+import csv
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from decimal import Decimal
+from unittest import skipIf
+
+import pandas as pd
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import Count
+from django.db.models import Sum
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.translation import ugettext_lazy
+
+from data_app import aggregation
+from data_app import benchmark
+from data_app import bulk
+from data_app import cache
+from data_app.admin import UploadFileForm
+from data_app import explain
+from data_app import fast_serializers
+from data_app import job_index
+from data_app import tasks
+from data_app import views
+from data_app.models import Code
+from data_app.models import CodeCount
+from data_app.models import DIMENSIONS
+from data_app.models import ImportJob
+from data_app.models import Job
+from data_app.models import Question
+from data_app.models import QuestionCube
+from data_app.models import UploadFile
+from data_app.progress import Progress
+from data_app.models import Variable
+from data_app.models import Verbatim
+from data_app.models import touch_jobs
+from data_app.validation import WorkbookInvalid
+
+
+class WorkbookMixin(object):
+    """Imports synthetic workbooks (see data_app.benchmark) stored
+    in a temporary directory of UploadFile storage
+    """
+
+    def setUp(self):
+        storage = UploadFile._meta.get_field('sheet').storage
+        if not os.path.isdir(storage.location):
+            os.makedirs(storage.location)
+        self.media = tempfile.mkdtemp(dir=storage.location)
+        self.storage = storage
+        # versions of the jobs rolled back by the previous test are given again
+        QuestionCube.objects.decoded.clear()
+        job_index.indexes.clear()
+        cache.get_cache().clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.media)
+
+    def import_workbook(self, respondents, extension='xls', keep=True, questions=2, **layout):
+        name = os.path.join(os.path.basename(self.media),
+                            '9{:05d}_benchmark.{}'.format(respondents, extension))
+        sizes = benchmark.make_workbook(self.storage.path(name),
+                                        respondents=respondents, questions=questions, **layout)
+        report = benchmark.run_import(name, keep=keep)
+        report.update(sizes)
+        return report
+
+    def edit_workbook(self, edit):
+        """Rewrites sheets of the workbook at self.path by edit({name: DataFrame})
+        """
+        sheets = pd.read_excel(self.path, sheet_name=None)
+        edit(sheets)
+        writer = pd.ExcelWriter(self.path)
+        for name, df in sheets.items():
+            df.to_excel(writer, name, index=False)
+        writer.save()
+
+
+class WorkbookTestCase(WorkbookMixin, TestCase):
+    pass
+
+
+class ImportBenchmarkTest(WorkbookTestCase):
+    """Imports of synthetic workbooks at small scales
+
+    Checks the imported rows, stages and query counts of the report;
+    timings and memory at larger scales are measured with
+    import_benchmark command.
+    """
+    scales = (50, 200)
+    stages = ('fingerprint', 'validate', 'parse_code_books', 'parse_questions', 'parse_variables',
+              'parse_codes', 'parse_verbatims', 'count_verbatims', 'build_cubes')
+    max_queries = 100
+
+    def test_import_scales(self):
+        for respondents in self.scales:
+            report = self.import_workbook(respondents)
+            job = Job.objects.get(number=report['job_number'])
+            verbatims = Verbatim.objects.filter(question__parent=job)
+            self.assertEqual(verbatims.count(), report['verbatims'])
+            self.assertEqual(sum(CodeCount.objects.filter(job=job).values_list('count', flat=True)),
+                             report['verbatims'])
+            stages = report['stages']
+            self.assertTrue(all(stage['finished'] for stage in stages.values()))
+            self.assertEqual(stages['parse_variables']['rows_written'], respondents)
+            self.assertEqual(stages['parse_verbatims']['rows_written'], report['verbatims'])
+            self.assertEqual(list(stages.keys()), list(self.stages))
+            self.assertLess(report['queries'], self.max_queries)
+
+    def test_queries_do_not_grow_with_rows(self):
+        """Import writes rows in batches, so the number of queries
+        depends on the workbook layout but not on the number of respondents
+        """
+        small, large = [self.import_workbook(n, keep=False)['queries'] for n in self.scales]
+        self.assertLess(large, small * 2)
+        self.assertFalse(Job.objects.exists())
+
+    def test_stage_stats(self):
+        report = self.import_workbook(self.scales[0])
+        stages = report['stages']
+        # job creation and savepoints are out of stages
+        self.assertLessEqual(sum(stage['queries'] for stage in stages.values()), report['queries'])
+        # validation reads the sheets only
+        self.assertEqual(stages['validate']['queries'], 0)
+        self.assertTrue(all(stage['queries'] > 0 for name, stage in stages.items() if name != 'validate'))
+        self.assertTrue(all(stage['cpu'] >= 0 for stage in stages.values()))
+
+        upload = UploadFile.objects.create(sheet=report['file'])
+        self.assertEqual(upload.get_stats(), {})
+        upload.process()
+        stats = UploadFile.objects.get(pk=upload.pk).get_stats()
+        self.assertEqual(list(stats.keys()), list(stages.keys()))
+        self.assertEqual(stats['parse_variables']['rows_written'], self.scales[0])
+
+    @skipIf(not os.path.exists('/proc/self/statm'), 'resident memory is read from /proc')
+    def test_memory(self):
+        """Memory is sampled per import and stage, not taken from the
+        high-water mark of the process
+        """
+        progress = Progress()
+        sampler = benchmark.MemorySampler(progress)
+        with progress.stage('allocate'):
+            sampler.sample()
+            allocated = 'x' * (64 * 1024 * 1024)
+            sampler.sample()
+        self.assertGreater(sampler.stages['allocate'], 60)
+        self.assertGreater(sampler.peak - sampler.start_memory, 60)
+        del allocated
+
+        report = self.import_workbook(self.scales[0])
+        self.assertGreaterEqual(report['peak_memory_growth_mb'], 0)
+        self.assertLess(report['peak_memory_mb'], report['process_peak_memory_mb'] + 1)
+        self.assertTrue(all('memory_growth_mb' in stage for stage in report['stages'].values()))
+
+    def test_xlsx(self):
+        report = self.import_workbook(self.scales[0], extension='xlsx')
+        self.assertEqual(Verbatim.objects.count(), report['verbatims'])
+
+    def test_parallel_sheets(self):
+        serial = self.import_workbook(self.scales[0])
+        with self.settings(IMPORT_PROCESSES=3):
+            parallel = self.import_workbook(self.scales[0])
+        self.assertEqual(Job.objects.count(), 2)
+        for stage, values in serial['stages'].items():
+            self.assertEqual(values['rows_written'], parallel['stages'][stage]['rows_written'], stage)
+
+    def test_code_trees(self):
+        """Nested sets computed in memory are the ones MPTT builds, and
+        codes are written by batches, not node by node
+        """
+        small = super(ImportBenchmarkTest, self).import_workbook(10, nets=2, codes=3)
+        large = super(ImportBenchmarkTest, self).import_workbook(11, nets=8, codes=12)
+        self.assertGreater(large['codes'], small['codes'] * 4)
+        self.assertEqual(small['stages']['parse_code_books']['queries'],
+                         large['stages']['parse_code_books']['queries'])
+        self.assertLess(large['stages']['parse_codes']['queries'], large['codes'] / 10)
+        self.assertEqual(Job.objects.count(), 2)
+
+        fields = ('id', 'tree_id', 'lft', 'rght', 'level')
+        imported = list(Code.objects.order_by('id').values_list(*fields))
+        Code.objects.rebuild()
+        self.assertEqual(list(Code.objects.order_by('id').values_list(*fields)), imported)
+
+
+class ListQueriesTest(WorkbookTestCase):
+    """List endpoints run a fixed number of queries whatever the number
+    of rows, see data_app.query_plan
+
+    Counts include 2 queries of the session authentication.
+    """
+    queries = (
+        ('/en/data/jobs/', 3),
+        ('/en/data/questions/', 4),
+        ('/en/data/short_questions/', 3),
+        ('/en/data/variable_codes/', 3),
+        ('/en/data/code_books/', 4),
+        ('/en/data/codes/', 4),
+        ('/en/data/codes/?fields=id,code,title', 3),
+        ('/en/data/verbatims/', 3),
+        ('/en/data/variables/', 3),
+        ('/en/data/viz_data/', 6),
+    )
+
+    def setUp(self):
+        super(ListQueriesTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def assertListQueries(self, url, expected):
+        """Asserts the number of queries of GET request to the list endpoint
+        """
+        with self.assertNumQueries(expected):
+            response = self.client.get(url + ('&' if '?' in url else '?') + 'format=json')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_queries_do_not_grow_with_rows(self):
+        for respondents, questions in ((10, 1), (100, 3)):
+            self.import_workbook(respondents, questions=questions)
+            for url, expected in self.queries:
+                self.assertListQueries(url, expected)
+
+
+class FastSerializersTest(WorkbookTestCase):
+    """values() serializers of list endpoints render the same JSON as
+    DRF serializers, see data_app.fast_serializers; their speed is
+    measured by serializer_benchmark command
+    """
+
+    def test_same_json(self):
+        self.import_workbook(30)
+        context = benchmark.serializer_context()
+        for name, model, serializer_class, fast_class in benchmark.SERIALIZERS:
+            drf = json.loads(benchmark.render_drf(model, serializer_class, context=context))
+            fast = json.loads(benchmark.render_fast(model, fast_class, context=context))
+            self.assertTrue(drf, name)
+            self.assertEqual(drf, fast, name)
+
+    def test_stream(self):
+        """Streamed array has the rows of the list, whatever the chunks
+        """
+        self.import_workbook(30)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        for url, viewset in (('/en/data/verbatims/', views.VerbatimViewSet),
+                             ('/en/data/codes/', views.CodeViewSet),
+                             ('/en/data/codes/?overcode=true', views.CodeViewSet)):
+            url += '&' if '?' in url else '?'
+            listed = json.loads(self.client.get(url + 'format=json&page_size=1000').content)['results']
+            self.assertTrue(listed, url)
+            for chunk_size in (7, len(listed), 1000):
+                viewset.stream_chunk_size = chunk_size
+                try:
+                    response = self.client.get(url + 'format=json&stream=1')
+                finally:
+                    del viewset.stream_chunk_size
+                self.assertTrue(response.streaming)
+                self.assertEqual(json.loads(''.join(response.streaming_content)), listed,
+                                 (url, chunk_size))
+
+    def test_render(self):
+        """Values of other responses are encoded like DRF does
+        """
+        data = {'created_at': datetime.datetime(2016, 3, 1, 12, 30), 'total': Decimal('1.5'),
+                'title': ugettext_lazy('Job'), 'text': u'r\xe9sultat'}
+        rendered = fast_serializers.FastJSONRenderer().render(data, renderer_context={'response': None})
+        self.assertEqual(json.loads(rendered), {'created_at': '2016-03-01T12:30:00', 'total': 1.5,
+                                                'title': 'Job', 'text': u'r\xe9sultat'})
+
+
+class VerbatimsCsvExportTest(WorkbookTestCase):
+    """CSV export streams all verbatims of the job chunk by chunk
+    """
+
+    def setUp(self):
+        super(VerbatimsCsvExportTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def test_export(self):
+        job = Job.objects.get(number=self.import_workbook(30)['job_number'])
+        chunk_size = views.VerbatimsCsvExport.chunk_size
+        views.VerbatimsCsvExport.chunk_size = 7
+        try:
+            # session, user, job and a query per chunk
+            with self.assertNumQueries(3 + Verbatim.objects.filter(job=job).count() // 7 + 1):
+                response = self.client.get('/en/data/verbatims_csv', {'job': job.pk})
+                rows = list(csv.reader(''.join(response.streaming_content).splitlines()))
+        finally:
+            views.VerbatimsCsvExport.chunk_size = chunk_size
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(tuple(rows[0]), views.VerbatimsCsvExport.header)
+        ids = list(Verbatim.objects.filter(job=job).order_by('id').values_list('id', flat=True))
+        self.assertEqual([int(row[0]) for row in rows[1:]], ids)
+
+    def test_errors(self):
+        for params, status in (({}, 400), ({'job': 'x'}, 400), ({'job': 1000}, 404)):
+            response = self.client.get('/en/data/verbatims_csv', dict(params, format='json'))
+            self.assertEqual(response.status_code, status, params)
+
+
+class ExplainQueriesTest(WorkbookTestCase):
+    """Hot queries read tables by index, see data_app.explain
+    """
+
+    def test_indexed(self):
+        self.import_workbook(30)
+        for name, queryset in explain.canonical_queries().items():
+            lines, indexed = explain.explain(queryset)
+            self.assertTrue(indexed, '{}: {}'.format(name, lines))
+
+
+class VerbatimDimensionsTest(WorkbookTestCase):
+    """Copies of variable DIMENSIONS in Verbatim follow the variables
+    """
+
+    def assertCopied(self):
+        fields = DIMENSIONS + tuple('variable__' + d for d in DIMENSIONS)
+        for row in Verbatim.objects.values_list(*fields):
+            self.assertEqual(row[:len(DIMENSIONS)], row[len(DIMENSIONS):])
+
+    def test_import_and_edit(self):
+        self.import_workbook(30)
+        self.assertCopied()
+        question = Question.objects.filter(code_book__isnull=False).first()
+        self.assertNotIn('data_app_variable', str(aggregation.filtered_verbatims(question, {'sex': 1}).query))
+
+        variable = Variable.objects.filter(verbatim__question=question).first()
+        variable.sex = 3 - variable.sex
+        variable.save()
+        self.assertCopied()
+        variables = Variable.objects.filter(sex=variable.sex)
+        joined = (Verbatim.objects.filter(question=question, variable__in=variables).order_by()
+                  .values_list('parent').annotate(Count('id')))
+        self.assertEqual(aggregation.verbatim_counts(question, {'sex': variable.sex}), dict(joined))
+        self.assertEqual(aggregation.code_counts(question, {'sex': variable.sex}), dict(joined))
+
+        verbatim = Verbatim.objects.filter(question=question).exclude(variable=variable).first()
+        verbatim.variable = variable
+        verbatim.save()
+        self.assertCopied()
+
+    @skipIf(connection.vendor != 'sqlite', 'plan lines of SQLite are compared')
+    def test_dimension_indexes(self):
+        self.import_workbook(30)
+        question = Question.objects.filter(code_book__isnull=False).first()
+        for dimension in DIMENSIONS:
+            verbatims = aggregation.filtered_verbatims(question, {dimension: 1}).order_by()
+            lines, indexed = explain.explain(verbatims)
+            self.assertTrue(any('{}=?'.format(dimension) in line for line in lines), lines)
+
+
+class QuestionCubeTest(WorkbookTestCase):
+    """Cube slices give the same counts as verbatims grouped by SQL
+    """
+
+    def assertSameCounts(self, question):
+        filters_list = [dict()] + [{d: v} for d in DIMENSIONS for v in range(1, 4)] + \
+                       [{'sex': 1, 'age_bands': 2}, {'sex': 2, 'reg_quota': 1, 'csp_quota': 3}]
+        for filters in filters_list:
+            self.assertEqual(aggregation.code_counts(question, filters),
+                             aggregation.verbatim_counts(question, filters), filters)
+
+    def test_counts(self):
+        self.import_workbook(50)
+        self.assertEqual(QuestionCube.objects.count(), Question.objects.count())
+        question = Question.objects.filter(code_book__isnull=False).first()
+        self.assertSameCounts(question)
+        aggregation.code_counts(question, {'sex': 1})
+        with self.assertNumQueries(1):  # versions only, decoded cube is reused
+            aggregation.code_counts(question, {'sex': 2})
+
+        variable = Variable.objects.filter(verbatim__question=question).first()
+        variable.sex = 3 - variable.sex
+        variable.save()
+        self.assertSameCounts(question)  # stale cube is rebuilt
+
+
+class JobIndexTest(WorkbookTestCase):
+    """In-memory index of the job counts like SQL and follows edits
+    """
+
+    def assertSameCounts(self, job, question):
+        variable = Variable.objects.filter(job=job).first()
+        filters_list = [dict(), {'sex': 1}, {'sex': 2, 'age_bands': 1},
+                        {'reg_quota': 2, 'csp_quota': 3}, {'uid': variable.uid},
+                        {'sex': variable.sex, 'uid': variable.uid}]
+        for filters in filters_list:
+            self.assertEqual(aggregation.code_counts(question, filters, job=job),
+                             aggregation.verbatim_counts(question, filters), filters)
+
+    def test_counts(self):
+        job = Job.objects.get(number=self.import_workbook(50)['job_number'])
+        question = Question.objects.filter(parent=job, code_book__isnull=False).first()
+        self.assertSameCounts(job, question)
+        with self.assertNumQueries(0):
+            aggregation.code_counts(question, {'sex': 1}, job=job)
+
+        variable = Variable.objects.filter(verbatim__question=question).first()
+        variable.sex = 3 - variable.sex
+        variable.save()
+        job = Job.objects.get(pk=job.pk)
+        self.assertSameCounts(job, question)
+        self.assertEqual(job_index.get_index(job).version, job.version)
+
+
+class VisualizationBatchTest(WorkbookTestCase):
+    """Every batch entry is the visualization_data response of its spec
+    and shares the cache with it
+    """
+
+    def setUp(self):
+        super(VisualizationBatchTest, self).setUp()
+        cache.get_cache().clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.job = Job.objects.get(number=self.import_workbook(30, questions=3)['job_number'])
+        questions = Question.objects.filter(parent=self.job, code_book__isnull=False).values_list('id', flat=True)
+        self.specs = [dict(filters, job=self.job.pk, question=question)
+                      for question in questions
+                      for filters in ({}, {'sex': 1}, {'sex': 2, 'age_bands': 1})]
+        for i, spec in enumerate(self.specs):
+            spec['key'] = str(i)
+
+    def batch(self, specs, status=200):
+        response = self.client.post('/en/data/visualization_batch?format=json',
+                                    json.dumps({'specs': specs}), content_type='application/json')
+        self.assertEqual(response.status_code, status, response.content)
+        return json.loads(response.content)
+
+    def visualization(self, spec):
+        params = dict((k, v) for k, v in spec.items() if k != 'key')
+        response = self.client.get('/en/data/visualization_data', dict(params, format='json'))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_same_as_single(self):
+        result = self.batch(self.specs)
+        self.assertEqual(sorted(result), sorted(spec['key'] for spec in self.specs))
+        self.assertEqual(cache.stats()['misses'], len(self.specs))
+        for spec in self.specs:  # filled by the batch
+            self.assertEqual(self.visualization(spec), result[spec['key']], spec)
+        self.assertEqual(cache.stats()['hits'], len(self.specs))
+
+        response = self.client.get('/en/data/visualization_batch',
+                                   {'specs': json.dumps(self.specs[:2]), 'format': 'json'})
+        self.assertEqual(json.loads(response.content), dict((k, result[k]) for k in ('0', '1')))
+
+    def test_cached_single(self):
+        single = [self.visualization(spec) for spec in self.specs[:2]]
+        self.assertEqual(cache.stats()['misses'], 2)
+        result = self.batch(self.specs)
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2 + len(self.specs) - 2)
+        self.assertEqual([result['0'], result['1']], single)
+
+    def test_errors(self):
+        for specs in ([], None, [{'job': self.job.pk}], [{'job': 'x', 'question': 1}]):
+            self.batch(specs, status=400)
+        response = self.client.get('/en/data/visualization_batch', {'specs': '[', 'format': 'json'})
+        self.assertEqual(response.status_code, 400)
+        self.batch([dict(self.specs[0], job=self.job.pk + 1000)], status=404)
+
+
+class CodeCountTest(WorkbookTestCase):
+    """Materialized counts follow deletions through the API and admin
+    """
+
+    def setUp(self):
+        super(CodeCountTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.job = Job.objects.get(number=self.import_workbook(30)['job_number'])
+        self.question = Question.objects.filter(parent=self.job, code_book__isnull=False).first()
+
+    def buckets(self):
+        fields = ('question', 'code') + DIMENSIONS + ('count', )
+        return sorted(CodeCount.objects.filter(job=self.job).values_list(*fields))
+
+    def assertRebuilt(self):
+        """Asserts counts equal to the counts rebuilt from scratch
+        """
+        buckets = self.buckets()
+        counts = aggregation.code_counts(self.question, {'sex': 1})
+        CodeCount.objects.rebuild(self.job)
+        touch_jobs([self.job.pk])
+        self.assertEqual(buckets, self.buckets())
+        self.assertEqual(counts, aggregation.code_counts(self.question, {'sex': 1}))
+        self.assertEqual(counts, aggregation.verbatim_counts(self.question, {'sex': 1}))
+
+    def test_api_delete(self):
+        verbatim = Verbatim.objects.filter(question=self.question, parent__isnull=False, sex=1).first()
+        counts = aggregation.code_counts(self.question, {'sex': 1})
+        response = self.client.delete('/en/data/verbatims/{}/'.format(verbatim.pk))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(aggregation.code_counts(self.question, {'sex': 1}).get(verbatim.parent_id, 0),
+                         counts[verbatim.parent_id] - 1)
+        self.assertRebuilt()
+
+        variable = Variable.objects.filter(verbatim__question=self.question, sex=1).first()
+        response = self.client.delete('/en/data/variables/{}/'.format(variable.pk))
+        self.assertEqual(response.status_code, 204)
+        self.assertRebuilt()
+
+    def test_delete_code(self):
+        code = Code.objects.filter(job=self.job, children_verbatims__question=self.question).first()
+        response = self.client.delete('/en/data/codes/{}/'.format(code.pk))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(CodeCount.objects.filter(code=code.pk).exists())
+        self.assertRebuilt()
+
+    def test_admin_delete_selected(self):
+        pks = list(Verbatim.objects.filter(question=self.question, parent__isnull=False)
+                   .values_list('id', flat=True)[:3])
+        response = self.client.post('/en/admin/data_app/verbatim/', {
+            'action': 'delete_selected', 'post': 'yes', '_selected_action': pks})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Verbatim.objects.filter(pk__in=pks).exists())
+        self.assertRebuilt()
+
+    def test_delete_job(self):
+        """Rows of a deleted job are deleted by cascade without loading
+        them, the number of queries doesn't grow with the job
+        """
+        queries = list()
+        for job in (self.job, Job.objects.get(number=self.import_workbook(100)['job_number'])):
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.delete('/en/data/jobs/{}/'.format(job.pk))
+            self.assertEqual(response.status_code, 204)
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+        self.assertLess(queries[0], 40)
+        self.assertFalse(Verbatim.objects.exists())
+        self.assertFalse(CodeCount.objects.exists())
+
+
+class VisualizationDataTest(WorkbookTestCase):
+    """visualization_data responses equal the ones of the recursive
+    per-code implementation stored in testdata, with a fixed number of
+    queries
+    """
+    fixture = os.path.join(os.path.dirname(__file__), 'testdata', 'visualization_responses.json')
+    # session, user, job, question and codes of its codebook; counts come
+    # from the in-memory job index, uid filter takes the respondent ids
+    queries = {'unfiltered': 5, 'dimensions': 5, 'uid': 6}
+
+    def setUp(self):
+        super(VisualizationDataTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.job = Job.objects.get(number=self.import_workbook(30)['job_number'])
+        job_index.get_index(self.job)
+
+    def strip_ids(self, nodes):
+        """Ids depend on the database, codes and titles are compared instead
+        """
+        for node in nodes:
+            del node['id'], node['question_id']
+            self.strip_ids(node['children'])
+
+    def test_same_response(self):
+        with open(self.fixture) as f:
+            expected = json.load(f)
+        for entry in expected:
+            question = Question.objects.get(parent=self.job, name=entry['question'])
+            filters = entry['filters']
+            kind = 'uid' if 'uid' in filters else 'dimensions' if filters else 'unfiltered'
+            cache.get_cache().clear()
+            with self.assertNumQueries(self.queries[kind]):
+                response = self.client.get('/en/data/visualization_data',
+                                           dict(filters, job=self.job.pk, question=question.pk, format='json'))
+            body = json.loads(response.content)
+            self.strip_ids(body['question']['children'])
+            self.assertEqual(body, entry['response'], entry)
+
+class VisualizationCacheTest(WorkbookTestCase):
+    """visualization_data responses are cached per job version, which
+    moves on every edit and deletion of the job data
+    """
+
+    def setUp(self):
+        super(VisualizationCacheTest, self).setUp()
+        cache.get_cache().clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        self.job = Job.objects.get(number=self.import_workbook(30)['job_number'])
+        self.question = Question.objects.filter(parent=self.job, code_book__isnull=False).first()
+
+    def visualization(self, **filters):
+        filters.update(job=self.job.pk, question=self.question.pk, format='json')
+        response = self.client.get('/en/data/visualization_data', filters)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def assertCounted(self, hits, misses):
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (hits, misses))
+
+    def coded_verbatim(self):
+        return Verbatim.objects.filter(question=self.question, parent__isnull=False).first()
+
+    def test_hit_and_miss(self):
+        first = self.visualization(sex=1)
+        self.assertCounted(0, 1)
+        self.assertEqual(self.visualization(sex=1), first)
+        self.assertCounted(1, 1)
+        self.visualization(sex=2)
+        self.assertCounted(1, 2)
+
+    def test_edit(self):
+        before = self.visualization()
+        verbatim = self.coded_verbatim()
+        verbatim.question = Question.objects.filter(parent=self.job).exclude(pk=self.question.pk).first()
+        verbatim.save()
+        after = self.visualization()
+        self.assertCounted(0, 2)
+        self.assertEqual(after['question']['verbatim_count'], before['question']['verbatim_count'] - 1)
+
+    def test_delete(self):
+        before = self.visualization()
+        response = self.client.delete('/en/data/verbatims/{}/'.format(self.coded_verbatim().pk))
+        self.assertEqual(response.status_code, 204)
+        after = self.visualization()
+        self.assertCounted(0, 2)
+        self.assertEqual(after['question']['verbatim_count'], before['question']['verbatim_count'] - 1)
+
+
+class IncrementalImportTest(WorkbookTestCase):
+    """Re-import of a corrected workbook writes the changed rows only
+    """
+
+    def setUp(self):
+        super(IncrementalImportTest, self).setUp()
+        self.name = os.path.join(os.path.basename(self.media), '900040_incremental.xls')
+        self.path = self.storage.path(self.name)
+        benchmark.make_workbook(self.path, respondents=40, questions=2)
+
+    def reimport(self):
+        upload = UploadFile.objects.create(sheet=self.name, incremental=True)
+        job = upload.process()
+        return upload, Job.objects.get(pk=job.pk)
+
+    def snapshot(self, job):
+        return sorted(Verbatim.objects.filter(job=job).values_list('id', 'verbatim', 'parent', 'sex'))
+
+    def test_reimport(self):
+        upload, job = self.reimport()
+        verbatims = self.snapshot(job)
+        self.assertTrue(verbatims)
+
+        upload, same = self.reimport()
+        self.assertEqual(same.pk, job.pk)
+        self.assertEqual(upload.get_stats().keys(), ['fingerprint'])
+        self.assertEqual(same.version, job.version)
+        self.assertEqual(self.snapshot(job), verbatims)
+
+        def retitle(sheets):
+            sheets['cb_q1'].loc[0, 'title'] = 'Corrected'
+            sheets['variables'].loc[0, 'sex'] = 3 - sheets['variables'].loc[0, 'sex']
+            sheets['verbatims'].loc[1, 'Q2 - text'] = 'Corrected answer'
+        self.edit_workbook(retitle)
+        upload, job = self.reimport()
+        self.assertEqual(upload.sync.inserted + upload.sync.deleted, 0)
+        self.assertGreater(upload.sync.updated, 2)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertTrue(Code.objects.filter(job=job, title='Corrected').exists())
+        self.assertEqual(Verbatim.objects.filter(job=job, verbatim='Corrected answer').count(),
+                         Verbatim.objects.filter(job=job, verbatim='Q2 answer 2').count() + 1)
+        self.assertEqual([row[0] for row in self.snapshot(job)], [row[0] for row in verbatims])
+        self.assertEqual(CodeCount.objects.filter(job=job).aggregate(Sum('count'))['count__sum'],
+                         len(verbatims))
+
+        def drop_answer(sheets):
+            sheets['verbatims'].loc[2, 'Q1 - text'] = None
+        self.edit_workbook(drop_answer)
+        upload, job = self.reimport()
+        self.assertEqual(upload.sync.inserted, 0)
+        self.assertGreater(upload.sync.deleted, 0)
+        self.assertEqual(Verbatim.objects.filter(job=job).count(), len(verbatims) - upload.sync.deleted)
+
+    def test_changed_code_tree(self):
+        upload, job = self.reimport()
+
+        def add_code(sheets):
+            codebook = sheets['cb_q1']
+            row = codebook[codebook['Codes'].notnull()].iloc[[0]].copy()
+            row['Codes'] = 999
+            sheets['cb_q1'] = pd.concat([codebook, row], ignore_index=True)
+        self.edit_workbook(add_code)
+        upload, same = self.reimport()
+        self.assertEqual(same.pk, job.pk)
+        self.assertTrue(Code.objects.filter(job=job, code=999).exists())
+        self.assertEqual(Code.objects.filter(job=job, code_book__name='cb_q1').count(),
+                         Code.objects.filter(job=job, code_book__name='cb_q2').count() + 1)
+        fields = ('id', 'tree_id', 'lft', 'rght', 'level')
+        imported = list(Code.objects.order_by('id').values_list(*fields))
+        Code.objects.rebuild()
+        self.assertEqual(list(Code.objects.order_by('id').values_list(*fields)), imported)
+
+    def test_fingerprint(self):
+        upload, job = self.reimport()
+        self.assertEqual(len(upload.fingerprint), 64)
+        self.assertIn('verbatims', upload.get_changed_sheets())
+
+        same = UploadFile.objects.create(sheet=self.name)
+        self.assertEqual(same.process(), job)
+        same = UploadFile.objects.get(pk=same.pk)
+        self.assertEqual(same.job, job)
+        self.assertEqual(same.get_stats().keys(), ['fingerprint'])
+        self.assertEqual(same.get_changed_sheets(), [])
+        self.assertEqual(Job.objects.count(), 1)
+
+        def retitle(sheets):
+            sheets['verbatims'].loc[1, 'Q2 - text'] = 'Corrected answer'
+        self.edit_workbook(retitle)
+        upload, job = self.reimport()
+        self.assertEqual(upload.get_changed_sheets(), ['verbatims'])
+        self.assertTrue(upload.unchanged_rows(Code))
+        self.assertFalse(upload.unchanged_rows(Verbatim))
+        self.assertEqual(upload.sync.updated, 1)
+
+        touch_jobs([job.pk])  # edited after the import
+        upload, job = self.reimport()
+        self.assertIn('parse_verbatims', upload.get_stats())
+        self.assertFalse(upload.sync.changed)
+
+
+class ImportQueueTest(WorkbookTestCase):
+    """Uploads are queued as ImportJob and imported by import_worker
+    """
+
+    def queue(self, respondents, broken=False):
+        name = os.path.join(os.path.basename(self.media), '9{:05d}_queued.xls'.format(respondents))
+        benchmark.make_workbook(self.storage.path(name), respondents=respondents)
+        if broken:
+            with open(self.storage.path(name), 'wb') as f:
+                f.write('not a workbook')
+        return UploadFile.objects.create(sheet=name).import_jobs.get()
+
+    def test_claim_once(self):
+        queued = [self.queue(10), self.queue(20)]
+        self.assertEqual([j.status for j in queued], [ImportJob.PENDING] * 2)
+        first = tasks.claim_next('first')
+        self.assertEqual((first.pk, first.status, first.worker), (queued[0].pk, ImportJob.RUNNING, 'first'))
+        self.assertIsNotNone(first.started_at)
+        self.assertEqual(tasks.claim_next('second').pk, queued[1].pk)
+        self.assertIsNone(tasks.claim_next('third'))
+
+    def test_done(self):
+        self.queue(10)
+        import_job = tasks.run_import_job(tasks.claim_next('worker'))
+        import_job = ImportJob.objects.get(pk=import_job.pk)
+        self.assertEqual((import_job.status, import_job.stage, import_job.error), (ImportJob.DONE, '', ''))
+        self.assertEqual(import_job.job.number, 900010)
+        self.assertIsNotNone(import_job.finished_at)
+        progress = json.loads(import_job.progress)
+        self.assertIn('parse_verbatims', progress)
+        self.assertTrue(all(stage['finished'] for stage in progress.values()))
+
+    def test_failed(self):
+        self.queue(10, broken=True)
+        import_job = tasks.run_import_job(tasks.claim_next('worker'))
+        import_job = ImportJob.objects.get(pk=import_job.pk)
+        self.assertEqual(import_job.status, ImportJob.FAILED)
+        self.assertIsNone(import_job.job)
+        self.assertIn('Traceback', import_job.error)
+        self.assertFalse(Job.objects.exists())
+
+    def test_progress(self):
+        import_job = self.queue(10)
+        progress = Progress()
+        reporter = tasks.ProgressReporter(import_job, progress, 1)
+        with progress.stage('parse_variables'):
+            progress.add(parsed=5)
+            reporter.flush()
+        import_job = ImportJob.objects.get(pk=import_job.pk)
+        self.assertEqual(import_job.stage, 'parse_variables')
+        stage = json.loads(import_job.progress)['parse_variables']
+        self.assertEqual((stage['rows_parsed'], stage['finished']), (5, False))
+
+    def test_worker(self):
+        done, failed = self.queue(10), self.queue(20, broken=True)
+        call_command('import_worker', once=True, stdout=StringIO())
+        self.assertEqual(ImportJob.objects.get(pk=done.pk).status, ImportJob.DONE)
+        self.assertEqual(ImportJob.objects.get(pk=failed.pk).status, ImportJob.FAILED)
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+        response = self.client.get('/en/data/import_jobs/', {'status': 'done', 'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.content)
+        self.assertEqual([j['id'] for j in results], [done.pk])
+        self.assertIn('parse_verbatims', results[0]['progress'])
+
+
+class ConcurrentImportTest(WorkbookMixin, TransactionTestCase):
+    """Imports running at once get distinct ids and tree ids
+
+    SQLite in-memory database of tests can't be shared by threads on
+    Python 2, give it TEST NAME to run the concurrent imports. Throughput
+    of concurrent imports is measured with import_stress command.
+    """
+
+    def test_id_allocator(self):
+        self.import_workbook(20)
+        stored = set(Verbatim.objects.values_list('id', flat=True))
+        first, second = bulk.IdAllocator(block=3), bulk.IdAllocator(block=3)
+        ids = [first.next_id(Verbatim) for i in range(7)]
+        self.assertEqual(len(set(ids)), 7)
+        self.assertFalse(stored & set(ids))
+        self.assertFalse(stored & set(second.next_id(Verbatim) for i in range(7)))
+
+        job = Job.objects.first()
+        codes = [Code(job=job, overcode=False), Code(job=job, overcode=False)]
+        codes.append(Code(job=job, overcode=False, parent=codes[0]))
+        first.number_tree(codes)
+        tree_ids = set(Code.objects.values_list('tree_id', flat=True))
+        self.assertEqual(len(set(code.tree_id for code in codes)), 2)
+        self.assertFalse(tree_ids & set(code.tree_id for code in codes))
+        self.assertEqual(Job.objects.create(name='root', number=1).tree_id,
+                         max(Job.objects.values_list('tree_id', flat=True)))
+
+    @skipIf(connection.vendor == 'sqlite' and not connection.features.can_share_in_memory_db and
+            connection.is_in_memory_db(connection.settings_dict['TEST']['NAME'] or ':memory:'),
+            'in-memory SQLite database is not shared by threads')
+    def test_concurrent_imports(self):
+        names = list()
+        verbatims = list()
+        for i in range(3):
+            name = os.path.join(os.path.basename(self.media), '8{:05d}_stress.xls'.format(i))
+            sizes = benchmark.make_workbook(self.storage.path(name), respondents=30,
+                                            questions=2, seed=i)
+            names.append(name)
+            verbatims.append(sizes['verbatims'])
+        report = benchmark.run_concurrent_imports(names, workers=3, threads=True)
+        self.assertEqual(len(set(report['jobs'])), 3)
+        self.assertEqual(benchmark.check_integrity(report['jobs'], dict(zip(report['jobs'], verbatims))), [])
+
+
+class WorkbookValidationTest(WorkbookTestCase):
+    """Broken references are reported before anything is written
+    """
+
+    def setUp(self):
+        super(WorkbookValidationTest, self).setUp()
+        self.name = os.path.join(os.path.basename(self.media), '900050_validation.xls')
+        self.path = self.storage.path(self.name)
+        benchmark.make_workbook(self.path, respondents=20, questions=2)
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def break_references(self, sheets):
+        codebook = sheets['cb_q1']
+        row = codebook[codebook['Sub net'].notnull() & codebook['Codes'].isnull()].iloc[[0]].copy()
+        row['NET'] = 77
+        sheets['cb_q1'] = pd.concat([codebook, row], ignore_index=True)
+        verbatims = sheets['verbatims']
+        verbatims.loc[3, 'Q1 - code 1'] = 999
+        verbatims.loc[5, 'uid'] = 9999
+        verbatims['Q9 - text'] = 'answer'
+
+    def test_valid(self):
+        self.assertEqual(UploadFile.validate_file(self.path), [])
+        response = self.client.get('/en/data/validate_workbook?format=json&upload={}'.format(
+            UploadFile.objects.create(sheet=self.name).pk))
+        self.assertEqual(json.loads(response.content), {'valid': True, 'errors': []})
+
+    def test_errors(self):
+        self.edit_workbook(self.break_references)
+        errors = UploadFile.validate_file(self.path)
+        found = set((e['sheet'], e['row'], e['column'], e['value']) for e in errors)
+        self.assertEqual(found, {
+            ('cb_q1', len(pd.read_excel(self.path, 'cb_q1')) + 1, 'NET', 77),
+            ('verbatims', 5, 'Q1 - code 1', 999),
+            ('verbatims', 7, 'uid', 9999),
+            ('verbatims', None, 'Q9 - text', None),
+        })
+
+        upload = UploadFile.objects.create(sheet=self.name)
+        with self.assertRaises(WorkbookInvalid) as raised:
+            upload.process()
+        self.assertEqual(raised.exception.errors, errors)
+        self.assertEqual(upload.get_stats().keys(), [])
+        self.assertFalse(Job.objects.exists())
+
+        with open(self.path, 'rb') as f:
+            response = self.client.post('/en/data/validate_workbook?format=json', {'sheet': f})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {'valid': False, 'errors': errors})
+
+        # cells are not parsed by the upload form, the queued import fails
+        with open(self.path, 'rb') as f:
+            form = UploadFileForm(files={'sheet': SimpleUploadedFile('900050_validation.xls', f.read())})
+        self.assertTrue(form.is_valid())
+        import_job = tasks.run_import_job(tasks.claim_next('worker'))
+        self.assertEqual((import_job.upload_id, import_job.status), (upload.pk, ImportJob.FAILED))
+        self.assertIn('WorkbookInvalid: {} errors in the workbook'.format(len(errors)), import_job.error)
+
+    def test_upload_form(self):
+        form = UploadFileForm(files={'sheet': SimpleUploadedFile('900050_validation.xls', 'not a workbook')})
+        self.assertFalse(form.is_valid())
 
-# Create your tests here.
+        self.edit_workbook(lambda sheets: sheets.pop('variables'))
+        with open(self.path, 'rb') as f:
+            form = UploadFileForm(files={'sheet': SimpleUploadedFile('900050_validation.xls', f.read())})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors['sheet'], ['variables: sheet is missing'])
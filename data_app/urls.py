@@ -13,8 +13,14 @@ router.register(r'codes', views.CodeViewSet)
 router.register(r'verbatims', views.VerbatimViewSet)
 router.register(r'variables', views.VariableViewSet)
 router.register(r'viz_data', views.VisDataViewSet)
+router.register(r'import_jobs', views.ImportJobViewSet)
+router.register(r'upload_files', views.UploadFileViewSet)
 
 urlpatterns = (
     url(r'^', include(router.urls)),
     url(r'visualization_data', views.VerbatimsFilteredSet.as_view()),
+    url(r'visualization_batch', views.VisualizationBatch.as_view()),
+    url(r'visualization_cache', views.VisualizationCacheStats.as_view()),
+    url(r'verbatims_csv', views.VerbatimsCsvExport.as_view()),
+    url(r'validate_workbook', views.WorkbookValidation.as_view()),
 )
\ No newline at end of file
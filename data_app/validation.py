@@ -0,0 +1,244 @@
+__author__ = 'yarnaid'
+
+from collections import OrderedDict
+
+import pandas as pd
+
+REQUIRED_SHEETS = ('question', 'variables', 'verbatims')
+QUESTION_COLUMNS = ('id', 'type', 'code_book', 'text', 'title')
+CODE_BOOK_COLUMNS = ('NET', 'Sub net', 'Codes', 'text', 'title')
+# uid, sex, age_bands, reg_quota, csp_quota, main_cell_text by position
+VARIABLE_COLUMNS = 6
+MAX_TEXT = 255  # of Variable.main_cell_text
+
+
+class WorkbookInvalid(ValueError):
+    """Workbook the import would fail on
+
+    Attributes:
+    -----------
+        errors: list of dicts, see validate
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        shown = '; '.join(describe(error) for error in errors[:10])
+        more = ' and {} more'.format(len(errors) - 10) if len(errors) > 10 else ''
+        super(WorkbookInvalid, self).__init__('{} errors in the workbook: {}{}'.format(len(errors), shown, more))
+
+
+def describe(error):
+    place = [error['sheet'] or 'workbook']
+    if error['column'] is not None:
+        place.append(u'column {}'.format(error['column']))
+    if error['row'] is not None:
+        place.append(u'row {}'.format(error['row']))
+    return u'{}: {}'.format(', '.join(place), error['message'])
+
+
+def json_value(value):
+    if pd.isnull(value):
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def sheet_error(sheet, message, column=None):
+    return {'sheet': sheet, 'row': None, 'column': column, 'value': None, 'message': message}
+
+
+def cell_errors(sheet, df, mask, column, message):
+    """Errors of the cells of the column in the rows of the mask
+
+    Rows are numbered as in Excel: the header is row 1.
+
+    Arguments:
+    ----------
+        message: String
+            formatted with the value of the cell
+    """
+    cells = df.loc[mask, column]
+    return [{'sheet': sheet, 'row': int(row) + 2, 'column': unicode(column),
+             'value': json_value(value), 'message': message.format(json_value(value))}
+            for row, value in cells.iteritems()]
+
+
+def not_integer(series):
+    """Mask of filled cells that are not integer numbers
+    """
+    numbers = pd.to_numeric(series, errors='coerce')
+    return series.notnull() & (numbers.isnull() | (numbers % 1 != 0))
+
+
+def integers(series):
+    """Integer values of the filled cells, other cells are NaN
+    """
+    numbers = pd.to_numeric(series, errors='coerce')
+    return numbers.where(numbers % 1 == 0)
+
+
+def check_columns(sheet, df, columns):
+    return [sheet_error(sheet, 'column is missing', column=column)
+            for column in columns if column not in df.columns]
+
+
+def check_questions(df):
+    """Returns:
+    --------
+        (errors, {question id: code book name or None})
+    """
+    errors = check_columns('question', df, QUESTION_COLUMNS)
+    if errors:
+        return errors, None
+    for column in ('id', 'type'):
+        errors += cell_errors('question', df, df[column].isnull(), column, 'value is empty')
+    filled = df[df['id'].notnull()]
+    books = filled['code_book'].where(filled['code_book'].notnull(), None)
+    return errors, dict(zip(filled['id'], books))
+
+
+def check_variables(df):
+    """Returns:
+    --------
+        (errors, set of respondent uids)
+    """
+    if len(df.columns) < VARIABLE_COLUMNS:
+        return [sheet_error('variables', 'sheet has {} columns instead of {}'.format(
+            len(df.columns), VARIABLE_COLUMNS))], None
+    uid = df.columns[0]
+    errors = cell_errors('variables', df, df[uid].isnull(), uid, 'respondent is empty')
+    for column in df.columns[:VARIABLE_COLUMNS - 1]:
+        errors += cell_errors('variables', df, not_integer(df[column]), column, 'value {} is not an integer')
+    text = df[df.columns[VARIABLE_COLUMNS - 1]]
+    errors += cell_errors('variables', df, text.astype(unicode).str.len().gt(MAX_TEXT) & text.notnull(),
+                          df.columns[VARIABLE_COLUMNS - 1],
+                          'value is longer than {} characters'.format(MAX_TEXT))
+    return errors, set(integers(df[uid]).dropna().astype(int))
+
+
+def check_code_book(name, df):
+    """NET rows without Sub net are overcodes, other NET rows are subnets
+    of their NET overcode, rows with Codes are codes of their Sub net or,
+    without it, of their NET (see UploadFile.parse_codes)
+
+    Returns:
+    --------
+        (errors, set of code numbers of the codebook)
+    """
+    errors = check_columns(name, df, CODE_BOOK_COLUMNS)
+    if errors:
+        return errors, None
+    numbers = dict()
+    for column in ('NET', 'Sub net', 'Codes'):
+        errors += cell_errors(name, df, not_integer(df[column]), column, 'value {} is not an integer')
+        numbers[column] = integers(df[column])
+    net, sub_net, code = numbers['NET'], numbers['Sub net'], numbers['Codes']
+    nets = df['Codes'].isnull() & df['Sub net'].isnull()
+    sub_nets = df['Codes'].isnull() & df['Sub net'].notnull()
+    codes = df['Codes'].notnull()
+
+    errors += cell_errors(name, df, (nets | sub_nets) & df['NET'].isnull(), 'NET',
+                          'NET of overcode or subnet is empty')
+    overcodes = set(net[nets].dropna())
+    errors += cell_errors(name, df, sub_nets & net.notnull() & ~net.isin(overcodes), 'NET',
+                          'NET {} of the subnet is not an overcode')
+    subnets = set(sub_net[sub_nets].dropna())
+    errors += cell_errors(name, df, codes & sub_net.notnull() & ~sub_net.isin(subnets), 'Sub net',
+                          'Sub net {} of the code is not a subnet')
+    errors += cell_errors(name, df, codes & df['Sub net'].isnull() & net.notnull() & ~net.isin(overcodes),
+                          'NET', 'NET {} of the code is not an overcode')
+    return errors, overcodes | subnets | set(code.dropna())
+
+
+def check_verbatims(df, questions, uids, books):
+    """Every question of the columns is in question sheet, every coded
+    answer refers to a respondent of variables and to codes of the
+    codebook of the question (see UploadFile.parse_verbatims)
+
+    Arguments:
+    ----------
+        questions: dict {question id: code book name}
+        uids: set of respondents
+        books: dict {code book name: set of code numbers}
+    """
+    errors = list()
+    if not len(df.columns):
+        return [sheet_error('verbatims', 'sheet is empty')]
+    uid = df.columns[0]
+    columns = OrderedDict()
+    for column in df.columns[1:]:
+        columns.setdefault(unicode(column).split('-')[0].rstrip(), list()).append(column)
+
+    coded = pd.Series(False, index=df.index)
+    for name, question_columns in columns.items():
+        if questions is not None and name not in questions:
+            errors.append(sheet_error('verbatims', u'question {} is not in question sheet'.format(name),
+                                      column=question_columns[0]))
+            continue
+        answered = df[uid].notnull() & df[question_columns[0]].notnull()
+        book = questions.get(name) if questions is not None else None
+        for column in question_columns[1:]:
+            if unicode(column).count('text_') > 0:
+                continue
+            cells = answered & df[column].notnull()
+            coded |= cells
+            errors += cell_errors('verbatims', df, cells & not_integer(df[column]), column,
+                                  'code {} is not an integer')
+            if questions is None or books is None:
+                continue
+            if book is None:
+                errors += cell_errors('verbatims', df, cells, column,
+                                      u'code {{}} is given, question {} has no codebook'.format(name))
+            elif book in books:
+                unknown = cells & integers(df[column]).notnull() & ~integers(df[column]).isin(books[book])
+                errors += cell_errors('verbatims', df, unknown, column,
+                                      u'code {{}} is not in codebook {}'.format(book))
+            else:
+                errors += cell_errors('verbatims', df, cells, column,
+                                      u'code {{}} is given, codebook {} has no sheet'.format(book))
+    errors += cell_errors('verbatims', df, coded & not_integer(df[uid]), uid, 'respondent {} is not an integer')
+    if uids is not None:
+        errors += cell_errors('verbatims', df, coded & integers(df[uid]).notnull() & ~integers(df[uid]).isin(uids),
+                              uid, 'respondent {} is not in variables')
+    return errors
+
+
+def missing_sheets(sheet_names):
+    return [sheet_error(sheet, 'sheet is missing') for sheet in REQUIRED_SHEETS if sheet not in sheet_names]
+
+
+def validate(excel_file, code_book_names):
+    """Finds everything the import of the workbook would fail on
+
+    Sheets are compared column by column, no rows are written, so the
+    whole report is ready before the import transaction starts.
+
+    Arguments:
+    ----------
+        excel_file: ExcelFile
+            or SheetReader
+        code_book_names: list
+            cb_* sheets of the workbook
+    Returns:
+    --------
+        list of errors {sheet, row, column, value, message}, empty if
+        the workbook can be imported; rows are numbered as in Excel
+    """
+    errors = missing_sheets(excel_file.sheet_names)
+    missing = set(error['sheet'] for error in errors)
+    questions = uids = None
+    books = dict()
+    for name in code_book_names:
+        book_errors, books[name] = check_code_book(name, excel_file.parse(name))
+        errors += book_errors
+    if None in books.values():
+        books = None
+    if 'question' not in missing:
+        question_errors, questions = check_questions(excel_file.parse('question'))
+        errors += question_errors
+    if 'variables' not in missing:
+        variable_errors, uids = check_variables(excel_file.parse('variables'))
+        errors += variable_errors
+    if 'verbatims' not in missing:
+        errors += check_verbatims(excel_file.parse('verbatims'), questions, uids, books)
+    return errors
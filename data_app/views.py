@@ -4,37 +4,58 @@ from django.db.models import Count
 from data_app import models
 from rest_framework import viewsets
 from data_app import serializers
+from data_app import aggregation
+from data_app import cache
+from data_app.pagination import IdCursorPagination
+from data_app.query_plan import QueryPlanMixin
+from data_app import fast_serializers
+from data_app.fast_serializers import FastListMixin
+from data_app.fast_serializers import FastJSONRenderer
+import helpers
+import json
 import rest_framework_filters as filters
+from rest_framework.exceptions import NotFound
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
 
-class JobViewSet(viewsets.ModelViewSet):
+class JobRowsMixin(object):
+    ''' Deletes rows with models.delete_job_rows, which brings counts
+        and the version of their job up to date once per request
+    '''
+
+    def perform_destroy(self, instance):
+        models.delete_job_rows(type(instance).objects.filter(pk=instance.pk))
+
+
+class JobViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = models.Job.objects.all()
     serializer_class = serializers.JobSerializer
     filter_fields = ('id', 'name', 'number')
 
 
-class QuestionViewSet(viewsets.ModelViewSet):
-    queryset = models.Question.objects.all().prefetch_related('verbatim_set', 'parent')
+class QuestionViewSet(JobRowsMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.Question.objects.all()
     serializer_class = serializers.QuestionSerializer
     filter_fields = ('id', 'name', 'code_book', 'parent', 'kind', 'verbatim')
 
 
-class ShortQuestionViewSet(viewsets.ModelViewSet):
-    queryset = models.Question.objects.exclude(kind='Variable').prefetch_related('verbatim_set', 'parent')
+class ShortQuestionViewSet(JobRowsMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.Question.objects.exclude(kind='Variable')
     serializer_class = serializers.ShortQuestionSerializer
     filter_fields = ('id', 'parent', 'kind', 'name')
 
 
-class VariableCodesViewSet(viewsets.ModelViewSet):
-    queryset = models.Question.objects.filter(kind='Variable').prefetch_related('verbatim_set', 'parent')
+class VariableCodesViewSet(JobRowsMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.Question.objects.filter(kind='Variable')
     serializer_class = serializers.VariableCodesSerializer
     filter_fields = ('id', 'parent', 'name')
 
 
-class CodeBookViewSet(viewsets.ModelViewSet):
-    queryset = models.CodeBook.objects.all().prefetch_related('verbatim_set', 'parent', 'code_book')
+class CodeBookViewSet(JobRowsMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.CodeBook.objects.all()
     serializer_class = serializers.CodeBookSerializer
     filter_fields = ('id', 'name', 'job')
 
@@ -68,31 +89,210 @@ class CodeFilter(filters.FilterSet):
         fields = ('overcode', 'code_book', 'id', 'job', 'children_verbatims')
 
 
-class CodeViewSet(viewsets.ModelViewSet):
-    queryset = models.Code.objects.all().prefetch_related('job', 'code_book', 'parent', 'children_verbatims__question',
-                                                          'children_verbatims', 'children_verbatims__variable')
+class CodeViewSet(JobRowsMixin, FastListMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.Code.objects.all()
     serializer_class = serializers.CodeSerializer
+    fast_serializer_class = fast_serializers.CodeValues
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    allow_stream = True
     filter_fields = ('overcode', 'code_book', 'id', 'job', 'children_verbatims')
     filter_class = CodeFilter
+    pagination_class = IdCursorPagination
 
 
-class VerbatimViewSet(viewsets.ModelViewSet):
-    queryset = models.Verbatim.objects.all().prefetch_related('parent', 'variable', 'question')
+class VerbatimViewSet(JobRowsMixin, FastListMixin, QueryPlanMixin, viewsets.ModelViewSet):
+    queryset = models.Verbatim.objects.all()
     serializer_class = serializers.VerbatimSerialier
+    fast_serializer_class = fast_serializers.VerbatimValues
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+    allow_stream = True
     filter_class = VerbatimFilter
+    pagination_class = IdCursorPagination
 
 
-class VariableViewSet(viewsets.ModelViewSet):
+class VariableViewSet(JobRowsMixin, FastListMixin, QueryPlanMixin, viewsets.ModelViewSet):
     queryset = models.Variable.objects.all()
     serializer_class = serializers.VariableSerializer
+    fast_serializer_class = fast_serializers.VariableValues
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
     filter_class = VariableFilter
+    pagination_class = IdCursorPagination
 
 
-class VisDataViewSet(viewsets.ModelViewSet):
+class ImportJobViewSet(viewsets.ReadOnlyModelViewSet):
+    ''' Queued and finished spreadsheet imports with per-stage progress
+    '''
+    queryset = models.ImportJob.objects.all().select_related('upload')
+    serializer_class = serializers.ImportJobSerializer
+    filter_fields = ('id', 'status', 'job')
+
+
+class UploadFileViewSet(viewsets.ReadOnlyModelViewSet):
+    ''' Uploaded spreadsheets with wall/CPU time, rows and queries
+        of every import stage
+    '''
+    queryset = models.UploadFile.objects.all()
+    serializer_class = serializers.UploadFileSerializer
+    filter_fields = ('id', )
+
+
+class WorkbookValidation(APIView):
+    ''' Errors the import of the workbook would fail on, found without
+        writing anything
+
+    POST multipart with the workbook in "sheet", or
+    GET /validate_workbook?upload={UploadFile Id} for the stored one.
+    Response is {"valid": bool, "errors": [{"sheet", "row", "column", "value", "message"}, ...]},
+    rows are numbered as in Excel.
+    '''
+
+    def get(self, request, format=None):
+        try:
+            upload = models.UploadFile.objects.get(pk=int(request.query_params['upload']))
+        except (KeyError, ValueError):
+            raise ParseError('upload parameter is required')
+        except models.UploadFile.DoesNotExist:
+            raise NotFound('no upload {}'.format(request.query_params['upload']))
+        return self.report(upload.sheet.path)
+
+    def post(self, request, format=None):
+        if 'sheet' not in request.FILES:
+            raise ParseError('sheet file is required')
+        return self.report(request.FILES['sheet'])
+
+    def report(self, f):
+        errors = models.UploadFile.validate_file(f)
+        return Response({'valid': not errors, 'errors': errors})
+
+
+class VerbatimsCsvExport(APIView):
+    ''' Streams all verbatims of the job as CSV in the order of their ids
+
+    /verbatims_csv?job={job Id}
+
+    Verbatims are read by chunks of chunk_size rows, see
+    fast_serializers.keyset_chunks
+    '''
+    fields = ('id', 'variable__uid', 'variable__sex', 'variable__age_bands',
+              'variable__reg_quota', 'variable__csp_quota', 'variable__main_cell_text',
+              'question__name', 'parent__code', 'parent__title', 'verbatim')
+    header = ('id', 'uid', 'sex', 'age_bands', 'reg_quota', 'csp_quota', 'main_cell_text',
+              'question', 'code', 'code_title', 'verbatim')
+    chunk_size = 1000
+
+    def get(self, request, format=None):
+        try:
+            job_id = int(request.query_params['job'])
+        except (KeyError, ValueError):
+            raise ParseError('job must be integer')
+        try:
+            job = models.Job.objects.get(pk=job_id)
+        except models.Job.DoesNotExist:
+            raise NotFound('no job {}'.format(job_id))
+        verbatims = models.Verbatim.objects.filter(job=job).values(*self.fields)
+        rows = ([row[f] for f in self.fields]
+                for chunk in fast_serializers.keyset_chunks(verbatims, self.chunk_size)
+                for row in chunk)
+        return helpers.rows_csv_response(rows, self.header, 'verbatims_{}.csv'.format(job.number))
+
+
+class VisDataViewSet(QueryPlanMixin, viewsets.ModelViewSet):
     queryset = models.Job.objects.all()
     serializer_class = serializers.VisDataSerializer
     filter_fields = ('id', 'children_questions')
 
+
+class VisualizationCacheStats(APIView):
+    ''' Hit and miss counters of visualization_data responses cache
+    '''
+
+    def get(self, request, format=None):
+        return Response(cache.stats())
+
+
+class VisualizationBatch(APIView):
+    ''' Several visualization_data responses in one request,
+        e.g. all windows of the compare page
+
+    Supports GET with JSON list in the query parameter:
+    /visualization_batch?specs=[{"key": "1", "job": 126, "question": 3, "age_bands": 3}, ...]
+    and POST of {"specs": [...]}. Spec has the parameters of visualization_data,
+    response is {key of the spec (or its index): visualization_data response}.
+
+    Every spec is cached as single visualization_data response. For missed
+    specs jobs, questions and codes of all codebooks are fetched once, then
+    counts of every spec are taken (see aggregation.batch_code_counts) from
+    the in-memory JobIndex of its job, else sliced from QuestionCube of its
+    question when filtered by demographics only, else counted by a GROUP BY
+    query of its own.
+    '''
+    ignored = ('format', 'visualization')
+
+    def get(self, request, format=None):
+        try:
+            specs = json.loads(request.query_params['specs'])
+        except (KeyError, ValueError):
+            raise ParseError('specs must be JSON list')
+        return Response(self.build_batch(specs))
+
+    def post(self, request, format=None):
+        return Response(self.build_batch(request.data.get('specs')))
+
+    def parse_spec(self, index, spec):
+        ''' Key, job id, question id and Variable filters of the spec
+        '''
+        try:
+            spec = dict(spec)
+            key = str(spec.pop('key', index))
+            filters = {name: int(value) for name, value in spec.iteritems()
+                       if name not in self.ignored}
+            return key, filters.pop('job'), filters.pop('question'), filters
+        except (KeyError, TypeError, ValueError):
+            raise ParseError('spec {} must have integer job and question'.format(index))
+
+    def build_batch(self, specs):
+        if not isinstance(specs, list) or not specs:
+            raise ParseError('specs must be non-empty JSON list')
+        specs = [self.parse_spec(i, spec) for i, spec in enumerate(specs)]
+        jobs = models.Job.objects.in_bulk(set(spec[1] for spec in specs))
+        missing = set(spec[1] for spec in specs) - set(jobs)
+        if missing:
+            raise NotFound('no jobs {}'.format(sorted(missing)))
+
+        vis_cache = cache.get_cache()
+        keys = [cache.visualization_key(jobs[job_id], question_id, filters)
+                for key, job_id, question_id, filters in specs]
+        cached = vis_cache.get_many(keys)
+        result = dict()
+        missed = list()
+        for spec, cache_key in zip(specs, keys):
+            if cache_key in cached:
+                cache.count('hits')
+                result[spec[0]] = cached[cache_key]
+            else:
+                cache.count('misses')
+                missed.append((spec, cache_key))
+        if not missed:
+            return result
+
+        questions = models.Question.objects.select_related('code_book').in_bulk(
+            set(spec[2] for spec, cache_key in missed))
+        missing = set(spec[2] for spec, cache_key in missed) - set(questions)
+        if missing:
+            raise NotFound('no questions {}'.format(sorted(missing)))
+        trees = aggregation.code_trees(q.code_book_id for q in questions.values())
+        counts = aggregation.batch_code_counts([(questions[spec[2]], spec[3])
+                                                for spec, cache_key in missed], jobs=jobs)
+        built = dict()
+        for (spec, cache_key), spec_counts in zip(missed, counts):
+            key, job_id, question_id, filters = spec
+            question = questions[question_id]
+            overcodes = aggregation.build_hierarchy(question, trees[question.code_book_id], spec_counts)
+            result[key] = built[cache_key] = aggregation.response_body(jobs[job_id], question, overcodes)
+        vis_cache.set_many(built)
+        return result
+
+
 class VerbatimsFilteredSet(APIView):
     ''' Class appointed to fast access to Verbatims statistics and data
 
@@ -110,115 +310,47 @@ class VerbatimsFilteredSet(APIView):
         params.pop('visualization', None)
         print params
         query_parameters_dict = {key: int(value[0]) for key, value in params.iteritems()}
-        job = models.Job.objects.get(pk=int(query_parameters_dict['job']))
-
-        question = models.Question.objects.get(pk=int(query_parameters_dict['question']))
-        code_book = question.code_book
-
-        response_body = {
-            'job_number': job.number,
-            'job_name': job.name,
-            'question': {
-                'codebook_name': code_book.name,
-                'title': question.title,
-                'text': question.text,
-                'name': question.name,
-                'kind': question.kind,
-                'verbatim_count': 0,
-            }
-        }
-
-        query_parameters_dict.pop('question')
-        query_parameters_dict.pop('job')
-        query_parameters_dict.pop('visualization', None)
-
-        overcodes_array = self.go_through_children(question, query_parameters_dict)
-
-        response_body['question']['children'] = overcodes_array
-        for child in overcodes_array:
-            response_body['question']['verbatim_count'] += child['verbatim_count']
-            child['overcode'] = True
-        for child in overcodes_array:
-            child['total'] = child['verbatim_count'] / response_body['question']['verbatim_count']
+        job = models.Job.objects.get(pk=int(query_parameters_dict.pop('job')))
+        question_id = query_parameters_dict.pop('question')
+
+        vis_cache = cache.get_cache()
+        key = cache.visualization_key(job, question_id, query_parameters_dict)
+        response_body = vis_cache.get(key)
+        if response_body is None:
+            cache.count('misses')
+            response_body = self.build_response(job, question_id, query_parameters_dict)
+            vis_cache.set(key, response_body)
+        else:
+            cache.count('hits')
         return Response(response_body)
 
-    def go_through_children(self, question, query_parameters_dict):
+    def build_response(self, job, question_id, query_parameters_dict):
+        question = models.Question.objects.select_related('code_book').get(pk=question_id)
+        overcodes_array = self.go_through_children(question, query_parameters_dict, job)
+        return aggregation.response_body(job, question, overcodes_array)
+
+    def go_through_children(self, question, query_parameters_dict, job=None):
         ''' Represents all children overcodes of the question as dict
             for serializing tp JSON
 
+            Query count doesn't depend on codebook size: codes of the
+            codebook are fetched once, verbatim counts come from the
+            in-memory index of the job (see data_app.job_index), the tree
+            is assembled in memory
+
         Arguments:
         ---------
             question: Question
 
             query_parameters_dict: dict{String:int}
                 query parameters got from request
-        Returns:
-        --------
-            dict of JSON-like data about children of the question
-        '''
-        variables = []
-        if len(query_parameters_dict) != 0:
-            variables = models.Variable.objects.filter(**query_parameters_dict)
-        unprocessed = [q for q in models.Code.objects.filter(code_book=question.code_book, overcode=True)]
-        children = list()
-
-        for code in unprocessed:
-            child = self.hierarchy_dfs(question, code, variables)
-            if child is not None:
-                children.append(child)
-
-        return children
 
-    def hierarchy_dfs(self, question, parent_code, variables, depth=0):
-        ''' Builds tree-like hierarchy for children codes and returns
-            its JSON-like representation
-
-        Arguments:
-        ----------
-            question: Question
-
-            parent_code: Code
-                code, that is parent for current ones
-            variables: Variable
-                subset of variables, restricted by request parameters
-            depth: int
-                level of current code in children hierarchy
+            job: Job
+                job of the question
         Returns:
         --------
-            The code with information about its children and level in hierarchy represented in dict
+            dict of JSON-like data about children of the question
         '''
-        if len(variables) != 0:
-            count = models.Verbatim.objects.filter(parent=parent_code,
-                                                   question=question,
-                                                   variable__in=variables).count()
-        else:
-            count = models.Verbatim.objects.filter(parent=parent_code,
-                                                   question=question,
-                                                   ).count()
-        code_dict = {
-            'id': parent_code.id,
-            'title': parent_code.title,
-            'code': parent_code.code,
-            'text': parent_code.text,
-            'code_depth': depth,
-            'question_id': question.id,
-            'verbatim_count': count
-        }
-
-        codes = parent_code.get_children()
-
-        if count == 0 and codes.count() == 0:
-            return None
-
-        children_list = list()
-        for code in codes:
-            child = self.hierarchy_dfs(question, code, variables, depth+1)
-            if child is not None:
-                children_list.append(child)
-                code_dict['verbatim_count'] += child['verbatim_count']
-
-        if len(children_list) == 0 and count == 0:
-            return None
-        else:
-            code_dict['children'] = children_list
-        return code_dict
+        codes = aggregation.code_tree(question.code_book_id)
+        counts = aggregation.code_counts(question, query_parameters_dict, job=job)
+        return aggregation.build_hierarchy(question, codes, counts)
@@ -1,2 +1,2 @@
 __author__ = 'yarnaid'
-from json2csv import json2csv
\ No newline at end of file
+from json2csv import json2csv, csv_response, rows_csv_response
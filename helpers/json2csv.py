@@ -5,10 +5,103 @@ __author__ = 'yarnaid'
 import json
 import csv
 
+from django.http import StreamingHttpResponse
 
-def json2csv(response, data):
-    writer = csv.writer(response)
-    writer.writerow(data[0].keys())  # header
+
+class Echo(object):
+    """File-like object returning written value instead of buffering it
+    """
+
+    def write(self, value):
+        return value
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def columns(data):
+    """Keys of all rows in order of first appearance
+
+    Rows with missing keys get empty cells instead of shifted values.
+    Order is stable for OrderedDict rows, e.g. of helpers.stubs.load
+    """
+    fields = list()
+    seen = set()
+    for row in data:
+        for key in row.keys():
+            if key not in seen:
+                seen.add(key)
+                fields.append(key)
+    return fields
+
+
+def csv_lines(rows, header):
+    """Generator of encoded CSV lines, header first
+
+    Arguments:
+    ----------
+        rows: iterable of sequences
+            values in the order of header
+        header: list
+            column names
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([encode(h) for h in header])
+    for row in rows:
+        yield writer.writerow([encode(v) for v in row])
+
+
+def dict_rows(data, fields):
     for row in data:
-        writer.writerow(row.values())
-    return response
\ No newline at end of file
+        yield [row.get(f, '') for f in fields]
+
+
+def json2csv(response, data):
+    """Writes list of dicts to the buffered response
+    """
+    fields = columns(data)
+    for line in csv_lines(dict_rows(data, fields), fields):
+        response.write(line)
+    return response
+
+
+def csv_response(data, filename, fields=None):
+    """Streams list of dicts as CSV attachment
+
+    Arguments:
+    ----------
+        data: list of dicts
+        filename: str
+        fields: list
+            columns to export, all keys of data by default
+    """
+    if fields is None:
+        fields = columns(data)
+    return attachment(csv_lines(dict_rows(data, fields), fields), filename)
+
+
+def rows_csv_response(rows, header, filename):
+    """Streams rows as CSV attachment
+
+    Rows are consumed while the response is sent, a generator of rows
+    read chunk by chunk (see data_app.fast_serializers.keyset_chunks)
+    keeps memory bounded.
+
+    Arguments:
+    ----------
+        rows: iterable of sequences
+            values in the order of header
+        header: list
+            column names
+        filename: str
+    """
+    return attachment(csv_lines(rows, header), filename)
+
+
+def attachment(lines, filename):
+    response = StreamingHttpResponse(lines, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+    return response
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+__author__ = 'yarnaid'
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+_loaded = dict()  # path: (mtime, data, payload)
+_lock = threading.Lock()
+
+
+def stub_path(name):
+    return os.path.join(settings.BASE_DIR, settings.STUB, name)
+
+
+def _load(name):
+    """Parsed stub file and its JSON payload, cached per process
+
+    File is read again only when its modification time changes. Keys
+    keep the order of the file, so do columns of CSV exports.
+    """
+    path = stub_path(name)
+    mtime = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached
+    with _lock:
+        cached = _loaded.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'r') as f:
+                data = json.load(f, object_pairs_hook=OrderedDict)
+            cached = (mtime, data, json.dumps(data))
+            _loaded[path] = cached
+    return cached
+
+
+def load(name):
+    """Parsed content of the stub file, shared between requests,
+    so it must not be modified
+    """
+    return _load(name)[1]
+
+
+def payload(name):
+    """Serialized content of the stub file, ready for HttpResponse
+    """
+    return _load(name)[2]
+
+
+def get_verbatim(code_id):
+    """Verbatims of the code from the lex stub
+    """
+    return load(settings.LEX_NAME)[code_id]
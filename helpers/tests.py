@@ -1,3 +1,92 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
 from django.test import TestCase
+from django.test import override_settings
+
+import helpers
+from helpers import stubs
+
+
+class StubTestCase(TestCase):
+    """Stub files written to a temporary STUB directory
+    """
+
+    def setUp(self):
+        self.stub_dir = tempfile.mkdtemp()
+        self.stub_settings = override_settings(STUB=self.stub_dir)
+        self.stub_settings.enable()
+
+    def tearDown(self):
+        self.stub_settings.disable()
+        shutil.rmtree(self.stub_dir)
+
+    def write_stub(self, name, content):
+        with open(os.path.join(self.stub_dir, name), 'w') as f:
+            f.write(content)
+
+
+class StubsTest(StubTestCase):
+    """Stub files are parsed and serialized once per modification
+    """
+
+    def test_reload(self):
+        self.write_stub('sample.json', '{"nodes": [1]}')
+        data = stubs.load('sample.json')
+        self.assertEqual(data, {'nodes': [1]})
+        self.assertIs(stubs.load('sample.json'), data)
+
+        self.write_stub('sample.json', '{"nodes": [2]}')
+        path = stubs.stub_path('sample.json')
+        mtime = os.path.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(stubs.load('sample.json'), {'nodes': [2]})
+        self.assertEqual(stubs.payload('sample.json'), '{"nodes": [2]}')
+
+    def test_get_verbatim(self):
+        self.write_stub('lex.json', '{"201": [{"answer": "le r\\u00e9sultat", "id": 24}], "704": []}')
+        with self.settings(LEX_NAME='lex.json'):
+            self.assertEqual(stubs.get_verbatim('201'), [{'answer': u'le r\xe9sultat', 'id': 24}])
+            self.assertEqual(stubs.get_verbatim('704'), [])
+            self.assertRaises(KeyError, stubs.get_verbatim, '999')
+            # looked up in the parsed file, not read again
+            self.assertIs(stubs.get_verbatim('201'), stubs.load('lex.json')['201'])
+
+    def test_payload(self):
+        self.write_stub('sample.json', '{"nodes": [{"title": "a", "id": 1}], "clusters": []}')
+        payload = stubs.payload('sample.json')
+        self.assertEqual(payload, json.dumps(stubs.load('sample.json')))
+        self.assertEqual(json.loads(payload), {'nodes': [{'title': 'a', 'id': 1}], 'clusters': []})
+
+        User.objects.create_user('user', 'user@example.com', 'user')
+        self.client.login(username='user', password='user')
+        for url in ('/en/cloud/', '/en/wordle/', '/en/tree/'):
+            response = self.client.post(url, {'all': 'true'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(response.content, payload, url)
+
+
+class CsvResponseTest(StubTestCase):
+    """Columns of CSV exports follow the order of the stub file
+    """
+
+    def rows(self, response):
+        return list(csv.reader(''.join(response.streaming_content).splitlines()))
+
+    def test_column_order(self):
+        self.write_stub('nodes.json', '{"nodes": [{"title": "a", "id": 1, "code": 10},'
+                                      ' {"total": 5, "title": "b", "id": 2}]}')
+        response = helpers.csv_response(stubs.load('nodes.json')['nodes'], 'nodes.csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="nodes.csv"')
+        self.assertEqual(self.rows(response), [['title', 'id', 'code', 'total'],
+                                               ['a', '1', '10', ''],
+                                               ['b', '2', '', '5']])
 
-# Create your tests here.
+    def test_rows(self):
+        rows = iter([(1, u'r\xe9sultat'), (2, None)])
+        response = helpers.rows_csv_response(rows, ('id', 'answer'), 'answers.csv')
+        self.assertEqual(self.rows(response), [['id', 'answer'], ['1', 'r\xc3\xa9sultat'], ['2', '']])
@@ -48,13 +48,20 @@ Rest.prototype.get_last_question = function(job_id) {
 
 Rest.prototype.get_verbatim = function(code_id) {
     var self = this;
-    var verbatims;
-    $.ajax({
-        async: false,
-        url: '/data/verbatims/?format=json&parent=' + code_id,
-        success: function(v) {
-            verbatims = v;
-        }
-    });
+    var verbatims = [];
+    var url = '/data/verbatims/?format=json&page_size=1000&parent=' + code_id;
+    while (url) {
+        $.ajax({
+            async: false,
+            url: url,
+            success: function(page) {
+                verbatims = verbatims.concat(page.results);
+                url = page.next;
+            },
+            error: function() {
+                url = null;
+            }
+        });
+    }
     return verbatims;
 };
\ No newline at end of file
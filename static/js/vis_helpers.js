@@ -103,14 +103,23 @@ Rest.prototype.get_last_question = function(job_id) {
 
 Rest.prototype.get_verbatims = function(code_id, question_id) {
     var self = this;
-    var verbatims;
-    $.ajax({
-        async: false,
-        url: '/data/verbatims/?format=json&parent=' + code_id + '&question=' + question_id,
-        success: function(v) {
-            verbatims = v;
-        }
-    });
+    var verbatims = [];
+    // verbatims are paged, see data_app.pagination.IdCursorPagination
+    var url = '/data/verbatims/?format=json&page_size=1000&fields=id,verbatim,variable' +
+        '&parent=' + code_id + '&question=' + question_id;
+    while (url) {
+        $.ajax({
+            async: false,
+            url: url,
+            success: function(page) {
+                verbatims = verbatims.concat(page.results);
+                url = page.next;
+            },
+            error: function() {
+                url = null;
+            }
+        });
+    }
     return verbatims;
 };
 
@@ -215,20 +224,22 @@ var tooltip_html = function(d) {
     return res;
 };
 
+var vis_data_params = function(col) {
+    var params = {};
+    $.each(eval('get_filter_params_'+col+'()'), function(k, v) {
+        if (v !== '-1') {
+            params[k] = v;
+        }
+    });
+    return params;
+};
+
 var get_vis_data = function(job_id, question_name, col) {
     col = col || 1;
-    var overcodes = {},
-        codes = [],
-        verbatims = {},
-        res;
-    var rest = new Rest();
-    var question = rest.get_short_questions(job_id, "&name="+question_name)[0];
-    var filter_params = eval('get_filter_params_'+col+'()');
+    var res;
     var url_ = '/data/visualization_data/?format=json';
-    $.each(filter_params, function(k, v) {
-        if (v !== '-1') {
-            url_ += '&' + k + '=' + v;
-        }
+    $.each(vis_data_params(col), function(k, v) {
+        url_ += '&' + k + '=' + v;
     });
 
     $.ajax({
@@ -242,6 +253,38 @@ var get_vis_data = function(job_id, question_name, col) {
     return res;
 };
 
+// First loads of all windows on the page are collected
+// and fetched with one /data/visualization_batch request
+var vis_batch = {queue: [], timer: null};
+
+var load_vis_batch = function() {
+    var queue = vis_batch.queue;
+    vis_batch.queue = [];
+    vis_batch.timer = null;
+    var specs = [];
+    $.each(queue, function(i, item) {
+        specs.push($.extend(vis_data_params(item.col), {key: item.col}));
+    });
+
+    $.ajax({
+        url: '/data/visualization_batch/',
+        data: {format: 'json', specs: JSON.stringify(specs)},
+        success: function(data_) {
+            $.each(queue, function(i, item) {
+                item.callback(data_[item.col]);
+            });
+        }
+    });
+};
+
+var queue_vis_data = function(col, callback) {
+    vis_batch.queue.push({col: col, callback: callback});
+    if (vis_batch.timer === null) {
+        // filters of all windows are initialized by then
+        vis_batch.timer = setTimeout(load_vis_batch, 0);
+    }
+};
+
 
 var make_svg = function(vis_list, toggle_motion_id, svg_parent_id_, col) {
     var col = col || 1;
@@ -286,5 +329,8 @@ var make_svg = function(vis_list, toggle_motion_id, svg_parent_id_, col) {
         var vis_type = params.visualization;
         data_loaded(null, vis_data, vis_type);
     };
-    start();
+    queue_vis_data(col, function(vis_data) {
+        var params = eval('get_filter_params_'+col+'()');
+        data_loaded(null, vis_data, params.visualization);
+    });
 };
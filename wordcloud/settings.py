@@ -171,6 +171,16 @@ STUB = 'stubs'
 SAMPLE_NAME = 'sample.json'
 LEX_NAME = 'lex.json'
 
+# rows per INSERT while importing spreadsheets
+IMPORT_BATCH_SIZE = 1000
+# queue uploads for `manage.py import_worker` instead of importing in the request
+IMPORT_ASYNC = True
+# processes decoding workbook sheets during import, 0 means one per CPU,
+# the pool never has more processes than the workbook has data sheets
+IMPORT_PROCESSES = 0
+# seconds between progress updates of running import
+IMPORT_PROGRESS_INTERVAL = 1
+
 STUDY_TYPES = (
     ('l', _('LEX')),
     ('l9', _('LINK 9')),
@@ -180,9 +190,33 @@ STUDY_TYPES = (
     ('ah', _('Ad`hock')),
 )
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # visualization_data responses, for several workers use shared backend:
+    # 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    # 'LOCATION': '/var/tmp/wordcloud_cache',
+    'visualization': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'visualization',
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+VISUALIZATION_CACHE = 'visualization'
+# decoded demographic cubes of questions kept by each process
+CUBE_CACHE_SIZE = 256
+# jobs whose verbatims are indexed in memory by each process, 0 disables
+JOB_INDEX_SIZE = 8
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAdminUser',),
-    # 'PAGE_SIZE': 10,
+    # only viewsets with pagination_class are paged, page scripts read
+    # other endpoints as plain lists
+    'DEFAULT_PAGINATION_CLASS': None,
+    # page of viewsets with data_app.pagination.IdCursorPagination
+    'PAGE_SIZE': 100,
     'DEFAULT_FILTER_BACKENDS': ('rest_framework.filters.DjangoFilterBackend',),
 }
 # Default layout to use with "crispy_forms"